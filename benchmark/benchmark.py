@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import os
+import json
+import platform
+import tempfile
+import contextlib
+import subprocess
+import importlib.util
+import numpy as np
+
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'group_genetic_distance')
+sys.path.insert(0, SCRIPT_DIR)
+
+import dist_csv
+import dist_engine
+import dist_matrix
+import multi_gene
+import timings
+from alignment import PackedAlignment
+from group_index import GroupIndex
+
+
+def get_para():
+    description = '''
+Benchmark of the group distance pipeline on synthetic data.
+
+A dataset of `-specimens` specimens in `-groups` groups (group sizes
+follow a power law of exponent `-skew`, 0 gives equal sizes) is simulated
+for `-genes` genes of `-length` sites: each specimen lacks a gene with
+probability `-missing` and every site is N with probability
+`-site_missing`. The alignments are written as fasta files and their
+distance matrices (in-process K80, pairwise deletion) as csv files in the
+format of R `write.csv(dist.dna(...))`.
+
+Then every stage is timed: dist (matrices from the alignments), parse
+(csv matrix to array), parse_npy (memory-mapped binary matrix), filter
+(groups present in the gene, member index arrays), within, between,
+output (writing the per-gene files), stream (the single-pass engine),
+multi_within and multi_between (the all-genes scripts) and join
+(join_diff-gene-dist.py over the per-gene files).
+
+The JSON report holds the parameters, the versions, and per stage the
+wall and CPU seconds (the fastest of `-repeat` runs), the items processed
+and the peak RSS of the process so far (process_peak_rss_kb, not a
+per-stage peak, see timings.py). `-compare` prints the wall time ratio of
+every stage to an earlier report.
+    '''
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-specimens', metavar='<int>', type=int, default=500,
+        help='number of specimens [%(default)s]')
+
+    parser.add_argument('-groups', metavar='<int>', type=int, default=50,
+        help='number of groups [%(default)s]')
+
+    parser.add_argument('-skew', metavar='<float>', type=float, default=1.0,
+        help='group size skew, the size of the k-th group is proportional to k**-skew [%(default)s]')
+
+    parser.add_argument('-genes', metavar='<int>', type=int, default=5,
+        help='number of genes [%(default)s]')
+
+    parser.add_argument('-length', metavar='<int>', type=int, default=600,
+        help='alignment length [%(default)s]')
+
+    parser.add_argument('-missing', metavar='<float>', type=float, default=0.1,
+        help='probability that a specimen lacks a gene [%(default)s]')
+
+    parser.add_argument('-site_missing', metavar='<float>', type=float, default=0.01,
+        help='probability that a site is N [%(default)s]')
+
+    parser.add_argument('-seed', metavar='<int>', type=int, default=1,
+        help='random seed [%(default)s]')
+
+    parser.add_argument('-repeat', metavar='<int>', type=int, default=1,
+        help='runs of every stage, the fastest is reported [%(default)s]')
+
+    parser.add_argument('-median', default="exact", choices=["exact", "approx", "none"],
+        help='median mode [%(default)s]')
+
+    parser.add_argument('-workdir', metavar='<dir>', required=False,
+        help='keep the synthetic data and outputs here, instead of a temporary directory')
+
+    parser.add_argument('-o', metavar='<file>', default='benchmark.json',
+        help='JSON report [%(default)s]')
+
+    parser.add_argument('-compare', metavar='<file>', required=False,
+        help='earlier JSON report to compare the wall times with')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    args = parser.parse_args()
+
+    if args.groups < 1 or args.specimens < args.groups:
+        sys.exit('`-specimens` must be at least `-groups`!')
+
+    return args
+
+
+def group_sizes(specimens=0, groups=1, skew=1.0, rng=None):
+    '''
+    Every group gets one specimen, the others are drawn with probability
+    proportional to rank**-skew.
+    '''
+    weights = np.arange(1, groups + 1, dtype=np.float64) ** -skew
+    return 1 + rng.multinomial(specimens - groups, weights / weights.sum())
+
+
+def mutate(seqs=None, rate=0.01, rng=None):
+    hit = rng.random(seqs.shape) < rate
+    return np.where(hit, rng.integers(0, 4, seqs.shape, dtype=np.uint8), seqs)
+
+
+def simulate(args=None, outdir=None):
+    '''
+    Write groups.txt, gene<k>.fas and gene<k>.csv to outdir; return the
+    group definition file and the fasta and csv files.
+    '''
+    rng = np.random.default_rng(args.seed)
+    sizes = group_sizes(args.specimens, args.groups, args.skew, rng)
+    groups = ['Genus{0}_sp{1}'.format(g // 5, g) for g in range(args.groups)]
+    member_group = np.repeat(np.arange(args.groups), sizes)
+    seqids = ['s{0:06d}'.format(i) for i in range(args.specimens)]
+
+    group_definition = os.path.join(outdir, 'groups.txt')
+    with open(group_definition, 'w') as fhout:
+        for seqid, g in zip(seqids, member_group):
+            print(seqid, groups[g], file=fhout)
+
+    fasta_files, csv_files = [], []
+    for k in range(args.genes):
+        root = rng.integers(0, 4, (1, args.length), dtype=np.uint8)
+        genera = mutate(np.repeat(root, args.groups // 5 + 1, axis=0), 0.1, rng)
+        species = mutate(genera[np.arange(args.groups) // 5], 0.03, rng)
+        seqs = mutate(species[member_group], 0.01, rng)
+        chars = np.frombuffer(b'ACGT', dtype=np.uint8)[seqs]
+        chars[rng.random(seqs.shape) < args.site_missing] = ord('N')
+        keep = np.nonzero(rng.random(args.specimens) >= args.missing)[0]
+
+        fasta = os.path.join(outdir, 'gene{0}.fas'.format(k))
+        with open(fasta, 'w') as fhout:
+            for i in keep:
+                print('>' + seqids[i], file=fhout)
+                print(chars[i].tobytes().decode('ascii'), file=fhout)
+        fasta_files.append(fasta)
+
+        aln = PackedAlignment.read(fasta, 'fasta')
+        matrix = aln.dist_dna(model='K80', pairwise_deletion=True)
+        csv_f = os.path.join(outdir, 'gene{0}.csv'.format(k))
+        write_dist_csv(csv_f, aln.seqids, matrix)
+        csv_files.append(csv_f)
+
+    return group_definition, fasta_files, csv_files
+
+
+def write_dist_csv(f=None, seqids=None, matrix=None):
+    with open(f, 'w') as fhout:
+        print(','.join(['""'] + ['"{0}"'.format(s) for s in seqids]), file=fhout)
+        for seqid, row in zip(seqids, matrix):
+            vals = ['NA' if np.isnan(x) else '{0:.15g}'.format(x) for x in row.tolist()]
+            print('"{0}"'.format(seqid), ','.join(vals), sep=',', file=fhout)
+
+
+class Stages(object):
+    '''
+    The timings.Timings of every run.
+    '''
+
+    def __init__(self):
+        self.runs = []
+
+    def start_run(self):
+        self.runs.append(timings.Timings())
+
+    def stage(self, name=None, items=0):
+        return self.runs[-1].stage(name, items)
+
+    def report(self):
+        '''
+        The fastest run of every stage, in the order of the first run.
+        '''
+        stages = []
+        for name in self.runs[0].stages:
+            best = min((run.stages[name] for run in self.runs), key=lambda r: r['wall_seconds'])
+            record = dict(best)
+            record['wall_seconds_all'] = [run.stages[name]['wall_seconds'] for run in self.runs]
+            stages.append(record)
+        return stages
+
+
+def load_join_script():
+    spec = importlib.util.spec_from_file_location('join_diff_gene_dist',
+        os.path.join(SCRIPT_DIR, 'join_diff-gene-dist.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_pipeline(stages=None, group_definition=None, fasta_files=None, csv_files=None,
+    outdir=None, median='exact'):
+    index = GroupIndex.read(group_definition)
+    join = load_join_script()
+    null = open(os.devnull, 'w')
+
+    npy_files = []
+    for f in csv_files:
+        npy = f[:-4] + '.npy'
+        if not os.path.exists(npy):
+            dist_matrix.save_matrix(npy, *dist_csv.read_dist_csv(f))
+        npy_files.append(npy)
+
+    b_files, w_files = [], []
+    for fasta, csv_f, npy in zip(fasta_files, csv_files, npy_files):
+        with stages.stage('dist', items=1):
+            aln = PackedAlignment.read(fasta, 'fasta')
+            aln.dist_dna(model='K80', pairwise_deletion=True)
+
+        with stages.stage('parse_npy', items=1):
+            seqids, matrix = dist_matrix.load_matrix(npy)
+            dist_engine.rows_with_upper_values(matrix)
+
+        with stages.stage('parse', items=1):
+            seqids, matrix = dist_csv.read_dist_csv(csv_f)
+
+        with stages.stage('filter', items=len(seqids)):
+            gene_index = index.restrict(set(seqids))
+            members = gene_index.members(seqids)
+            codes = gene_index.codes(seqids)
+
+        ngroups = len(gene_index)
+        with stages.stage('within', items=ngroups):
+            with contextlib.redirect_stdout(null):
+                within = list(dist_engine.within_group_stats(matrix, members, gene_index.groups, median=median))
+
+        with stages.stage('between', items=ngroups * (ngroups - 1) // 2):
+            with contextlib.redirect_stdout(null):
+                between = list(dist_engine.between_groups_stats(matrix, members, gene_index.groups, median=median))
+
+        gene = os.path.splitext(os.path.basename(csv_f))[0]
+        b_o = os.path.join(outdir, gene + '.between-group.dist')
+        w_o = os.path.join(outdir, gene + '.within-group.dist')
+        with stages.stage('output', items=len(within) + len(between)):
+            with open(b_o, 'w') as fhout:
+                for code1, code2, count, stats in between:
+                    print(gene_index.groups[code1], gene_index.groups[code2],
+                        '\t'.join(str(i) for i in stats), sep='\t', file=fhout)
+            with open(w_o, 'w') as fhout:
+                for group, count, stats in within:
+                    print(group, '\t'.join(str(i) for i in stats), sep='\t', file=fhout)
+        b_files.append(b_o)
+        w_files.append(w_o)
+
+        with stages.stage('stream', items=len(seqids) * (len(seqids) - 1) // 2):
+            with contextlib.redirect_stdout(null):
+                dist_engine.dist_groups_single_pass(matrix, codes, gene_index.groups,
+                    null, null, median=median)
+
+    with stages.stage('multi_within', items=len(csv_files)):
+        present, stats = multi_gene.within_all_genes(csv_files, index, median)
+        multi_gene.print_within(index.groups, present, stats, null)
+
+    with stages.stage('multi_between', items=len(csv_files)):
+        seen, stats = multi_gene.between_all_genes(csv_files, index, median)
+        multi_gene.print_between(index.groups, seen, stats, null)
+
+    for d_type, files in (('w', w_files), ('b', b_files)):
+        f_lst = os.path.join(outdir, d_type + '_list')
+        with open(f_lst, 'w') as fhout:
+            print('\n'.join(files), file=fhout)
+        with stages.stage('join', items=len(files)):
+            join.join_files(join.read_file_list(f_lst), 2 if d_type == 'b' else 1,
+                val_width=5, out_handle=null)
+
+    null.close()
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+            cwd=SCRIPT_DIR, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('utf-8').strip()
+
+
+def compare(report=None, old_report=None):
+    old = {stage['name']: stage for stage in old_report['stages']}
+    print('# stage\twall_seconds\told_wall_seconds\tratio', file=sys.stderr)
+    for stage in report['stages']:
+        if stage['name'] not in old:
+            continue
+        new_wall, old_wall = stage['wall_seconds'], old[stage['name']]['wall_seconds']
+        ratio = new_wall / old_wall if old_wall > 0 else float('nan')
+        print(stage['name'], '{0:.4f}'.format(new_wall), '{0:.4f}'.format(old_wall),
+            '{0:.3f}'.format(ratio), sep='\t', file=sys.stderr)
+
+
+def main():
+    args = get_para()
+
+    if args.workdir:
+        if not os.path.exists(args.workdir):
+            os.makedirs(args.workdir)
+        tmp = None
+        workdir = args.workdir
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        workdir = tmp.name
+
+    stages = Stages()
+    stages.start_run()
+    with stages.stage('generate', items=args.genes):
+        group_definition, fasta_files, csv_files = simulate(args, workdir)
+    generate = stages.runs.pop().stages['generate']
+
+    for k in range(args.repeat):
+        stages.start_run()
+        run_pipeline(stages, group_definition, fasta_files, csv_files, workdir, args.median)
+
+    params = {key: value for key, value in vars(args).items() if key not in ('o', 'compare', 'workdir')}
+    report = {
+        'params': params,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'generate': generate,
+        'stages': stages.report(),
+        'peak_rss_kb': timings.peak_rss_kb(),
+    }
+    with open(args.o, 'w') as fhout:
+        json.dump(report, fhout, indent=2)
+        print(file=fhout)
+
+    if args.compare:
+        with open(args.compare, 'r') as fh:
+            compare(report, json.load(fh))
+
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
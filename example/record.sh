@@ -16,3 +16,42 @@ python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genet
 # Step 4.
 # between-group_dist_of_multi-genes
 python /Users/mengguanliang/myonedrive/OneDrive/GitHub/group_genetic_distance/group_genetic_distance/between-group_dist_of_multi-genes.py -pairwise_dist_list pairwise_dist_list -group_definition species_level_group_def.txt -delimiter '\=' -i_o all-genes.between-group.dist
+
+
+# Steps 1, 3 and 4 in one run:
+# the group definition is read once and the genes are processed in parallel
+ls *.phy > phy_list
+python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genetic_distance/batch_group_dist.py -msa_list phy_list -msa_format sequential -group_definition species_level_group_def.txt -delimiter '\=' -processes 4
+
+# Keep per-gene partial statistics; after editing the group definition,
+# the same command only recomputes the group pairs whose members changed
+python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genetic_distance/batch_group_dist.py -msa_list phy_list -msa_format sequential -group_definition species_level_group_def.txt -delimiter '\=' -state_dir group_dist_state -processes 4
+
+# Keep the all-genes aggregates; when genes are added to (or removed from)
+# pairwise_dist_list, only the new matrices are read
+python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genetic_distance/within-group_dist_of_multi-genes.py -pairwise_dist_list pairwise_dist_list -group_definition species_level_group_def.txt -delimiter '\=' -store all-genes.store -i_o all-genes.within-group.dist
+
+# Typed columnar output (npz needs only NumPy, parquet needs pyarrow, hdf5 needs h5py)
+python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genetic_distance/between-group_dist_of_multi-genes.py -pairwise_dist_list pairwise_dist_list -group_definition species_level_group_def.txt -delimiter '\=' -out_format parquet -i_o all-genes.between-group.parquet
+
+# Group x group matrices for heatmaps (see example/between_group_dist_visual),
+# rows and columns ordered by a UPGMA tree of the mean distances
+python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genetic_distance/between-group_dist_of_multi-genes.py -pairwise_dist_list pairwise_dist_list -group_definition species_level_group_def.txt -delimiter '\=' -i_o all-genes.between-group.dist -matrix_prefix all-genes.between-group -matrix_stats mean median -matrix_order cluster
+
+# Bootstrap intervals and permutation tests of the mean distances of one gene
+python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genetic_distance/group_dist.py -pairwise_dist COI.phy.csv -group_definition species_level_group_def.txt -delimiter '\=' -b_o COI.between-group.dist -i_o COI.within-group.dist -bootstrap 1000 -permutations 1000 -seed 1 -processes 4 -r_o COI.resampling.txt
+
+# Barcoding gap and nearest neighbour of every specimen and species
+python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genetic_distance/group_dist.py -pairwise_dist COI.phy.csv -group_definition species_level_group_def.txt -delimiter '\=' -engine stream -b_o COI.between-group.dist -i_o COI.within-group.dist -barcode_gap COI.barcode_gap.txt
+
+# Very large specimen sets: keep only the pairs up to 0.05 (sparse store),
+# count the others per group pair; later runs read the store
+python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genetic_distance/group_dist.py -pairwise_dist COI.npy -group_definition species_level_group_def.txt -delimiter '\=' -sparse_store COI.sparse -sparse_cutoff 0.05 -max_memory 512 -congeneric_only -b_o COI.between-group.dist -i_o COI.within-group.dist
+
+# Every gene weighs its alignment length instead of its number of distances
+# (gene_lengths: one `matrix_file length` line per gene)
+python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genetic_distance/between-group_dist_of_multi-genes.py -pairwise_dist_list pairwise_dist_list -group_definition species_level_group_def.txt -delimiter '\=' -weighting length -gene_lengths gene_lengths -median approx -i_o all-genes.between-group.length-weighted.dist
+
+# Distances of the concatenated alignment of all genes (no supermatrix file
+# needed): per-gene site counts are summed and K80 is applied once
+python3 /Users/mengguanliang/Documents/GitHub/group_genetic_distance/group_genetic_distance/batch_group_dist.py -msa_list phy_list -msa_format sequential -group_definition species_level_group_def.txt -delimiter '\=' -dist_engine native -model K80 -pairwise_deletion -supermatrix -processes 4
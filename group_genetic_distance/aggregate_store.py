@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+'''
+Persistent all-genes aggregates of the multi-gene scripts (`-store`).
+
+A store directory keeps, for one kind of output ('within' or 'between'):
+
+- <kind>.settings: the settings the partials depend on (a digest of the
+  group definition and the median mode); a store is only reused with the
+  same settings
+- <kind>.genes: the genes included, one per line: file, size, mtime and
+  SHA-256 of its content
+- <digest>.<kind>: the partial (flags, BucketStats) of every gene, see
+  multi_gene.py, named after the content digest of the gene file
+- <kind>.aggregate: the merged partials of the last run, with the digests
+  it is made of
+
+The file list of a run is the new gene set. Files whose size and mtime
+are those recorded are not read again; a gene of a new or changed file is
+reduced and added. If genes were only added, their partials are merged
+into the stored aggregate; if a gene was removed or replaced, the
+aggregate is merged again from the stored partials. No matrix of an
+unchanged gene is read in either case.
+'''
+import os
+import sys
+import functools
+import pickle
+import hashlib
+import collections
+
+import dist_cache
+import multi_gene
+import timings
+
+# bump when the stored partials would change for the same inputs
+STORE_VERSION = '1'
+
+
+def index_digest(index=None):
+    '''
+    Digest of a GroupIndex: its groups, their members and the group of
+    every seqid.
+    '''
+    h = hashlib.sha256()
+    for group in index.groups:
+        h.update('{0}\t{1}\n'.format(group, '\t'.join(index.group_seqid[group])).encode('utf-8'))
+    for seqid in sorted(index.seqid_group):
+        h.update('{0}\t{1}\n'.format(seqid, index.seqid_group[seqid]).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _dump(obj=None, f=None):
+    tmp = '{0}.{1}.tmp'.format(f, os.getpid())
+    with open(tmp, 'wb') as fhout:
+        pickle.dump(obj, fhout, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, f)
+
+
+def _load(f=None):
+    with open(f, 'rb') as fh:
+        return pickle.load(fh)
+
+
+def _weighed_partial(f=None, fold_groups=0):
+    return multi_gene.weighed_partial(_load(f), fold_groups)
+
+
+class AggregateStore(object):
+
+    def __init__(self, store_dir=None, kind='within', index=None, median='exact'):
+        self.store_dir = store_dir
+        self.kind = kind
+        self.settings = [('version', STORE_VERSION), ('groups', index_digest(index)), ('median', median)]
+
+    def _path(self, name=None):
+        return os.path.join(self.store_dir, name)
+
+    def part_file(self, digest=None):
+        return self._path('{0}.{1}'.format(digest, self.kind))
+
+    def check_settings(self):
+        '''
+        Write the settings of a new store, or exit if the store was built
+        with others.
+        '''
+        f = self._path(self.kind + '.settings')
+        if not os.path.exists(f):
+            with open(f, 'w') as fhout:
+                for key, value in self.settings:
+                    print(key, value, sep='\t', file=fhout)
+            return
+        with open(f, 'r') as fh:
+            stored = [tuple(line.rstrip('\n').split('\t', 1)) for line in fh if line.strip()]
+        if stored != self.settings:
+            sys.exit('{0}: the store was built with another group definition or median mode'.format(self.store_dir))
+
+    def read_genes(self):
+        '''
+        {file: (size, mtime_ns, digest)} of the included genes.
+        '''
+        genes = {}
+        f = self._path(self.kind + '.genes')
+        if not os.path.exists(f):
+            return genes
+        with open(f, 'r') as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                gene_file, size, mtime, digest = line.rstrip('\n').split('\t')
+                genes[gene_file] = (int(size), int(mtime), digest)
+        return genes
+
+    def write_genes(self, genes=None, files=None):
+        f = self._path(self.kind + '.genes')
+        tmp = '{0}.{1}.tmp'.format(f, os.getpid())
+        with open(tmp, 'w') as fhout:
+            for gene_file in files:
+                size, mtime, digest = genes[gene_file]
+                print(gene_file, size, mtime, digest, sep='\t', file=fhout)
+        os.replace(tmp, f)
+
+    def digests(self, files=None):
+        '''
+        {file: (size, mtime_ns, digest)} of `files`; only new or modified
+        files are read.
+        '''
+        known = self.read_genes()
+        genes = {}
+        for gene_file in files:
+            st = os.stat(gene_file)
+            if gene_file in known and known[gene_file][:2] == (st.st_size, st.st_mtime_ns):
+                genes[gene_file] = known[gene_file]
+            else:
+                genes[gene_file] = (st.st_size, st.st_mtime_ns, dist_cache.file_digest(gene_file))
+        return genes
+
+    def update(self, files=None, partial_func=None, processes=1):
+        '''
+        Bring the store to the genes of `files` and return the merged
+        (flags, stats), or (None, None) for no genes. partial_func(f)
+        reduces one gene file.
+        '''
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        self.check_settings()
+
+        genes = self.digests(files)
+        wanted = [genes[gene_file][2] for gene_file in files]
+
+        new_files = []
+        queued = set()
+        for gene_file in files:
+            digest = genes[gene_file][2]
+            if digest not in queued and not os.path.exists(self.part_file(digest)):
+                queued.add(digest)
+                new_files.append(gene_file)
+        with timings.stage('genes', items=len(new_files)):
+            for gene_file, partial in zip(new_files, multi_gene.map_genes(partial_func, new_files, processes)):
+                _dump(partial, self.part_file(genes[gene_file][2]))
+
+        aggregate_f = self._path(self.kind + '.aggregate')
+        included, flags, stats = [], None, None
+        if os.path.exists(aggregate_f):
+            included, flags, stats = _load(aggregate_f)
+        missing = collections.Counter(wanted)
+        missing.subtract(collections.Counter(included))
+        if any(count < 0 for count in missing.values()):
+            # a gene was removed or replaced: merge the partials again
+            missing = collections.Counter(wanted)
+            included, flags, stats = [], None, None
+        added = list(missing.elements())
+        with timings.stage('merge', items=len(added)):
+            part_flags, part_stats = multi_gene.merge_partials(_load(self.part_file(digest)) for digest in added)
+            if stats is None:
+                flags, stats = part_flags, part_stats
+            elif part_stats is not None:
+                flags |= part_flags
+                stats.merge(part_stats)
+        _dump((included + added, flags, stats), aggregate_f)
+        self.write_genes(genes, files)
+
+        # partials of the genes no longer included
+        suffix = '.' + self.kind
+        wanted = set(wanted)
+        for name in os.listdir(self.store_dir):
+            if name.endswith(suffix) and name[:-len(suffix)] not in wanted:
+                os.remove(self._path(name))
+        return flags, stats
+
+    def weighed_partials(self, files=None, fold_groups=0, processes=1):
+        '''
+        Yield multi_gene.weighed_partial() of the stored partial of every
+        gene of `files`, in order, computed in `processes` worker
+        processes (after update() with these files).
+        '''
+        genes = self.read_genes()
+        part_files = [self.part_file(genes[gene_file][2]) for gene_file in files]
+        func = functools.partial(_weighed_partial, fold_groups=fold_groups)
+        return multi_gene.map_genes(func, part_files, processes)
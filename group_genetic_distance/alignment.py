@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+'''
+Bit-packed nucleotide alignment for all-pairs site counting.
+
+Every sequence is stored as four bitplanes (A, C, G, T), 64 sites per
+uint64 word, in one contiguous (4, n, words) buffer. A bit is set only
+where the site is that known base, so ambiguity codes, gaps and unknown
+characters have no bit in any plane, which matches ape's `KnownBase()`.
+Sites compared, differences and transitions of a sequence against all
+later ones are then popcounts of ANDed words.
+'''
+import numpy as np
+
+import dna_dist
+
+
+A, C, G, T = 0, 1, 2, 3
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(words):
+        return np.bitwise_count(words)
+else:
+    _POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        bytes_ = words.view(np.uint8).reshape(words.shape + (8,))
+        return _POPCOUNT8[bytes_].sum(axis=-1, dtype=np.uint8)
+
+
+def pack_sites(bits=None):
+    '''
+    Pack an (n, s) bool array into (n, ceil(s / 64)) uint64 words.
+    '''
+    n, s = bits.shape
+    nbytes = (s + 63) // 64 * 8
+    packed = np.zeros((n, nbytes), dtype=np.uint8)
+    packed[:, :(s + 7) // 8] = np.packbits(bits, axis=1, bitorder='little')
+    return packed.view(np.uint64)
+
+
+class PackedAlignment(object):
+    '''
+    seqids: sequence names; planes: (4, n, words) uint64; nsites: alignment length.
+    '''
+
+    def __init__(self, seqids=None, planes=None, nsites=0):
+        self.seqids = seqids
+        self.planes = planes
+        self.nsites = nsites
+
+    @classmethod
+    def from_masks(cls, seqids=None, seqs=None):
+        '''
+        Build from the (n, s) uint8 IUPAC masks of dna_dist.read_msa().
+        '''
+        n, s = seqs.shape
+        words = (s + 63) // 64
+        planes = np.zeros((4, n, words), dtype=np.uint64)
+        for base, mask in zip((A, C, G, T), (1, 2, 4, 8)):
+            planes[base] = pack_sites(seqs == mask)
+        return cls(seqids, planes, s)
+
+    @classmethod
+    def read(cls, msa_file=None, msa_format='fasta'):
+        seqids, seqs = dna_dist.read_msa(msa_file=msa_file, msa_format=msa_format)
+        return cls.from_masks(seqids, seqs)
+
+    def known(self):
+        return self.planes[A] | self.planes[C] | self.planes[G] | self.planes[T]
+
+    def base_counts(self):
+        '''
+        Numbers of A, C, G and T over the whole alignment.
+        '''
+        return np.array([popcount(self.planes[base]).sum(dtype=np.int64)
+            for base in (A, C, G, T)], dtype=np.int64)
+
+    def base_freq(self):
+        '''
+        Frequencies of A, C, G and T over the whole alignment.
+        '''
+        counts = self.base_counts().astype(np.float64)
+        return counts / counts.sum()
+
+    def global_deletion(self):
+        '''
+        Copy without the sites that are not a known base in every sequence.
+        The sites are cleared rather than removed, which counts the same.
+        '''
+        keep = np.bitwise_and.reduce(self.known(), axis=0)
+        return PackedAlignment(self.seqids, self.planes & keep, int(popcount(keep).sum()))
+
+    def row_counts(self, i=0):
+        '''
+        Site counts of sequence i against sequences i+1..n-1
+        (see dna_dist.pair_counts).
+        '''
+        row = self.planes[:, i, None, :]
+        other = self.planes[:, i + 1:, :]
+
+        def count(words):
+            return popcount(words).sum(axis=1, dtype=np.int64)
+
+        known_i = row[A] | row[C] | row[G] | row[T]
+        known_j = other[A] | other[C] | other[G] | other[T]
+        L = count(known_i & known_j)
+        same = count(row[A] & other[A]) + count(row[C] & other[C]) + \
+            count(row[G] & other[G]) + count(row[T] & other[T])
+        return {
+            'L': L,
+            'Nd': L - same,
+            'Ns1': count(row[A] & other[G]) + count(row[G] & other[A]),
+            'Ns2': count(row[C] & other[T]) + count(row[T] & other[C]),
+        }
+
+    def pair_counts(self, pairwise_deletion=False):
+        '''
+        Same result as dna_dist.pair_counts() on the unpacked alignment.
+        '''
+        aln = self if pairwise_deletion else self.global_deletion()
+        n = len(self.seqids)
+        counts = {name: np.zeros((n, n), dtype=np.int64) for name in ('L', 'Nd', 'Ns1', 'Ns2')}
+        for i in range(n - 1):
+            for name, vals in aln.row_counts(i).items():
+                counts[name][i, i + 1:] = vals
+                counts[name][i + 1:, i] = vals
+        return counts
+
+    def dist_dna(self, model='K80', pairwise_deletion=False):
+        '''
+        Pairwise distance matrix, one row of counts at a time.
+        '''
+        return self.dist_and_counts(model, pairwise_deletion, keep_counts=False)[0]
+
+    def dist_and_counts(self, model='K80', pairwise_deletion=False, keep_counts=True):
+        '''
+        Return (dist_dna(), pair_counts()) from one pass over the rows; the
+        counts are None with keep_counts=False.
+        '''
+        if model not in dna_dist.NATIVE_MODELS:
+            raise ValueError('model {0} is not available in-process, use Rscript'.format(model))
+        bf = self.base_freq()
+        aln = self if pairwise_deletion else self.global_deletion()
+        n = len(self.seqids)
+        matrix = np.zeros((n, n))
+        counts = None
+        if keep_counts:
+            counts = {name: np.zeros((n, n), dtype=np.int64) for name in ('L', 'Nd', 'Ns1', 'Ns2')}
+        for i in range(n - 1):
+            row = aln.row_counts(i)
+            vals = dna_dist.model_distance(row, model=model, bf=bf)
+            matrix[i, i + 1:] = vals
+            matrix[i + 1:, i] = vals
+            if keep_counts:
+                for name, vals in row.items():
+                    counts[name][i, i + 1:] = vals
+                    counts[name][i + 1:, i] = vals
+        return matrix, counts
+
+    def iter_upper_blocks(self, model='K80', pairwise_deletion=False, block_rows=1):
+        '''
+        Yield (i0, matrix[i0:i1, i0 + 1:]) row blocks of the distance matrix
+        (see dist_engine.accumulate_blocks) without building the matrix.
+        '''
+        if model not in dna_dist.NATIVE_MODELS:
+            raise ValueError('model {0} is not available in-process, use Rscript'.format(model))
+        bf = self.base_freq()
+        aln = self if pairwise_deletion else self.global_deletion()
+        n = len(self.seqids)
+        for i0 in range(0, n, block_rows):
+            i1 = min(n, i0 + block_rows)
+            block = np.full((i1 - i0, n - i0 - 1), np.nan)
+            for i in range(i0, min(i1, n - 1)):
+                block[i - i0, i - i0:] = dna_dist.model_distance(aln.row_counts(i), model=model, bf=bf)
+            yield i0, block
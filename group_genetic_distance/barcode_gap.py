@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+'''
+Barcoding gap and nearest neighbours (`-barcode_gap` of group_dist.py).
+
+For every grouped specimen: its largest distance to a member of its own
+group (Max_intra), its smallest distance to a member of another group
+(Min_inter), that specimen and its group (the nearest neighbour), and
+Gap = Min_inter - Max_intra. For every group: the largest Max_intra and
+the smallest Min_inter of its members, the group of the nearest neighbour
+and their gap. A gap > 0 means the group does not overlap any other.
+
+Both are reduced from the row blocks of the upper triangle as they are
+read (BarcodeGap.add): a block updates its rows with reductions along its
+columns and its columns with reductions along its rows, so one pass over
+the triangle (the same pass as -engine stream and -max_memory) and O(n)
+memory suffice. NaN, infinite values and values above max_dist are not
+used; NA. is printed where a specimen or group has no such distance (a
+group of one specimen has no Max_intra). Of equal distances, the first
+one read is the nearest. Every seqid must be in one group (group_dist.py
+exits on a seqid listed under several groups).
+'''
+import numpy as np
+
+
+class BarcodeGap(object):
+
+    def __init__(self, codes=None, ngroups=0, max_dist=10):
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.ngroups = ngroups
+        self.max_dist = max_dist
+        n = len(self.codes)
+        self.max_intra = np.full(n, -np.inf)
+        self.min_inter = np.full(n, np.inf)
+        self.nearest = np.full(n, -1, dtype=np.int64)
+
+    def add(self, i0=0, block=None):
+        '''
+        Update with a row block matrix[i0:i1, i0 + 1:] of the upper triangle.
+        '''
+        n = len(self.codes)
+        i1 = i0 + block.shape[0]
+        if i1 <= i0 or block.shape[1] == 0:
+            return
+        rows = np.arange(i0, i1)
+        cols = np.arange(i0 + 1, n)
+        code_r = self.codes[i0:i1]
+        code_c = self.codes[i0 + 1:]
+        with np.errstate(invalid='ignore'):
+            valid = np.isfinite(block) & ~(block > self.max_dist)
+        valid &= (cols[None, :] > rows[:, None]) & (code_r >= 0)[:, None] & (code_c >= 0)[None, :]
+        same = code_r[:, None] == code_c[None, :]
+
+        intra = np.where(valid & same, block, -np.inf)
+        np.maximum(self.max_intra[i0:i1], intra.max(axis=1), out=self.max_intra[i0:i1])
+        np.maximum(self.max_intra[i0 + 1:], intra.max(axis=0), out=self.max_intra[i0 + 1:])
+
+        inter = np.where(valid & ~same, block, np.inf)
+        j = inter.argmin(axis=1)
+        self._nearer(rows, inter[np.arange(len(rows)), j], cols[j])
+        i = inter.argmin(axis=0)
+        self._nearer(cols, inter[i, np.arange(len(cols))], rows[i])
+
+    def _nearer(self, idx=None, vals=None, other=None):
+        better = vals < self.min_inter[idx]
+        self.min_inter[idx[better]] = vals[better]
+        self.nearest[idx[better]] = other[better]
+
+    def tap(self, blocks=None):
+        '''
+        Yield the (i0, block) row blocks after adding them.
+        '''
+        for i0, block in blocks:
+            self.add(i0, block)
+            yield i0, block
+
+    def group_results(self):
+        '''
+        (members, max_intra, min_inter, nearest_group) arrays by group code;
+        -inf, inf and -1 where there is no distance.
+        '''
+        idx = np.nonzero(self.codes >= 0)[0]
+        codes = self.codes[idx]
+        members = np.bincount(codes, minlength=self.ngroups)
+        max_intra = np.full(self.ngroups, -np.inf)
+        np.maximum.at(max_intra, codes, self.max_intra[idx])
+        min_inter = np.full(self.ngroups, np.inf)
+        np.minimum.at(min_inter, codes, self.min_inter[idx])
+        # the first member at the group minimum gives the nearest group
+        nearest_group = np.full(self.ngroups, -1, dtype=np.int64)
+        at_min = idx[np.isfinite(self.min_inter[idx]) & (self.min_inter[idx] == min_inter[codes])]
+        found, first = np.unique(self.codes[at_min], return_index=True)
+        nearest_group[found] = self.codes[self.nearest[at_min[first]]]
+        return members, max_intra, min_inter, nearest_group
+
+
+def _fmt(x=None):
+    return str(float(x)) if np.isfinite(x) else 'NA.'
+
+
+def _gap(max_intra=None, min_inter=None):
+    if np.isfinite(max_intra) and np.isfinite(min_inter):
+        return str(float(min_inter - max_intra))
+    return 'NA.'
+
+
+def print_barcode_gap(gap=None, seqids=None, groups=None, out_handle=None):
+    print('# barcode gap per specimen:', file=out_handle)
+    print('# seqid\tgroup\tMax_intra\tMin_inter\tNearest_seqid\tNearest_group\tGap', file=out_handle)
+    for i in np.nonzero(gap.codes >= 0)[0].tolist():
+        j = gap.nearest[i]
+        line = [seqids[i], groups[gap.codes[i]], _fmt(gap.max_intra[i]), _fmt(gap.min_inter[i]),
+            seqids[j] if j >= 0 else 'NA.', groups[gap.codes[j]] if j >= 0 else 'NA.',
+            _gap(gap.max_intra[i], gap.min_inter[i])]
+        print('\t'.join(line), file=out_handle)
+
+    members, max_intra, min_inter, nearest_group = gap.group_results()
+    print('# barcode gap per group:', file=out_handle)
+    print('# group\tMembers\tMax_intra\tMin_inter\tNearest_group\tGap', file=out_handle)
+    for code, group in enumerate(groups):
+        k = nearest_group[code]
+        line = [group, str(members[code]), _fmt(max_intra[code]), _fmt(min_inter[code]),
+            groups[k] if k >= 0 else 'NA.', _gap(max_intra[code], min_inter[code])]
+        print('\t'.join(line), file=out_handle)
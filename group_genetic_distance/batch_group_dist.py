@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import os
+import functools
+import dna_dist
+import multi_gene
+import dist_cache
+import dist_state
+import dist_matrix
+import supermatrix
+import timings
+from dist_stats import MEDIAN_MODES
+from group_dist import write_R_tmp_script, read_matrix, dist_groups
+from group_index import GroupIndex, read_pairs
+
+
+def get_para():
+    description = '''
+Run group_dist.py for every gene of a list and derive the within- and
+between-group distances of all genes in the same run (Steps 1, 3 and 4 of
+example/record.sh). The group definition is read once and the genes are
+processed in a pool of worker processes.
+
+For every gene <gene>.between-group.dist and <gene>.within-group.dist are
+written to `-outdir` (<gene> is the file name without its last extension),
+followed by <prefix>.within-group.dist and <prefix>.between-group.dist of
+all genes.
+
+With `-state_dir`, the partial statistics of every gene are kept there
+(see dist_state.py). A later run with a changed `-group_definition` only
+recomputes the group pairs whose members changed, and reads no matrix of
+a gene whose groups are all unchanged; the per-gene files are written as
+`-engine stream` writes them.
+
+With `-supermatrix` (and `-msa_list`), the site counts of every pair of
+sequences are also summed over the genes and `-model` is applied once to
+the sums, which gives the distances of the concatenated alignment (see
+supermatrix.py): <prefix>.supermatrix.npy (a binary matrix, see
+dist_matrix.py), <prefix>.supermatrix.within-group.dist and
+<prefix>.supermatrix.between-group.dist.
+    '''
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-msa_list', metavar='<file>', required=False,
+        help='list of msa files, one per line')
+
+    parser.add_argument('-pairwise_dist_list', metavar='<file>', required=False,
+        help='list of files of pairwise genetic distance matrix, csv or binary .npy')
+
+    parser.add_argument('-msa_format', default="fasta",
+        choices=["interleaved", "sequential", "clustal", "fasta"],
+        help='MSA format [%(default)s]')
+
+    parser.add_argument('-group_definition', metavar='<file>', required=True,
+        help='File format: seqid groupName')
+
+    parser.add_argument('-delimiter', metavar='<str>', default=r'\s+',
+        help='the delimiter between `seqid groupName` [%(default)s]')
+
+    parser.add_argument('-outdir', metavar='<dir>', default='.',
+        help='output directory [%(default)s]')
+
+    parser.add_argument('-prefix', metavar='<str>', default='all-genes',
+        help='prefix of the all-genes output files [%(default)s]')
+
+    parser.add_argument('-max_dist', metavar='<float>', type=float,
+        default=10, help="per-gene distances greater than this value will be excluded, see group_dist.py [%(default)s]")
+
+    parser.add_argument('-model', default="K80",
+        choices=["raw", "N", "TS", "TV", "JC69", "K80", "F81", "K81", "F84",
+"BH87", "T92", "TN93", "GG95", "logdet", "paralin", "indel", "indelblock"],
+        help='Evolutionary model [%(default)s]')
+
+    parser.add_argument('-pairwise_deletion', action='store_true',
+        help='delete the sites with missing data in a pairwise way, see group_dist.py [%(default)s]')
+
+    parser.add_argument('-dist_engine', default="R", choices=["R", "native"],
+        help='how to compute distances from the msa files, see group_dist.py [%(default)s]')
+
+    parser.add_argument('-cache_dir', metavar='<dir>', required=False,
+        help='cache of distance matrices computed from the msa files, see group_dist.py')
+
+    parser.add_argument('-engine', default="numpy", choices=["numpy", "stream"],
+        help='per-gene statistics engine, see group_dist.py [%(default)s]')
+
+    parser.add_argument('-median', default="exact", choices=MEDIAN_MODES,
+        help='median mode, see group_dist.py [%(default)s]')
+
+    parser.add_argument('-pairs', metavar='<file>', required=False,
+        help='only compute these between-groups pairs, see group_dist.py')
+
+    parser.add_argument('-congeneric_only', action='store_true',
+        help='only compute between-groups pairs of the same genus, see group_dist.py [%(default)s]')
+
+    parser.add_argument('-match', metavar='<str>', nargs='+', required=False,
+        help='only compute between-groups pairs matching these strings, see group_dist.py')
+
+    parser.add_argument('-supermatrix', action='store_true',
+        help='''also compute the distances of the concatenated alignment of all
+genes from the summed per-gene site counts (models: {0}); the counts come
+from the distance computation with `-dist_engine native`, are counted
+in-process otherwise, and are cached with `-cache_dir` [%(default)s]'''.format(', '.join(dna_dist.NATIVE_MODELS)))
+
+    parser.add_argument('-state_dir', metavar='<dir>', required=False,
+        help='keep per-gene partial statistics here and update them when the group definition changes')
+
+    parser.add_argument('-processes', metavar='<int>', type=int, default=1,
+        help='number of genes processed in parallel [%(default)s]')
+
+    timings.add_arguments(parser)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    args = parser.parse_args()
+
+    if bool(args.msa_list) == bool(args.pairwise_dist_list):
+        sys.exit('You must specify either `-msa_list` or `-pairwise_dist_list`!')
+
+    if args.supermatrix:
+        if not args.msa_list:
+            sys.exit('`-supermatrix` needs `-msa_list`!')
+        if args.model not in dna_dist.NATIVE_MODELS:
+            sys.exit('`-supermatrix` supports the models: ' + ', '.join(dna_dist.NATIVE_MODELS))
+
+    if args.msa_list and args.dist_engine == 'native':
+        if args.model not in dna_dist.NATIVE_MODELS:
+            sys.exit('`-dist_engine native` supports the models: ' + ', '.join(dna_dist.NATIVE_MODELS))
+
+    return args
+
+
+def gene_name(f=None):
+    return os.path.splitext(os.path.basename(f))[0]
+
+
+def group_dist_of_gene(f=None, from_msa=False, index=None,
+    outdir='.', msa_format='fasta', model='K80', pairwise_deletion=False,
+    native=False, engine='numpy', max_dist=10, median='exact', cache_dir=None,
+    pairs=None, congeneric_only=False, match=None, selected=None, site_counts=False):
+    '''
+    Write the per-gene output files of `f` and return its within- and
+    between-group partials for the all-genes statistics. pairs,
+    congeneric_only and match are the filters of group_dist.py, selected
+    the resulting pairs of the whole group definition (same-group pairs
+    included, for the all-genes between-group output).
+
+    site_counts=True: return ((within, between), counts), counts the
+    supermatrix.gene_counts() of the alignment (see read_matrix).
+    '''
+    result = read_matrix(
+        msa_file=f if from_msa else None,
+        pairwise_dist=None if from_msa else f,
+        msa_format=msa_format,
+        model=model,
+        pairwise_deletion=pairwise_deletion,
+        native=native,
+        cache_dir=cache_dir,
+        reuse_buffer=True,
+        site_counts=site_counts)
+    seqids, matrix = result[:2]
+
+    gene = gene_name(f)
+    b_o = os.path.join(outdir, gene + '.between-group.dist')
+    i_o = os.path.join(outdir, gene + '.within-group.dist')
+    with open(b_o, 'w') as b_handle, open(i_o, 'w') as i_handle:
+        dist_groups(
+            seqids=seqids,
+            matrix=matrix,
+            index=index,
+            b_handle=b_handle,
+            i_handle=i_handle,
+            engine=engine,
+            max_dist=max_dist,
+            median=median,
+            pairs=pairs,
+            congeneric_only=congeneric_only,
+            match=match)
+
+    with timings.stage('multi_within', items=len(seqids)):
+        within = multi_gene.within_matrix_partial(seqids, matrix, index, median)
+    with timings.stage('multi_between', items=len(seqids)):
+        between = multi_gene.between_matrix_partial(seqids, matrix, index, median, selected)
+    if site_counts:
+        return (within, between), result[2]
+    return within, between
+
+
+def state_of_gene(f=None, from_msa=False, index=None,
+    outdir='.', msa_format='fasta', model='K80', pairwise_deletion=False,
+    native=False, max_dist=10, median='exact', cache_dir=None, state_dir=None,
+    pairs=None, congeneric_only=False, match=None, site_counts=False):
+    '''
+    group_dist_of_gene() through the stored state of the gene: the state
+    is updated to `index` (or computed, if there is none for this matrix
+    and these settings) and saved again. The site counts are taken from
+    the matrix computation if the matrix is read, else from the cache or
+    counted.
+    '''
+    if from_msa:
+        source = dist_cache.cache_key(msa_file=f, msa_format=msa_format, model=model,
+            pairwise_deletion=pairwise_deletion, dist_engine='native' if native else 'R')
+    else:
+        source = dist_cache.file_digest(f)
+
+    counts = []
+
+    def read():
+        result = read_matrix(
+            msa_file=f if from_msa else None,
+            pairwise_dist=None if from_msa else f,
+            msa_format=msa_format,
+            model=model,
+            pairwise_deletion=pairwise_deletion,
+            native=native,
+            cache_dir=cache_dir,
+            reuse_buffer=True,
+            site_counts=site_counts)
+        counts.extend(result[2:])
+        return result[:2]
+
+    gene = gene_name(f)
+    state_f = dist_state.state_file(state_dir, gene)
+    state = dist_state.load_state(state_f)
+    if state is not None and state.matches(source, max_dist, median):
+        with timings.stage('state_update'):
+            state.update(index, read)
+    else:
+        seqids, matrix = read()
+        with timings.stage('state_compute', items=len(seqids)):
+            state = dist_state.GeneState(source, max_dist, median).compute(seqids, matrix, index)
+    state.save(state_f)
+
+    b_o = os.path.join(outdir, gene + '.between-group.dist')
+    i_o = os.path.join(outdir, gene + '.within-group.dist')
+    with open(b_o, 'w') as b_handle, open(i_o, 'w') as i_handle, timings.stage('output'):
+        state.write_gene(index, b_handle, i_handle, pairs=pairs,
+            congeneric_only=congeneric_only, match=match)
+
+    partials = state.within_partial(index), state.between_partial()
+    if site_counts:
+        if not counts:
+            counts.append(supermatrix.read_gene_counts(f, msa_format, pairwise_deletion, cache_dir))
+        return partials, counts[0]
+    return partials
+
+
+def write_supermatrix(site_counts=None, index=None, outdir='.', prefix='all-genes',
+    model='K80', engine='numpy', max_dist=10, median='exact',
+    pairs=None, congeneric_only=False, match=None):
+    '''
+    Write the distance matrix of the summed site counts and its within- and
+    between-group statistics (as group_dist.py does for one gene).
+    '''
+    with timings.stage('supermatrix', items=len(site_counts.seqids)):
+        matrix = site_counts.dist_dna(model=model)
+        base = os.path.join(outdir, prefix + '.supermatrix')
+        dist_matrix.save_matrix(base + '.npy', site_counts.seqids, matrix)
+        with open(base + '.between-group.dist', 'w') as b_handle, open(base + '.within-group.dist', 'w') as i_handle:
+            dist_groups(
+                seqids=site_counts.seqids,
+                matrix=matrix,
+                index=index,
+                b_handle=b_handle,
+                i_handle=i_handle,
+                engine=engine,
+                max_dist=max_dist,
+                median=median,
+                pairs=pairs,
+                congeneric_only=congeneric_only,
+                match=match)
+
+
+def main():
+    args = get_para()
+
+    with timings.profiled(args.profile):
+        run(args)
+
+    if args.timings:
+        timings.write(args.timings)
+
+
+def run(args=None):
+    with timings.stage('groups'):
+        index = GroupIndex.read(infile=args.group_definition, delimiter=args.delimiter)
+    pairs = read_pairs(args.pairs) if args.pairs else None
+    selected = index.select_pairs(pairs=pairs, congeneric_only=args.congeneric_only,
+        match=args.match, include_same=True)
+
+    from_msa = bool(args.msa_list)
+    files = multi_gene.read_file_list(args.msa_list if from_msa else args.pairwise_dist_list)
+    if not files:
+        sys.exit('The file list is empty!')
+
+    if from_msa and args.dist_engine == 'R':
+        # written once here, before the workers look for it
+        write_R_tmp_script(
+            msa_format=args.msa_format,
+            model=args.model,
+            pairwise_deletion=args.pairwise_deletion)
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    if args.state_dir:
+        if not os.path.exists(args.state_dir):
+            os.makedirs(args.state_dir)
+        func = functools.partial(state_of_gene,
+            from_msa=from_msa,
+            index=index,
+            outdir=args.outdir,
+            msa_format=args.msa_format,
+            model=args.model,
+            pairwise_deletion=args.pairwise_deletion,
+            native=args.dist_engine == 'native',
+            max_dist=args.max_dist,
+            median=args.median,
+            cache_dir=args.cache_dir,
+            state_dir=args.state_dir,
+            pairs=pairs,
+            congeneric_only=args.congeneric_only,
+            match=args.match,
+            site_counts=args.supermatrix)
+    else:
+        func = functools.partial(group_dist_of_gene,
+            from_msa=from_msa,
+            index=index,
+            outdir=args.outdir,
+            msa_format=args.msa_format,
+            model=args.model,
+            pairwise_deletion=args.pairwise_deletion,
+            native=args.dist_engine == 'native',
+            engine=args.engine,
+            max_dist=args.max_dist,
+            median=args.median,
+            cache_dir=args.cache_dir,
+            pairs=pairs,
+            congeneric_only=args.congeneric_only,
+            match=args.match,
+            selected=selected,
+            site_counts=args.supermatrix)
+
+    site_counts = supermatrix.SiteCounts() if args.supermatrix else None
+
+    present = within_stats = seen = between_stats = None
+    with timings.stage('genes', items=len(files)):
+        for result in multi_gene.map_genes(func, files, args.processes):
+            if site_counts is not None:
+                result, counts = result
+                site_counts.add(*counts)
+            (part_present, part_within), (part_seen, part_between) = result
+            if within_stats is None:
+                present, within_stats = part_present, part_within
+                seen, between_stats = part_seen, part_between
+                continue
+            present |= part_present
+            within_stats.merge(part_within)
+            seen |= part_seen
+            between_stats.merge(part_between)
+
+    with timings.stage('output', items=len(index)):
+        with open(os.path.join(args.outdir, args.prefix + '.within-group.dist'), 'w') as fhout:
+            multi_gene.print_within(groups=index.groups, present=present, stats=within_stats, out_handle=fhout)
+
+        with open(os.path.join(args.outdir, args.prefix + '.between-group.dist'), 'w') as fhout:
+            multi_gene.print_between(groups=index.groups, seen=seen, stats=between_stats, out_handle=fhout, pairs=selected)
+
+    if site_counts is not None:
+        write_supermatrix(
+            site_counts=site_counts,
+            index=index,
+            outdir=args.outdir,
+            prefix=args.prefix,
+            model=args.model,
+            engine=args.engine,
+            max_dist=args.max_dist,
+            median=args.median,
+            pairs=pairs,
+            congeneric_only=args.congeneric_only,
+            match=args.match)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
-import re
-from mglcmdtools import csv2dict,csv2tupe
-import statistics
 import argparse
 import sys
 import subprocess
 import os
-import numpy as np
+import functools
+from dist_stats import MEDIAN_MODES
+import multi_gene
+import dist_output
+import group_matrix
+import timings
+from aggregate_store import AggregateStore
+from group_index import GroupIndex, read_pairs
 
 
 def get_para():
@@ -22,7 +26,7 @@ can be greater than 1.
     parser = argparse.ArgumentParser(description=description)
 
     parser.add_argument('-pairwise_dist_list', metavar='<file>', required=True,
-        help='list of files of pairwise genetic distance matrix')
+        help='list of files of pairwise genetic distance matrix, csv or binary .npy')
 
     parser.add_argument('-group_definition', metavar='<file>', required=True,
         help='File format: seqid groupName')
@@ -33,80 +37,188 @@ can be greater than 1.
     parser.add_argument('-i_o', metavar='<file>', type=argparse.FileType('w'),
         default=sys.stdout, help='between-group distance output')
 
-    if len(sys.argv) == 1:
-        parser.print_help()
-        sys.exit()
+    parser.add_argument('-median', default="exact", choices=MEDIAN_MODES,
+        help='''exact: keep all values; approx: quantile sketch with 1%% relative
+error, memory bounded by the number of group pairs; none: do not compute
+medians (printed as NA.). [%(default)s]''')
 
-    args = parser.parse_args()
+    parser.add_argument('-weighting', default="pooled", choices=multi_gene.WEIGHTINGS,
+        help='''pooled: the statistics of the distances of all genes together, a
+gene weighs as much as it has distances of a group pair; gene: every gene
+weighs the same in the mean, median and std of a group pair; length: every
+gene weighs its alignment length (-gene_lengths). With gene and length,
+every gene is reduced to its per-pair statistics before it is weighed, see
+dist_stats.WeightedStats [%(default)s]''')
 
-    return args
+    parser.add_argument('-gene_lengths', metavar='<file>', required=False,
+        help='''alignment lengths for `-weighting length`, File format: matrix_file
+length, the files as in `-pairwise_dist_list`''')
 
+    parser.add_argument('-pairs', metavar='<file>', required=False,
+        help='only compute these group pairs (two group names per line)')
 
-def get_seqid_group(infile=None, delimiter=r'\s+'):
-    seqid_group = {}
-    group_seqid = {}
-    with open(infile, 'r') as fh:
-        for i in fh:
-            i = i.strip()
-            seqid, group = re.split(delimiter, i, maxsplit=1)
-            seqid_group[seqid] = group
-            if group not in group_seqid:
-                group_seqid.setdefault(group, [])
-            group_seqid[group].append(seqid)
+    parser.add_argument('-congeneric_only', action='store_true',
+        help='''only compute pairs of groups of the same genus (group names as
+Genus_species, see get_congenic_stat.py) [%(default)s]''')
 
-    return seqid_group, group_seqid
+    parser.add_argument('-match', metavar='<str>', nargs='+', required=False,
+        help='''only compute pairs whose two group names both contain one of these
+strings (see pick_lines_with_specified_element_only.py)''')
 
+    parser.add_argument('-store', metavar='<dir>', required=False,
+        help='''keep the per-gene partials and the all-genes aggregate here; a later
+run only reads the genes added to (or changed in) the list, genes removed from
+the list are dropped from the aggregate''')
 
-def stat_dist(vals=None):
-    # one val corresponds to two members.
-    if len(vals) <= 0:
-        return 'NA.', 'NA.', 'NA.', 'NA.', 'NA.', 'NA.'
+    parser.add_argument('-processes', metavar='<int>', type=int, default=1,
+        help='number of processes to parse and reduce genes in parallel [%(default)s]')
 
-    return len(vals), min(vals), max(vals), statistics.mean(vals), statistics.median(vals), statistics.stdev(vals)
+    parser.add_argument('-out_format', default="text", choices=dist_output.OUT_FORMATS,
+        help='''text: tab-separated lines; npz, parquet (needs pyarrow) or hdf5 (needs
+h5py): typed columns written to the `-i_o` file, see dist_output.py [%(default)s]''')
 
+    group_matrix.add_arguments(parser)
 
+    timings.add_arguments(parser)
 
-def distStat_of_all_genes_of_diff_group(pairwise_dist_list=None, seqid_group=None, out_handle=None):
-    group1_group2_seq1Seq2Dist = {}
-    with open(pairwise_dist_list, 'r') as fh:
-        for f in fh:
-            f = f.strip()
-            triu_tupe, tril_tupe = csv2tupe(f, header=0)
-            for a in triu_tupe:
-                k1, k2, val = a
-                g1 = seqid_group[k1]
-                g2 = seqid_group[k2]
-                if str(val) == 'inf':
-                    val = np.nan
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
 
-                if k1 not in group1_group2_seq1Seq2Dist:
-                    group1_group2_seq1Seq2Dist.setdefault(g1, {})
-                if k2 not in group1_group2_seq1Seq2Dist[g1]:
-                    group1_group2_seq1Seq2Dist[g1].setdefault(g2, [])
+    args = parser.parse_args()
 
-                group1_group2_seq1Seq2Dist[g1][g2].append(val)
+    if args.weighting == 'length' and not args.gene_lengths:
+        sys.exit('`-weighting length` needs `-gene_lengths`!')
 
-    for g1 in sorted(group1_group2_seq1Seq2Dist.keys()):
-        for g2 in sorted(group1_group2_seq1Seq2Dist[g1].keys()):
-            vals = group1_group2_seq1Seq2Dist[g1][g2]
-            vals_clean = [x for x in vals if str(x) != 'nan']
-            line = [str(i) for i in stat_dist(vals_clean)]
-            print(g1, g2, '\t'.join(line), sep='\t', file=out_handle)
+    if args.out_format != 'text':
+        if args.i_o is sys.stdout:
+            sys.exit('`-out_format {0}` needs an `-i_o` file!'.format(args.out_format))
+        message = dist_output.missing_dependency(args.out_format)
+        if message:
+            sys.exit(message)
 
-def main():
+    return args
 
-    f_dir = os.getcwd()
 
+def distStat_of_all_genes_of_diff_group(pairwise_dist_list=None, index=None, out_handle=None, median='exact', processes=1, pairs=None, store=None, out_format='text', matrix_prefix=None, matrix_stats=group_matrix.MATRIX_STATS, matrix_order='input', weighting='pooled', gene_lengths=None):
+    '''
+    Group pairs are ordered as (group of row seqid, group of column seqid)
+    of the upper triangle. Each gene is reduced into per-pair running
+    statistics right away; the distance values themselves are only kept
+    for median='exact'. Infinite distances are skipped.
+
+    store: directory of an AggregateStore, see aggregate_store.py; it
+    keeps all group pairs, `pairs` only selects the printed ones.
+    out_format: see dist_output.py; the typed output is written to the
+    file of out_handle, its mean matrix is not symmetric.
+    matrix_prefix: also write the G x G matrices of group_matrix.py, from
+    the statistics of (a, b) and (b, a) merged.
+    weighting: see multi_gene.WEIGHTINGS; gene_lengths: the file of
+    multi_gene.read_gene_lengths() for weighting='length'.
+    '''
+    files = multi_gene.read_file_list(pairwise_dist_list)
+    folded = None
+    if weighting != 'pooled':
+        lengths = None
+        if weighting == 'length':
+            try:
+                lengths = multi_gene.read_gene_lengths(gene_lengths)
+            except ValueError as e:
+                sys.exit(str(e))
+        try:
+            weights = multi_gene.gene_weights(files, weighting, lengths)
+        except ValueError as e:
+            sys.exit('{0}: {1} of {2}'.format(gene_lengths, e, pairwise_dist_list))
+    if store:
+        func = functools.partial(multi_gene.between_gene_partial, index=index, median=median)
+        aggregate = AggregateStore(store, 'between', index, median)
+        seen, stats = aggregate.update(files, func, processes)
+        if weighting != 'pooled':
+            with timings.stage('merge', items=len(files)):
+                fold_groups = len(index) if matrix_prefix else 0
+                seen, stats, folded = multi_gene.weigh_partials(
+                    aggregate.weighed_partials(files, fold_groups, processes), weights,
+                    len(index) ** 2, median, fold_groups)
+        elif stats is None:
+            seen, stats = multi_gene.between_all_genes([], index, median)
+    elif weighting != 'pooled':
+        seen, stats, folded = multi_gene.between_all_genes_weighted(
+            files=files,
+            weights=weights,
+            index=index,
+            median=median,
+            processes=processes,
+            pairs=pairs,
+            fold=bool(matrix_prefix))
+    else:
+        seen, stats = multi_gene.between_all_genes(
+            files=files,
+            index=index,
+            median=median,
+            processes=processes,
+            pairs=pairs)
+
+    with timings.stage('output', items=len(index) ** 2):
+        if out_format != 'text':
+            table = dist_output.GroupTable(index.groups, pairs=True, symmetric=False)
+            multi_gene.print_between(groups=index.groups, seen=seen, stats=stats, pairs=pairs, table=table)
+            out_handle.close()
+            dist_output.write_table(out_handle.name, out_format, table)
+        else:
+            multi_gene.print_between(
+                groups=index.groups,
+                seen=seen,
+                stats=stats,
+                out_handle=out_handle,
+                pairs=pairs)
+
+    if matrix_prefix:
+        with timings.stage('matrices', items=len(index)):
+            if folded is None:
+                seen, stats = multi_gene.fold_pairs(seen, stats, len(index))
+            else:
+                seen, stats = folded
+            table = dist_output.GroupTable(index.groups, pairs=True)
+            multi_gene.print_between(groups=index.groups, seen=seen, stats=stats, pairs=pairs, table=table)
+            group_matrix.write_matrices(matrix_prefix, table, stats=matrix_stats, order=matrix_order)
+
+def main():
     args = get_para()
 
-    seqid_group, group_seqid = get_seqid_group(
-        infile=args.group_definition,
-        delimiter=args.delimiter)
+    with timings.profiled(args.profile):
+        run(args)
+
+    if args.timings:
+        timings.write(args.timings)
+
+
+def run(args=None):
+
+    f_dir = os.getcwd()
+
+    with timings.stage('groups'):
+        index = GroupIndex.read(
+            infile=args.group_definition,
+            delimiter=args.delimiter)
 
     distStat_of_all_genes_of_diff_group(
         pairwise_dist_list=args.pairwise_dist_list,
-        seqid_group=seqid_group,
-        out_handle=args.i_o)
+        index=index,
+        out_handle=args.i_o,
+        median=args.median,
+        processes=args.processes,
+        store=args.store,
+        out_format=args.out_format,
+        matrix_prefix=args.matrix_prefix,
+        matrix_stats=args.matrix_stats,
+        matrix_order=args.matrix_order,
+        weighting=args.weighting,
+        gene_lengths=args.gene_lengths,
+        pairs=index.select_pairs(
+            pairs=read_pairs(args.pairs) if args.pairs else None,
+            congeneric_only=args.congeneric_only,
+            match=args.match,
+            include_same=True))
 
 
 
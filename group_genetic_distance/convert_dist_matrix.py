@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import os
+import functools
+import numpy as np
+import dist_csv
+import dist_matrix
+import multi_gene
+import timings
+
+
+def get_para():
+    description = '''
+Convert pairwise genetic distance matrices (csv files of R ape
+`dist.dna(a, as.matrix = TRUE)`) to the binary format read directly by
+group_dist.py, batch_group_dist.py and the multi-gene scripts:
+<name>.npy (condensed upper triangle, memory-mapped when read) and
+<name>.npy.seqids, where <name> is the csv file name without `.csv`.
+
+The names of the written .npy files are printed, one per line, so the
+output can be used as a new `-pairwise_dist_list`.
+    '''
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-pairwise_dist', metavar='<file>', required=False,
+        help='file of pairwise genetic distance matrix')
+
+    parser.add_argument('-pairwise_dist_list', metavar='<file>', required=False,
+        help='list of files of pairwise genetic distance matrix')
+
+    parser.add_argument('-outdir', metavar='<dir>', default='.',
+        help='output directory [%(default)s]')
+
+    parser.add_argument('-dtype', default="float64", choices=["float64", "float32"],
+        help='float32 halves the file size, the distances are rounded to 7 significant digits [%(default)s]')
+
+    parser.add_argument('-processes', metavar='<int>', type=int, default=1,
+        help='number of files converted in parallel [%(default)s]')
+
+    timings.add_arguments(parser)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
+
+    args = parser.parse_args()
+
+    if bool(args.pairwise_dist) == bool(args.pairwise_dist_list):
+        sys.exit('You must specify either `-pairwise_dist` or `-pairwise_dist_list`!')
+
+    return args
+
+
+def convert(f=None, outdir='.', dtype='float64'):
+    name = os.path.basename(f)
+    if name.endswith('.csv'):
+        name = name[:-4]
+    out = os.path.join(outdir, name + '.npy')
+
+    with timings.stage('parse'):
+        try:
+            seqids, matrix = dist_csv.read_dist_csv(f, reuse_buffer=True)
+        except ValueError as e:
+            sys.exit(str(e))
+    with timings.stage('write', items=len(seqids)):
+        dist_matrix.save_matrix(out, seqids, matrix, dtype=np.dtype(dtype))
+    return out
+
+
+def main():
+    args = get_para()
+
+    with timings.profiled(args.profile):
+        run(args)
+
+    if args.timings:
+        timings.write(args.timings)
+
+
+def run(args=None):
+    if args.pairwise_dist:
+        files = [args.pairwise_dist]
+    else:
+        files = multi_gene.read_file_list(args.pairwise_dist_list)
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    func = functools.partial(convert, outdir=args.outdir, dtype=args.dtype)
+    with timings.stage('genes', items=len(files)):
+        for out in multi_gene.map_genes(func, files, args.processes):
+            print(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+'''
+On-disk cache of distance matrices computed from alignments.
+
+An entry is keyed by the SHA-256 of the alignment bytes and of every
+setting that changes the distances (format, model, pairwise deletion and
+distance engine), and stored in the binary format of dist_matrix.py as
+<cache_dir>/<key>.npy and <key>.npy.seqids. Entries are written to a
+temporary name and renamed, so concurrent runs never see a partial one.
+
+The site counts of the alignment pairs and its base counts (supermatrix.py)
+do not depend on the model or the distance engine; they are keyed by the
+alignment, its format and pairwise deletion only (counts_key) and stored
+as <cache_dir>/<key>.counts.npz: the seqids, the condensed upper triangle
+of every count (see dist_matrix.py) and the base counts.
+'''
+import os
+import hashlib
+import numpy as np
+
+import dist_matrix
+
+# bump when the stored matrices would change for the same inputs
+CACHE_VERSION = '1'
+
+
+def file_digest(f=None, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(f, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(msa_file=None, msa_format='fasta', model='K80', pairwise_deletion=False, dist_engine='R'):
+    h = hashlib.sha256()
+    settings = [CACHE_VERSION, file_digest(msa_file), msa_format, model,
+        str(bool(pairwise_deletion)), dist_engine]
+    h.update('\t'.join(settings).encode('utf-8'))
+    return h.hexdigest()
+
+
+def cache_file(cache_dir=None, key=None):
+    return os.path.join(cache_dir, key + '.npy')
+
+
+def load(cache_dir=None, key=None):
+    '''
+    Return (seqids, CondensedMatrix) of a cached matrix, or None.
+    '''
+    f = cache_file(cache_dir, key)
+    if not os.path.exists(f):
+        return None
+    return dist_matrix.load_matrix(f)
+
+
+def store(cache_dir=None, key=None, seqids=None, matrix=None):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    f = cache_file(cache_dir, key)
+    tmp = '{0}.{1}.tmp.npy'.format(f[:-4], os.getpid())
+    dist_matrix.save_matrix(tmp, seqids, matrix)
+    # the .npy is renamed last: load() only looks for it
+    os.replace(tmp + dist_matrix.SEQIDS_SUFFIX, f + dist_matrix.SEQIDS_SUFFIX)
+    os.replace(tmp, f)
+    return f
+
+
+def counts_key(msa_file=None, msa_format='fasta', pairwise_deletion=False):
+    h = hashlib.sha256()
+    settings = [CACHE_VERSION, file_digest(msa_file), msa_format,
+        str(bool(pairwise_deletion)), 'counts']
+    h.update('\t'.join(settings).encode('utf-8'))
+    return h.hexdigest()
+
+
+def counts_file(cache_dir=None, key=None):
+    return os.path.join(cache_dir, key + '.counts.npz')
+
+
+def load_counts(cache_dir=None, key=None):
+    '''
+    Return (seqids, {count: n x n array}, base counts) of cached site
+    counts, or None.
+    '''
+    f = counts_file(cache_dir, key)
+    if not os.path.exists(f):
+        return None
+    with np.load(f) as data:
+        seqids = data['seqids'].tolist()
+        n = len(seqids)
+        upper = np.triu_indices(n, k=1)
+        counts = {}
+        for name in data.files:
+            if name in ('seqids', 'bases'):
+                continue
+            square = np.zeros((n, n), dtype=np.int64)
+            square[upper] = data[name]
+            counts[name] = square + square.T
+        return seqids, counts, data['bases'].astype(np.int64)
+
+
+def store_counts(cache_dir=None, key=None, seqids=None, counts=None, bases=None):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    f = counts_file(cache_dir, key)
+    tmp = '{0}.{1}.tmp.npz'.format(f[:-4], os.getpid())
+    upper = np.triu_indices(len(seqids), k=1)
+    arrays = {name: np.asarray(square)[upper] for name, square in counts.items()}
+    np.savez(tmp, seqids=np.array(seqids, dtype=str), bases=np.asarray(bases), **arrays)
+    os.replace(tmp, f)
+    return f
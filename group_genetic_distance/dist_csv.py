@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+'''
+Reader of the square csv matrices written by R `write.csv(dist.dna(...,
+as.matrix = TRUE))`.
+
+The file is parsed straight into a float64 (n, n) array plus the seqid
+list, in file order: the values of a chunk of rows are joined and parsed
+in one np.fromstring() call (`NA` is NaN, `Inf`/`-Inf`/`NaN` as written
+by R). Symmetry is checked chunk by chunk against the rows already read,
+so the file is read once. The diagonal is set to NaN, as csv2dict drops
+it.
+
+np.fromstring() rounds every value correctly; the pandas parser behind
+csv2dict (-engine dict of group_dist.py) does not always, so values with
+16-17 significant digits may differ in the last bit from it, and the
+statistics then in the last printed digit. With up to 15 significant digits
+both read the same floats.
+
+read_blocks() parses the file row block by row block for the chunked
+(-max_memory) mode instead.
+
+A DistCsvReader keeps its array between files; with reuse_buffer=True the
+process-wide reader is used, so a batch of genes allocates the matrix only
+when a larger one comes. The returned matrix is then only valid until the
+next read.
+'''
+import csv
+import re
+import numpy as np
+
+
+# matrix cells parsed per np.fromstring() call
+CHUNK_CELLS = 1 << 20
+
+_QUOTED_LABEL = re.compile(r'"((?:[^"]|"")*)",?')
+
+
+def _split_label(line=''):
+    '''
+    Return (row label, rest of the line).
+    '''
+    m = _QUOTED_LABEL.match(line)
+    if m:
+        return m.group(1).replace('""', '"'), line[m.end():]
+    label, _, rest = line.partition(',')
+    return label, rest
+
+
+def _parse_rows(f=None, rows=None, n=0, i0=0):
+    '''
+    (len(rows), n) array of the value parts of rows i0.. of the file.
+    '''
+    i1 = i0 + len(rows)
+    if i1 > n:
+        raise ValueError('{0}: more rows than columns'.format(f))
+    text = ','.join(row.strip() for row in rows).replace('NA', 'nan')
+    vals = np.fromstring(text, sep=',') if text else np.empty(0)
+    if vals.size != len(rows) * n:
+        raise ValueError('{0}: rows {1}-{2} do not have {3} numeric values each'.format(f, i0 + 1, i1, n))
+    return vals.reshape(len(rows), n)
+
+
+def _read_header(fh=None):
+    header = next(csv.reader([fh.readline()]))
+    return header[1:]
+
+
+class DistCsvReader(object):
+
+    def __init__(self):
+        self.buffer = np.empty(0)
+
+    def _matrix(self, n=0):
+        if self.buffer.size < n * n:
+            self.buffer = np.empty(n * n)
+        return self.buffer[:n * n].reshape(n, n)
+
+    def _parse(self, f=None, rows=None, matrix=None, i0=0):
+        i1 = i0 + len(rows)
+        matrix[i0:i1] = _parse_rows(f, rows, matrix.shape[1], i0)
+
+        a = matrix[i0:i1, :i1]
+        b = matrix[:i1, i0:i1].T
+        bad = ~((a == b) | (np.isnan(a) & np.isnan(b)))
+        if np.any(bad):
+            r, c = np.argwhere(bad)[0]
+            raise ValueError('{0}: matrix is not symmetric at row {1}, column {2}'.format(f, i0 + r + 1, c + 1))
+
+    def read(self, f=None):
+        '''
+        Return (seqids, matrix) of the csv file `f`.
+        '''
+        with open(f, 'r') as fh:
+            seqids = _read_header(fh)
+            n = len(seqids)
+            matrix = self._matrix(n)
+            chunk_rows = max(1, CHUNK_CELLS // max(n, 1))
+
+            row_seqids = []
+            rows = []
+            i = 0
+            for line in fh:
+                if not line.strip():
+                    continue
+                label, rest = _split_label(line)
+                row_seqids.append(label)
+                rows.append(rest)
+                if len(rows) == chunk_rows:
+                    self._parse(f, rows, matrix, i)
+                    i += len(rows)
+                    rows = []
+            if rows:
+                self._parse(f, rows, matrix, i)
+
+        if row_seqids != seqids:
+            raise ValueError('{0}: row names are not the column names'.format(f))
+        np.fill_diagonal(matrix, np.nan)
+        return seqids, matrix
+
+
+_READER = DistCsvReader()
+
+
+def read_dist_csv(f=None, reuse_buffer=False):
+    reader = _READER if reuse_buffer else DistCsvReader()
+    return reader.read(f)
+
+
+def read_blocks(f=None, block_rows=None):
+    '''
+    Return (seqids, blocks) of the csv file `f` without reading it whole:
+    blocks yields (i0, block) for consecutive row blocks, block being
+    matrix[i0:i1, i0 + 1:] as dist_engine.upper_rows() gives it. The rows
+    are parsed as they are consumed, so only one block is in memory.
+    Symmetry is not checked, the distances are taken from the upper
+    triangle.
+
+    block_rows: number of rows per block, or a function of n returning it.
+    '''
+    fh = open(f, 'r')
+    seqids = _read_header(fh)
+    n = len(seqids)
+    if callable(block_rows):
+        block_rows = block_rows(n)
+    if block_rows is None:
+        block_rows = max(1, CHUNK_CELLS // max(n, 1))
+
+    def blocks():
+        with fh:
+            rows = []
+            i = 0
+            for line in fh:
+                if not line.strip():
+                    continue
+                label, rest = _split_label(line)
+                if i + len(rows) >= n or label != seqids[i + len(rows)]:
+                    raise ValueError('{0}: row names are not the column names'.format(f))
+                rows.append(rest)
+                if len(rows) == block_rows:
+                    yield i, _parse_rows(f, rows, n, i)[:, i + 1:]
+                    i += len(rows)
+                    rows = []
+            if rows:
+                yield i, _parse_rows(f, rows, n, i)[:, i + 1:]
+                i += len(rows)
+            if i != n:
+                raise ValueError('{0}: row names are not the column names'.format(f))
+
+    return seqids, blocks()
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+'''
+NumPy engine for within- and between-group distance statistics.
+
+The pairwise distance matrix is held as a dense float64 array indexed by
+integer seqid positions, and the members of every group are looked up once
+(group_index.GroupIndex). Group blocks are then pulled out with fancy
+indexing instead of scanning the whole matrix for each group and each
+group pair.
+
+The printed text is identical to the dict-based functions in group_dist.py.
+
+`accumulate_triu` is the single-pass alternative: it streams the upper
+triangle once, row block by row block, and sends every distance to its
+(group1, group2) bucket of a BucketStats accumulator. Its cost does not
+depend on the number of groups. A seqid listed under several groups sends
+its distances to the buckets of all of them (expand_pairs).
+
+Every function also accepts a memory-mapped dist_matrix.CondensedMatrix in
+place of the dense array; see sub_matrix() and upper_rows().
+'''
+import numpy as np
+
+from dist_stats import stat_dist, BucketStats
+
+# matrix cells handled per row block by accumulate_triu
+BLOCK_CELLS = 1 << 22
+
+# peak bytes per matrix cell of a row block in accumulate_blocks (the block
+# itself, its masks, indices and values), used to size blocks by -max_memory
+BLOCK_BYTES_PER_CELL = 256
+
+
+def matrix_from_dict(mdict=None):
+    '''
+    Convert a `csv2dict` dictionary into (seqids, matrix).
+
+    Both the symmetric (all_key_to_all=True) and the upper-triangle-only
+    dictionaries are accepted. Pairs missing from the dictionary (NA in the
+    csv file) and the diagonal are NaN.
+    '''
+    seqids = list(mdict.keys())
+    seen = set(seqids)
+    for key1 in mdict:
+        for key2 in mdict[key1]:
+            if key2 not in seen:
+                seen.add(key2)
+                seqids.append(key2)
+
+    index = {seqid: i for i, seqid in enumerate(seqids)}
+    matrix = np.full((len(seqids), len(seqids)), np.nan)
+    for key1 in mdict:
+        i = index[key1]
+        for key2, val in mdict[key1].items():
+            j = index[key2]
+            matrix[i, j] = val
+            matrix[j, i] = val
+
+    return seqids, matrix
+
+
+def sub_matrix(matrix=None, idx1=None, idx2=None):
+    '''
+    matrix[np.ix_(idx1, idx2)] of a dense or a condensed matrix.
+    '''
+    if isinstance(matrix, np.ndarray):
+        return matrix[np.ix_(idx1, idx2)]
+    return matrix.block(idx1, idx2)
+
+
+def upper_rows(matrix=None, i0=0, i1=0):
+    '''
+    matrix[i0:i1, i0 + 1:] of a dense or a condensed matrix; only the cells
+    right of the diagonal are meaningful.
+    '''
+    if isinstance(matrix, np.ndarray):
+        return matrix[i0:i1, i0 + 1:]
+    return matrix.upper_rows(i0, i1)
+
+
+def rows_with_upper_values(matrix=None):
+    '''
+    Bool array: row i has a non-NaN value right of the diagonal.
+    '''
+    n = matrix.shape[0]
+    found = np.zeros(n, dtype=bool)
+    block_rows = max(1, BLOCK_CELLS // max(n, 1))
+    for i0 in range(0, n, block_rows):
+        i1 = min(n, i0 + block_rows)
+        block = upper_rows(matrix, i0, i1)
+        upper = np.arange(i0 + 1, n)[None, :] > np.arange(i0, i1)[:, None]
+        found[i0:i1] = np.any(upper & ~np.isnan(block), axis=1)
+    return found
+
+
+def _clean(vals=None, max_dist=10):
+    '''
+    Drop NaN (absent pairs), infinite values and values above max_dist.
+    '''
+    return vals[np.isfinite(vals) & ~(vals > max_dist)]
+
+
+def _print_excluded(sub=None, mask=None, max_dist=10):
+    excluded = sub[mask & (sub > max_dist) & ~np.isinf(sub)]
+    for x in excluded.tolist():
+        print("excluding", x)
+
+
+def within_group_stats(matrix=None, members=None, groups=None, max_dist=10, median='exact'):
+    '''
+    Yield (group, count, stats) for every group, in the order of `groups`;
+    members[code] are the sorted matrix indices of a group (see
+    GroupIndex.members), count the number of distances used.
+    '''
+    for code, group in enumerate(groups):
+        idx = members[code]
+        sub = sub_matrix(matrix, idx, idx)
+        if np.any(sub > max_dist):
+            _print_excluded(sub, np.isfinite(sub), max_dist)
+        vals = _clean(sub[np.triu_indices(len(idx), k=1)], max_dist)
+        yield group, len(vals), stat_dist(vals, weight=2, median=median)
+
+
+def all_pairs(ngroups=0):
+    for code1 in range(ngroups):
+        for code2 in range(code1 + 1, ngroups):
+            yield code1, code2
+
+
+def between_groups_stats(matrix=None, members=None, groups=None, max_dist=10, median='exact', pairs=None):
+    '''
+    Yield (code1, code2, count, stats) for every unordered pair of groups,
+    or only for the (code1, code2) `pairs` (see GroupIndex.select_pairs).
+    '''
+    if pairs is None:
+        pairs = all_pairs(len(groups))
+    for code1, code2 in pairs:
+        idx1, idx2 = members[code1], members[code2]
+        vals = sub_matrix(matrix, idx1, idx2).ravel()
+        if np.any(vals > max_dist):
+            # report excluded values in the same order as the dict scan
+            idx = np.union1d(idx1, idx2)
+            in1 = np.isin(idx, idx1)
+            in2 = np.isin(idx, idx2)
+            cross = (in1[:, None] & in2[None, :]) | (in2[:, None] & in1[None, :])
+            _print_excluded(sub_matrix(matrix, idx, idx), cross, max_dist)
+        vals = _clean(vals, max_dist)
+        yield code1, code2, len(vals), stat_dist(vals, weight=2, median=median)
+
+
+def dist_within_group(matrix=None, members=None, groups=None, out_handle=None, max_dist=10, median='exact', table=None):
+    '''
+    The rows are printed to out_handle, if given, and added to the
+    dist_output.GroupTable `table`, if given.
+    '''
+    if out_handle is not None:
+        print('# within-group distances:', file=out_handle)
+        print('# group\tMinimum\tMaximum\tAverage\tMedian\tSample_std', file=out_handle)
+    for code, (group, count, stats) in enumerate(within_group_stats(matrix, members, groups, max_dist, median)):
+        if table is not None:
+            table.add(code, count, stats)
+        if out_handle is None:
+            continue
+        line = [str(i) for i in stats]
+        print(group, '\t'.join(line), sep='\t', file=out_handle)
+
+
+def dist_between_groups(matrix=None, members=None, groups=None, out_handle=None, max_dist=10, median='exact', pairs=None, table=None):
+    '''
+    As dist_within_group(), for the group pairs.
+    '''
+    if out_handle is not None:
+        print('# between-groups distances:', file=out_handle)
+        print('# group1\tgroup2\tMinimum\tMaximum\tAverage\tMedian\tSample_std', file=out_handle)
+    for code1, code2, count, stats in between_groups_stats(matrix, members, groups, max_dist, median, pairs):
+        if table is not None:
+            table.add(code1, count, stats, code2)
+        if out_handle is None:
+            continue
+        line = [str(i) for i in stats]
+        print(groups[code1], groups[code2], '\t'.join(line), sep='\t', file=out_handle)
+
+
+def pair_buckets(code1=None, code2=None, ngroups=0, ordered=False):
+    '''
+    Bucket number of each (code1, code2) group pair.
+
+    ordered=False puts (a, b) and (b, a) into the same bucket, min(a, b) first.
+    '''
+    if not ordered:
+        code1, code2 = np.minimum(code1, code2), np.maximum(code1, code2)
+    return code1 * ngroups + code2
+
+
+def block_rows_for(n=0, max_cells=BLOCK_CELLS):
+    return max(1, max_cells // max(n, 1))
+
+
+def iter_upper_blocks(matrix=None, block_rows=None):
+    '''
+    Yield (i0, matrix[i0:i1, i0 + 1:]) for consecutive row blocks.
+    '''
+    n = matrix.shape[0]
+    if block_rows is None:
+        block_rows = block_rows_for(n)
+    for i0 in range(0, n, block_rows):
+        i1 = min(n, i0 + block_rows)
+        yield i0, upper_rows(matrix, i0, i1)
+
+
+def expand_pairs(i=None, j=None, vals=None, codes=None, multi=None):
+    '''
+    Return (code_i, code_j, vals) of the pairs (i, j) of matrix indices:
+    their group codes and values, one entry for every (group of i, group
+    of j) when a seqid is in several groups. multi: GroupIndex.multi_codes()
+    of the matrix seqids, or None.
+    '''
+    if multi is None:
+        return codes[i], codes[j], vals
+    offsets, all_codes = multi
+    ncodes = np.diff(offsets)
+    several = ncodes[i] * ncodes[j] > 1
+    if not np.any(several):
+        return codes[i], codes[j], vals
+    i_s, j_s, vals_s = i[several], j[several], vals[several]
+    ni, nj = ncodes[i_s], ncodes[j_s]
+    total = ni * nj
+    pair = np.repeat(np.arange(len(i_s)), total)
+    k = np.arange(len(pair)) - np.repeat(np.cumsum(total) - total, total)
+    code_i = all_codes[offsets[i_s][pair] + k // nj[pair]]
+    code_j = all_codes[offsets[j_s][pair] + k % nj[pair]]
+    single = ~several
+    return (np.concatenate((codes[i[single]], code_i)),
+        np.concatenate((codes[j[single]], code_j)),
+        np.concatenate((vals[single], vals_s[pair])))
+
+
+def accumulate_triu(matrix=None, codes=None, ngroups=0, stats=None,
+    ordered=False, max_dist=None, verbose_exclude=False, median='exact',
+    within_only=False, seen=None, excluded=None, buckets=None, multi=None):
+    '''
+    Stream the upper triangle of the matrix once into a BucketStats.
+
+    codes: group code of every row (GroupIndex.codes), multi: the
+    GroupIndex.multi_codes() of the rows (see expand_pairs), if any seqid
+    is in several groups. Rows and columns with code -1 are skipped, as are NaN and infinite values and, when
+    max_dist is given, values above it. Returns the BucketStats (ngroups *
+    ngroups buckets, see pair_buckets; with within_only=True only
+    same-group pairs are kept, bucket = group code). If a bool array `seen`
+    is given, the buckets with any non-NaN value (infinite and excluded
+    ones included) are set to True in it. The finite values above max_dist
+    go to the BucketStats `excluded`, if given. With a bool array
+    `buckets`, only the values of the buckets set in it are taken (and
+    reported as excluded).
+    '''
+    return accumulate_blocks(iter_upper_blocks(matrix), codes, ngroups, stats,
+        ordered, max_dist, verbose_exclude, median, within_only, seen, excluded, buckets, multi)
+
+
+def _accumulate_values(code_r=None, code_c=None, vals=None, ngroups=0, stats=None,
+    ordered=False, max_dist=None, verbose_exclude=False, within_only=False,
+    seen=None, excluded=None, selected=None):
+    '''
+    Add the values of pairs (row group code_r, column group code_c).
+    '''
+    if within_only:
+        same = code_r == code_c
+        code_r, vals = code_r[same], vals[same]
+        buckets = code_r
+    else:
+        buckets = pair_buckets(code_r, code_c, ngroups, ordered)
+    if selected is not None:
+        take = selected[buckets]
+        buckets, vals = buckets[take], vals[take]
+    if seen is not None:
+        seen[buckets[~np.isnan(vals)]] = True
+    keep = np.isfinite(vals)
+    if max_dist is not None:
+        over = vals > max_dist
+        if verbose_exclude:
+            for x in vals[over & keep].tolist():
+                print("excluding", x)
+        if excluded is not None:
+            excluded.add(buckets[over & keep], vals[over & keep])
+        keep &= ~over
+    stats.add(buckets[keep], vals[keep])
+
+
+def accumulate_blocks(blocks=None, codes=None, ngroups=0, stats=None,
+    ordered=False, max_dist=None, verbose_exclude=False, median='exact',
+    within_only=False, seen=None, excluded=None, buckets=None, multi=None):
+    '''
+    accumulate_triu() over the (i0, matrix[i0:i1, i0 + 1:]) row blocks of
+    any source (iter_upper_blocks, dist_csv.read_blocks,
+    PackedAlignment.iter_upper_blocks), one block in memory at a time.
+    '''
+    if stats is None:
+        nbuckets = ngroups if within_only else ngroups * ngroups
+        stats = BucketStats(nbuckets, median=median)
+    n = len(codes)
+    several = np.zeros(n, dtype=bool)
+    if multi is not None:
+        several = np.diff(multi[0]) > 1
+    for i0, block in blocks:
+        i1 = i0 + block.shape[0]
+        rows = np.arange(i0, i1)
+        cols = np.arange(i0 + 1, n)
+        code_r = codes[i0:i1]
+        code_c = codes[i0 + 1:]
+        upper = (cols[None, :] > rows[:, None]) & (code_r >= 0)[:, None] & (code_c >= 0)[None, :]
+        if within_only:
+            upper &= ((code_r[:, None] == code_c[None, :])
+                | several[i0:i1][:, None] | several[i0 + 1:][None, :])
+        r, c = np.nonzero(upper)
+        code_i, code_j, vals = expand_pairs(rows[r], cols[c], block[r, c], codes, multi)
+        _accumulate_values(code_i, code_j, vals, ngroups, stats,
+            ordered, max_dist, verbose_exclude, within_only, seen, excluded, buckets)
+    return stats
+
+
+def accumulate_rows(matrix=None, rows=None, codes=None, ngroups=0, stats=None,
+    ordered=False, max_dist=None, median='exact', seen=None, excluded=None):
+    '''
+    accumulate_triu() restricted to the pairs with at least one seqid in
+    `rows` (sorted matrix indices); a pair is still bucketed as (group of
+    the upper seqid, group of the lower seqid). Only len(rows) * n cells
+    are read, block by block.
+    '''
+    if stats is None:
+        stats = BucketStats(ngroups * ngroups, median=median)
+    n = len(codes)
+    in_rows = np.zeros(n, dtype=bool)
+    in_rows[rows] = True
+    cols = np.nonzero(codes >= 0)[0]
+    block_rows = block_rows_for(len(cols))
+    for k in range(0, len(rows), block_rows):
+        idx = rows[k:k + block_rows]
+        idx = idx[codes[idx] >= 0]
+        block = sub_matrix(matrix, idx, cols)
+        # pairs inside `rows` are taken once, from their upper seqid
+        take = ~in_rows[cols][None, :] | (cols[None, :] > idx[:, None])
+        r, c = np.nonzero(take)
+        i, j = idx[r], cols[c]
+        upper, lower = np.minimum(i, j), np.maximum(i, j)
+        _accumulate_values(codes[upper], codes[lower], block[r, c], ngroups, stats,
+            ordered, max_dist, seen=seen, excluded=excluded)
+    return stats
+
+
+def dist_groups_single_pass(matrix=None, codes=None, groups=None,
+    b_handle=None, i_handle=None, max_dist=10, median='exact', pairs=None, blocks=None,
+    b_table=None, i_table=None, multi=None):
+    '''
+    Same output as dist_between_groups() and dist_within_group(), from one
+    pass over the upper triangle. Excluded values are reported once per pair.
+    Instead of a matrix, its row blocks can be given (see accumulate_blocks).
+    multi: see accumulate_triu().
+    With `pairs`, only these group pairs and the within-group pairs are
+    accumulated.
+    '''
+    ngroups = len(groups)
+    if blocks is None:
+        blocks = iter_upper_blocks(matrix)
+    selected = None
+    if pairs is not None:
+        selected = np.zeros(ngroups * ngroups, dtype=bool)
+        selected[np.arange(ngroups) * (ngroups + 1)] = True
+        for code1, code2 in pairs:
+            selected[code1 * ngroups + code2] = True
+    stats = accumulate_blocks(blocks, codes, ngroups, max_dist=max_dist,
+        verbose_exclude=True, median=median, buckets=selected, multi=multi)
+    print_bucket_results(stats, groups, b_handle, i_handle, pairs, b_table, i_table)
+
+
+def print_bucket_results(stats=None, groups=None, b_handle=None, i_handle=None, pairs=None,
+    b_table=None, i_table=None, medians=None):
+    '''
+    Write the between- and within-group output of a BucketStats over
+    unordered group pairs (pair_buckets) to b_handle and i_handle, if
+    given, and add the rows to the dist_output.GroupTable b_table and
+    i_table, if given. medians: see BucketStats.results().
+    '''
+    ngroups = len(groups)
+    # every pair counts twice, as in the dict scan
+    results = stats.results(weight=2, medians=medians)
+    na = ('NA.', 'NA.', 'NA.', 'NA.', 'NA.')
+
+    if b_handle is not None:
+        print('# between-groups distances:', file=b_handle)
+        print('# group1\tgroup2\tMinimum\tMaximum\tAverage\tMedian\tSample_std', file=b_handle)
+    if pairs is None:
+        pairs = all_pairs(ngroups)
+    for code1, code2 in pairs:
+        b = code1 * ngroups + code2
+        stat = results.get(b, na)
+        if b_table is not None:
+            b_table.add(code1, int(stats.count[b]), stat, code2)
+        if b_handle is None:
+            continue
+        line = [str(i) for i in stat]
+        print(groups[code1], groups[code2], '\t'.join(line), sep='\t', file=b_handle)
+
+    if i_handle is not None:
+        print('# within-group distances:', file=i_handle)
+        print('# group\tMinimum\tMaximum\tAverage\tMedian\tSample_std', file=i_handle)
+    for code in range(ngroups):
+        b = code * ngroups + code
+        stat = results.get(b, na)
+        if i_table is not None:
+            i_table.add(code, int(stats.count[b]), stat)
+        if i_handle is None:
+            continue
+        line = [str(i) for i in stat]
+        print(groups[code], '\t'.join(line), sep='\t', file=i_handle)
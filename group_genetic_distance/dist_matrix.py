@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+'''
+Binary pairwise distance matrix: the condensed upper triangle (row by
+row, diagonal excluded, NaN for NA) in a `.npy` file, float32 or float64,
+plus a sidecar `<file>.seqids` text file with one seqid per line, in
+matrix order.
+
+load_matrix() memory-maps the `.npy` file, so opening a matrix costs no
+parsing and the pages are only read when the engines touch them.
+'''
+import numpy as np
+
+
+SEQIDS_SUFFIX = '.seqids'
+
+
+def is_binary_matrix(f=None):
+    return f.endswith('.npy')
+
+
+def row_offsets(n=0):
+    '''
+    Position in the condensed array of the first pair (i, i + 1) of every row.
+    '''
+    i = np.arange(n, dtype=np.int64)
+    return i * n - i * (i + 1) // 2
+
+
+class CondensedMatrix(object):
+    '''
+    Symmetric n x n matrix with NaN diagonal, stored as its condensed upper
+    triangle `data` (length n * (n - 1) / 2).
+    '''
+
+    def __init__(self, data=None, n=0):
+        if len(data) != n * (n - 1) // 2:
+            raise ValueError('condensed matrix of {0} values does not fit {1} seqids'.format(len(data), n))
+        self.data = data
+        self.n = n
+        self.shape = (n, n)
+        self.offsets = row_offsets(n)
+
+    @classmethod
+    def from_dense(cls, matrix=None, dtype=np.float64):
+        n = matrix.shape[0]
+        return cls(matrix[np.triu_indices(n, k=1)].astype(dtype), n)
+
+    def upper_rows(self, i0=0, i1=0):
+        '''
+        Same as dense matrix[i0:i1, i0 + 1:]; cells on or below the diagonal are NaN.
+        '''
+        n = self.n
+        block = np.full((i1 - i0, n - i0 - 1), np.nan)
+        for i in range(i0, i1):
+            start = self.offsets[i]
+            block[i - i0, i - i0:] = self.data[start:start + n - 1 - i]
+        return block
+
+    def block(self, idx1=None, idx2=None):
+        '''
+        Same as dense matrix[np.ix_(idx1, idx2)].
+        '''
+        i = np.asarray(idx1, dtype=np.int64)[:, None]
+        j = np.asarray(idx2, dtype=np.int64)[None, :]
+        lo, hi = np.minimum(i, j), np.maximum(i, j)
+        off_diag = lo != hi
+        k = self.offsets[lo] + hi - lo - 1
+        out = np.full(k.shape, np.nan)
+        out[off_diag] = self.data[k[off_diag]]
+        return out
+
+    def dense(self):
+        return self.block(np.arange(self.n), np.arange(self.n))
+
+
+def save_matrix(f=None, seqids=None, matrix=None, dtype=np.float64):
+    '''
+    Write a dense (or CondensedMatrix) matrix to `f` (.npy) and its seqids
+    to `f`.seqids.
+    '''
+    if not isinstance(matrix, CondensedMatrix):
+        matrix = CondensedMatrix.from_dense(matrix, dtype=dtype)
+    np.save(f, np.asarray(matrix.data, dtype=dtype))
+    with open(f + SEQIDS_SUFFIX, 'w') as fhout:
+        for seqid in seqids:
+            print(seqid, file=fhout)
+
+
+def load_matrix(f=None, mmap_mode='r'):
+    '''
+    Return (seqids, CondensedMatrix) of a binary matrix.
+    '''
+    with open(f + SEQIDS_SUFFIX, 'r') as fh:
+        seqids = [line.rstrip('\n') for line in fh]
+    seqids = [seqid for seqid in seqids if seqid]
+    data = np.load(f, mmap_mode=mmap_mode)
+    return seqids, CondensedMatrix(data, len(seqids))
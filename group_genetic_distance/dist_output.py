@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+'''
+Typed (columnar) output of group distance results, `-out_format`.
+
+'text' is the tab-separated output of the scripts. The other formats
+hold the same rows as typed columns:
+
+- groups: the group names; group1 (and group2 for group pairs): int32
+  codes into groups
+- count: int64 number of distances (0 where the text output has NA.)
+- minimum, maximum, mean, median, std: float64, NaN for NA.
+- mean_matrix: G x G float64 matrix of the mean distances, NaN where a
+  pair has no row (between-group results only)
+
+npz (numpy.savez_compressed) needs nothing beyond NumPy; parquet needs
+pyarrow and hdf5 needs h5py, imported only when used. A parquet result is
+the row table in the output file plus the matrix, its columns named after
+the groups, in <output>.mean_matrix.parquet.
+
+RowWriter writes the wide tables of join_diff-gene-dist.py in batches:
+string key columns plus one float64 value per file and statistic, as
+named columns in parquet and as a `values` array with `value_names` in
+npz and hdf5. Parquet and hdf5 outputs are streamed; npz keeps the table
+in memory until it is written.
+'''
+import os
+import numpy as np
+
+OUT_FORMATS = ('text', 'npz', 'parquet', 'hdf5')
+
+STAT_COLUMNS = ('minimum', 'maximum', 'mean', 'median', 'std')
+
+_MODULES = {'parquet': 'pyarrow', 'hdf5': 'h5py'}
+
+
+def missing_dependency(out_format='text'):
+    '''
+    Error message if the module needed by out_format is not installed.
+    '''
+    module = _MODULES.get(out_format)
+    if module is None:
+        return None
+    try:
+        __import__(module)
+    except ImportError:
+        return '`-out_format {0}` needs the {1} package!'.format(out_format, module)
+    return None
+
+
+def to_float(x=None):
+    if x == 'NA.':
+        return np.nan
+    try:
+        return float(x)
+    except ValueError:
+        return np.nan
+
+
+class GroupTable(object):
+    '''
+    Rows of a within-group (pairs=False) or between-group (pairs=True)
+    result, collected by the output functions instead of printed.
+    symmetric: the pairs are unordered, the mean matrix is filled on both
+    sides of the diagonal.
+    '''
+
+    def __init__(self, groups=None, pairs=False, symmetric=True):
+        self.groups = list(groups)
+        self.pairs = pairs
+        self.symmetric = symmetric
+        self.code1 = []
+        self.code2 = []
+        self.count = []
+        self.stats = []
+
+    def add(self, code1=0, count=0, stats=None, code2=-1):
+        '''
+        stats: (min, max, mean, median, std) as printed, 'NA.' allowed.
+        '''
+        self.code1.append(code1)
+        self.code2.append(code2)
+        self.count.append(count)
+        self.stats.append([to_float(x) for x in stats])
+
+    def columns(self):
+        columns = [('group1', np.array(self.code1, dtype=np.int32))]
+        if self.pairs:
+            columns.append(('group2', np.array(self.code2, dtype=np.int32)))
+        columns.append(('count', np.array(self.count, dtype=np.int64)))
+        stats = np.array(self.stats, dtype=np.float64).reshape(len(self.stats), len(STAT_COLUMNS))
+        for j, name in enumerate(STAT_COLUMNS):
+            columns.append((name, stats[:, j].copy()))
+        return columns
+
+    def values(self, column='mean'):
+        '''
+        float64 array of one column ('count' or a statistic) of the rows.
+        '''
+        if column == 'count':
+            return np.array(self.count, dtype=np.float64)
+        stats = np.array(self.stats, dtype=np.float64).reshape(len(self.stats), len(STAT_COLUMNS))
+        return stats[:, STAT_COLUMNS.index(column)]
+
+    def matrix(self, column='mean'):
+        '''
+        G x G matrix of a statistic over the group pairs, NaN elsewhere.
+        '''
+        ngroups = len(self.groups)
+        matrix = np.full((ngroups, ngroups), np.nan)
+        if not self.stats:
+            return matrix
+        code1 = np.array(self.code1, dtype=np.int64)
+        code2 = np.array(self.code2, dtype=np.int64)
+        vals = self.values(column)
+        matrix[code1, code2] = vals
+        if self.symmetric:
+            matrix[code2, code1] = vals
+        return matrix
+
+
+def write_table(f=None, out_format='npz', table=None):
+    '''
+    Write a GroupTable to the file `f`.
+    '''
+    columns = table.columns()
+    arrays = {'groups': np.array(table.groups, dtype=str)}
+    arrays.update(columns)
+    if table.pairs:
+        arrays['mean_matrix'] = table.matrix('mean')
+
+    if out_format == 'npz':
+        with open(f, 'wb') as fhout:
+            np.savez_compressed(fhout, **arrays)
+    elif out_format == 'hdf5':
+        import h5py
+        with h5py.File(f, 'w') as h5:
+            h5.create_dataset('groups', data=np.array(table.groups, dtype=object),
+                dtype=h5py.string_dtype())
+            for name, values in arrays.items():
+                if name != 'groups':
+                    h5.create_dataset(name, data=values, compression='gzip')
+    elif out_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        groups = pa.array(table.groups, type=pa.string())
+        fields = []
+        for name, values in columns:
+            if name in ('group1', 'group2'):
+                fields.append((name, pa.DictionaryArray.from_arrays(pa.array(values), groups)))
+            else:
+                fields.append((name, pa.array(values)))
+        pq.write_table(pa.table(dict(fields)), f)
+        if table.pairs:
+            matrix = arrays['mean_matrix']
+            data = {'group': groups}
+            for code, group in enumerate(table.groups):
+                data[group] = pa.array(matrix[:, code])
+            pq.write_table(pa.table(data), matrix_file(f))
+    else:
+        raise ValueError('unknown output format: {0}'.format(out_format))
+
+
+def matrix_file(f=None):
+    root, ext = os.path.splitext(f)
+    return root + '.mean_matrix' + ext
+
+
+def read_table(f=None, out_format='npz'):
+    '''
+    {column: array} of a file written by write_table (npz or hdf5).
+    '''
+    if out_format == 'npz':
+        with np.load(f) as data:
+            return {name: data[name] for name in data.files}
+    if out_format == 'hdf5':
+        import h5py
+        with h5py.File(f, 'r') as h5:
+            data = {name: h5[name][()] for name in h5}
+        data['groups'] = np.array([g.decode('utf-8') if isinstance(g, bytes) else g for g in data['groups']])
+        return data
+    raise ValueError('read_table reads npz and hdf5 files')
+
+
+class RowWriter(object):
+    '''
+    Batched writer of a table of string key columns and float64 value
+    columns.
+    '''
+
+    def __init__(self, f=None, out_format='npz', key_names=None, value_names=None, batch_rows=1 << 16):
+        self.f = f
+        self.out_format = out_format
+        self.key_names = list(key_names)
+        self.value_names = list(value_names)
+        self.batch_rows = batch_rows
+        self.keys = []
+        self.values = []
+        self.done = []
+        self.nrows = 0
+        self.writer = None
+        self.h5 = None
+
+    def add(self, keys=None, values=None):
+        self.keys.append(keys)
+        self.values.append([to_float(x) for x in values])
+        if len(self.keys) >= self.batch_rows:
+            self.flush()
+
+    def _batch(self):
+        keys = np.array(self.keys, dtype=object).reshape(len(self.keys), len(self.key_names))
+        values = np.array(self.values, dtype=np.float64).reshape(len(self.values), len(self.value_names))
+        self.keys, self.values = [], []
+        return keys, values
+
+    def flush(self):
+        if not self.keys:
+            return
+        keys, values = self._batch()
+        n = len(keys)
+        if self.out_format == 'npz':
+            self.done.append((keys, values))
+        elif self.out_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            data = {}
+            for j, name in enumerate(self.key_names):
+                data[name] = pa.array(keys[:, j].tolist(), type=pa.string())
+            for j, name in enumerate(self.value_names):
+                data[name] = pa.array(values[:, j])
+            batch = pa.table(data)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.f, batch.schema)
+            self.writer.write_table(batch)
+        elif self.out_format == 'hdf5':
+            import h5py
+            if self.h5 is None:
+                self.h5 = h5py.File(self.f, 'w')
+                for name in self.key_names:
+                    self.h5.create_dataset(name, shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=True)
+                self.h5.create_dataset('values', shape=(0, len(self.value_names)),
+                    maxshape=(None, len(self.value_names)), dtype='f8', chunks=True, compression='gzip')
+                self.h5.create_dataset('value_names', data=np.array(self.value_names, dtype=object),
+                    dtype=h5py.string_dtype())
+            for j, name in enumerate(self.key_names):
+                self.h5[name].resize((self.nrows + n,))
+                self.h5[name][self.nrows:] = keys[:, j].tolist()
+            self.h5['values'].resize((self.nrows + n, len(self.value_names)))
+            self.h5['values'][self.nrows:] = values
+        else:
+            raise ValueError('unknown output format: {0}'.format(self.out_format))
+        self.nrows += n
+
+    def close(self):
+        self.flush()
+        if self.out_format == 'npz':
+            keys = [k for k, v in self.done]
+            values = [v for k, v in self.done]
+            arrays = {'value_names': np.array(self.value_names, dtype=str)}
+            keys = np.concatenate(keys) if keys else np.empty((0, len(self.key_names)), dtype=object)
+            for j, name in enumerate(self.key_names):
+                arrays[name] = keys[:, j].astype(str)
+            arrays['values'] = np.concatenate(values) if values else np.empty((0, len(self.value_names)))
+            with open(self.f, 'wb') as fhout:
+                np.savez_compressed(fhout, **arrays)
+        elif self.writer is not None:
+            self.writer.close()
+        elif self.h5 is not None:
+            self.h5.close()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+'''
+Bootstrap confidence intervals and permutation tests of the mean group
+distances (`-bootstrap N`, `-permutations N` of group_dist.py).
+
+The matrix is prepared once (CodedMatrix): the grouped specimens sorted by
+group code, the distances of the upper triangle mirrored to a full square
+(0 where a value is NaN, infinite or above max_dist) and the list of the
+pairs not used. A replicate is a set of specimen weights or an order of
+the specimens, and its G x G sums of distances are reductions over the
+group blocks of this matrix (np.add.reduceat; for the weights of a batch
+of replicates, one matrix product per group); its counts are those of
+all pairs minus the pairs not used. No group is rescanned.
+
+- bootstrap: the specimens of every group are drawn with replacement
+  (weights of a multinomial draw); the mean of a pair of groups is
+  sum(w_i * w_j * d_ij) / sum(w_i * w_j) over its specimen pairs, the
+  copies of the same specimen (distance 0) not counted. Reported: the
+  observed mean (that of the -b_o and -i_o output), the standard
+  deviation of the replicate means and their percentile interval. The
+  replicate means of the reported pairs are kept, replicates x pairs x 8
+  bytes.
+- permutations: the group labels are shuffled over the grouped
+  specimens. For every pair of groups, the statistic is the between-group
+  mean minus the average of the two within-group means; the p-value is
+  (1 + replicates with a statistic >= the observed) / (1 + replicates).
+
+Replicates are drawn in batches of BATCH, each from its own seed of a
+numpy.random.SeedSequence, so a run with -seed gives the same result with
+any number of processes. Only mean distances are resampled. Every seqid
+must be in one group (group_dist.py exits on a seqid listed under several
+groups).
+'''
+import warnings
+import multiprocessing
+import numpy as np
+
+from dist_engine import sub_matrix, all_pairs
+
+# replicates per batch (and per task of a worker process)
+BATCH = 16
+
+
+class CodedMatrix(object):
+
+    def __init__(self, matrix=None, codes=None, ngroups=0, max_dist=10):
+        codes = np.asarray(codes, dtype=np.int64)
+        grouped = np.nonzero(codes >= 0)[0]
+        # specimens sorted by group, every group a contiguous block
+        idx = grouped[np.argsort(codes[grouped], kind='stable')]
+        self.codes = codes[idx]
+        self.ngroups = ngroups
+        self.sizes = np.bincount(self.codes, minlength=ngroups)
+        self.starts = np.concatenate(([0], np.cumsum(self.sizes)[:-1]))
+
+        sub = np.asarray(sub_matrix(matrix, idx, idx), dtype=np.float64)
+        upper = np.triu(np.ones(sub.shape, dtype=bool), k=1)
+        with np.errstate(invalid='ignore'):
+            valid = upper & np.isfinite(sub) & (sub <= max_dist)
+        values = np.where(valid, sub, 0.0)
+        self.values = values + values.T
+        # the pairs not used, usually few: counts are all pairs minus these
+        self.skip1, self.skip2 = np.nonzero(upper & ~valid)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _means(self, sums=None, counts=None):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / np.where(counts > 0, counts, 1), np.nan)
+
+    def _skipped(self, code1=None, code2=None, weights=None):
+        '''
+        G x G (x n) numbers, or sums of the weight products, of the pairs not
+        used, on both sides of the diagonal.
+        '''
+        keys = np.concatenate((code1 * self.ngroups + code2, code2 * self.ngroups + code1))
+        if weights is None:
+            return np.bincount(keys, minlength=self.ngroups ** 2).reshape(self.ngroups, self.ngroups)
+        prod = weights[self.skip1] * weights[self.skip2]
+        skipped = np.zeros((self.ngroups ** 2, weights.shape[1]))
+        np.add.at(skipped, keys, np.concatenate((prod, prod)))
+        return skipped.reshape(self.ngroups, self.ngroups, weights.shape[1])
+
+    def means(self, order=None):
+        '''
+        G x G mean distances between (and within, on the diagonal) the
+        groups, with the specimens taken in `order` (a permutation) if given.
+        '''
+        labels = self.codes
+        if order is None:
+            order = np.arange(len(self))
+        else:
+            labels = np.empty_like(self.codes)
+            labels[order] = self.codes
+        # sums of the rows of every group block, then of its columns; the
+        # matrix is symmetric, so only whole rows are gathered
+        sums = np.add.reduceat(self.values[order], self.starts, axis=0)
+        sums = np.add.reduceat(sums[:, order], self.starts, axis=1)
+        counts = np.outer(self.sizes, self.sizes) - np.diag(self.sizes)
+        counts = counts - self._skipped(labels[self.skip1], labels[self.skip2])
+        return self._means(sums, counts)
+
+    def weighted_means(self, weights=None):
+        '''
+        n x G x G mean distances for n x specimens weights: a pair of
+        specimens counts w_i * w_j times.
+        '''
+        w = np.asarray(weights, dtype=np.float64).T
+        n = w.shape[1]
+        sums = np.empty((self.ngroups, self.ngroups, n))
+        for code in range(self.ngroups):
+            block = slice(self.starts[code], self.starts[code] + self.sizes[code])
+            # specimens x n weighted sums over the members of the group,
+            # one matrix product for all replicates
+            t = self.values[:, block] @ w[block]
+            sums[:, code] = np.add.reduceat(t * w, self.starts, axis=0)
+        # the weights of a group add up to its size; a specimen drawn
+        # several times is not paired with itself
+        counts = np.repeat(np.outer(self.sizes, self.sizes)[:, :, None], n, axis=2).astype(np.float64)
+        diag = np.arange(self.ngroups)
+        counts[diag, diag] -= np.add.reduceat(w * w, self.starts, axis=0)
+        counts -= self._skipped(self.codes[self.skip1], self.codes[self.skip2], w)
+        return np.moveaxis(self._means(sums, counts), 2, 0)
+
+    def bootstrap_weights(self, rng=None, n=1):
+        '''
+        n x specimens weights: the members of every group drawn with
+        replacement from the group.
+        '''
+        size = self.sizes[self.codes]
+        draws = self.starts[self.codes] + np.floor(rng.random((n, len(self))) * size).astype(np.int64)
+        draws += np.arange(n)[:, None] * len(self)
+        return np.bincount(draws.ravel(), minlength=n * len(self)).reshape(n, len(self))
+
+    def permutations(self, rng=None, n=1):
+        return rng.permuted(np.tile(np.arange(len(self)), (n, 1)), axis=1)
+
+
+def gap_statistic(means=None):
+    '''
+    Between-group mean minus the average of the two within-group means.
+    '''
+    within = np.diagonal(means)
+    return means - (within[:, None] + within[None, :]) / 2
+
+
+_CODED = None
+
+
+def _init_worker(coded=None):
+    global _CODED
+    _CODED = coded
+
+
+def _bootstrap_batch(task=None):
+    seed, n, code1, code2 = task
+    rng = np.random.default_rng(seed)
+    return _CODED.weighted_means(_CODED.bootstrap_weights(rng, n))[:, code1, code2]
+
+
+def _permutation_batch(task=None):
+    seed, n, observed = task
+    rng = np.random.default_rng(seed)
+    hits = np.zeros(observed.shape, dtype=np.int64)
+    valid = np.zeros(observed.shape, dtype=np.int64)
+    for order in _CODED.permutations(rng, n):
+        stat = gap_statistic(_CODED.means(order=order))
+        hits += stat >= observed
+        valid += ~np.isnan(stat)
+    return hits, valid
+
+
+def _tasks(replicates=0, seed=None):
+    nbatches = (replicates + BATCH - 1) // BATCH
+    seeds = np.random.SeedSequence(seed).spawn(nbatches)
+    return [(seeds[i], min(BATCH, replicates - i * BATCH)) for i in range(nbatches)]
+
+
+def _map(func=None, coded=None, tasks=None, processes=1):
+    if processes <= 1 or len(tasks) <= 1:
+        _init_worker(coded)
+        try:
+            return [func(task) for task in tasks]
+        finally:
+            _init_worker(None)
+    pool = multiprocessing.Pool(processes=min(processes, len(tasks)),
+        initializer=_init_worker, initargs=(coded,))
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def bootstrap(coded=None, replicates=1000, seed=None, processes=1, confidence=0.95, pairs=None, observed=None):
+    '''
+    Return (observed, std, low, high) G x G matrices of the mean distances
+    of the (code1, code2) `pairs` (all pairs if None) and of every group
+    with itself; NaN elsewhere and where no replicate had a distance.
+
+    observed: the exact G x G mean matrix of the run (group_matrix
+    summary_matrices), so the averages are those of the other outputs;
+    coded.means() (float sums) if None.
+    '''
+    ngroups = coded.ngroups
+    if pairs is None:
+        pairs = all_pairs(ngroups)
+    pairs = list(pairs) + [(code, code) for code in range(ngroups)]
+    code1 = np.array([c1 for c1, c2 in pairs], dtype=np.int64)
+    code2 = np.array([c2 for c1, c2 in pairs], dtype=np.int64)
+    tasks = [(s, n, code1, code2) for s, n in _tasks(replicates, seed)]
+    means = np.concatenate(_map(_bootstrap_batch, coded, tasks, processes))
+    alpha = (1 - confidence) / 2 * 100
+    # np.nanpercentile loops over the columns: only for pairs with a NaN
+    low, high = np.percentile(means, [alpha, 100 - alpha], axis=0)
+    nan = np.isnan(means).any(axis=0)
+    with warnings.catch_warnings():
+        # pairs with no distance in any replicate
+        warnings.simplefilter('ignore', RuntimeWarning)
+        std = np.nanstd(means, axis=0, ddof=1)
+        if nan.any():
+            low[nan], high[nan] = np.nanpercentile(means[:, nan], [alpha, 100 - alpha], axis=0)
+    result = [coded.means() if observed is None else observed]
+    for vals in (std, low, high):
+        matrix = np.full((ngroups, ngroups), np.nan)
+        matrix[code1, code2] = vals
+        matrix[code2, code1] = vals
+        result.append(matrix)
+    return tuple(result)
+
+
+def permutation_test(coded=None, replicates=1000, seed=None, processes=1):
+    '''
+    Return (observed, pvalue) G x G matrices of gap_statistic(), NaN where
+    the statistic is undefined.
+    '''
+    observed = gap_statistic(coded.means())
+    tasks = [(s, n, observed) for s, n in _tasks(replicates, seed)]
+    hits = np.zeros(observed.shape, dtype=np.int64)
+    valid = np.zeros(observed.shape, dtype=np.int64)
+    for part_hits, part_valid in _map(_permutation_batch, coded, tasks, processes):
+        hits += part_hits
+        valid += part_valid
+    pvalue = np.where(np.isnan(observed), np.nan, (1 + hits) / (1 + valid))
+    return observed, pvalue
+
+
+def _fmt(x=None):
+    return 'NA.' if np.isnan(x) else str(float(x))
+
+
+def print_bootstrap(groups=None, result=None, out_handle=None, pairs=None, replicates=0, confidence=0.95):
+    observed, std, low, high = result
+    print('# bootstrap of the mean distances: {0} replicates, specimens resampled within groups'.format(replicates), file=out_handle)
+    print('# between-groups distances:', file=out_handle)
+    print('# group1\tgroup2\tAverage\tBootstrap_std\tCI{0:g}_low\tCI{0:g}_high'.format(confidence * 100), file=out_handle)
+    for code1, code2 in pairs:
+        line = [_fmt(m[code1, code2]) for m in (observed, std, low, high)]
+        print(groups[code1], groups[code2], '\t'.join(line), sep='\t', file=out_handle)
+    print('# within-group distances:', file=out_handle)
+    print('# group\tAverage\tBootstrap_std\tCI{0:g}_low\tCI{0:g}_high'.format(confidence * 100), file=out_handle)
+    for code, group in enumerate(groups):
+        line = [_fmt(m[code, code]) for m in (observed, std, low, high)]
+        print(group, '\t'.join(line), sep='\t', file=out_handle)
+
+
+def print_permutations(groups=None, result=None, means=None, out_handle=None, pairs=None, replicates=0):
+    '''
+    means: the G x G mean matrix printed, and of which Gap is printed; the
+    p-values are those of `result` (permutation_test).
+    '''
+    observed, pvalue = result
+    observed = gap_statistic(means)
+    within = np.diagonal(means)
+    print('# permutation test: {0} replicates, group labels shuffled; Gap = Between - (Within1 + Within2) / 2'.format(replicates), file=out_handle)
+    print('# group1\tgroup2\tBetween\tWithin1\tWithin2\tGap\tP_value', file=out_handle)
+    for code1, code2 in pairs:
+        line = [_fmt(x) for x in (means[code1, code2], within[code1], within[code2],
+            observed[code1, code2], pvalue[code1, code2])]
+        print(groups[code1], groups[code2], '\t'.join(line), sep='\t', file=out_handle)
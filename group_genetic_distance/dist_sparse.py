@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+'''
+Sparse, threshold-pruned pairwise store for very large specimen sets
+(`-sparse_store` of group_dist.py).
+
+The matrix is read once, row block by row block (never whole), and split:
+
+- the pairs of grouped specimens with a distance <= cutoff are kept, in
+  CSR form over the upper triangle (indptr, indices, data: the columns and
+  distances of row i are indices/data[indptr[i]:indptr[i + 1]])
+- the finite distances above the cutoff (and not above max_dist) are only
+  counted, into dense per-group-pair counters (a BucketStats over unordered
+  group pairs: count, min, max, exact sums and, unless median='none', a
+  quantile sketch)
+
+The group statistics are merged from both, so count, minimum, maximum,
+mean and standard deviation are exact. The median is exact when the middle
+distances of a group pair are at most the cutoff; otherwise it comes from
+the sketch of the pruned distances (1% relative error) and is counted as
+approximate. NaN, infinite values and values above max_dist are dropped
+without the "excluding" messages of the other engines.
+
+The store is bound to the group definition it was built with (the digest
+of aggregate_store.index_digest), to max_dist, the cutoff and whether
+medians are computed. Every seqid must be in one group (group_dist.py
+exits on a seqid listed under several groups).
+'''
+import os
+import pickle
+import numpy as np
+
+from dist_stats import BucketStats
+from dist_engine import pair_buckets, print_bucket_results, all_pairs
+from aggregate_store import index_digest
+
+# bump when the stored data would change for the same inputs
+SPARSE_VERSION = '1'
+
+
+class SparseStore(object):
+
+    def __init__(self, seqids=None, index=None, cutoff=10, max_dist=10, median='exact'):
+        self.version = SPARSE_VERSION
+        self.digest = index_digest(index)
+        self.seqids = list(seqids)
+        index = index.restrict(set(self.seqids))
+        self.groups = list(index.groups)
+        self.codes = index.codes(self.seqids)
+        self.cutoff = cutoff
+        self.max_dist = max_dist
+        ngroups = len(self.groups)
+        self.rest = BucketStats(ngroups * ngroups, median='none' if median == 'none' else 'approx')
+        self.indptr = np.zeros(len(self.seqids) + 1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.data = np.zeros(0, dtype=np.float64)
+
+    def build(self, blocks=None):
+        '''
+        Fill the store from the (i0, matrix[i0:i1, i0 + 1:]) row blocks.
+        '''
+        n, ngroups, codes = len(self.seqids), len(self.groups), self.codes
+        rows_kept, cols_kept, vals_kept = [], [], []
+        for i0, block in blocks:
+            i1 = i0 + block.shape[0]
+            rows = np.arange(i0, i1)
+            cols = np.arange(i0 + 1, n)
+            code_r = codes[i0:i1]
+            code_c = codes[i0 + 1:]
+            keep = (cols[None, :] > rows[:, None]) & (code_r >= 0)[:, None] & (code_c >= 0)[None, :]
+            with np.errstate(invalid='ignore'):
+                keep &= np.isfinite(block) & ~(block > self.max_dist)
+                below = keep & (block <= self.cutoff)
+            r, c = np.nonzero(below)
+            rows_kept.append(rows[r])
+            cols_kept.append(cols[c].astype(np.int32))
+            vals_kept.append(block[r, c].astype(np.float64))
+            r, c = np.nonzero(keep & ~below)
+            self.rest.add(pair_buckets(code_r[r], code_c[c], ngroups), block[r, c])
+
+        rows = np.concatenate(rows_kept) if rows_kept else np.zeros(0, dtype=np.int64)
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=n)))).astype(np.int64)
+        if rows_kept:
+            self.indices = np.concatenate(cols_kept)
+            self.data = np.concatenate(vals_kept)
+        return self
+
+    def matches(self, index=None, max_dist=10, cutoff=10, median='exact'):
+        '''
+        True if the store was built with the same group definition and
+        settings; -median exact and approx build the same store.
+        '''
+        return (self.version == SPARSE_VERSION and self.digest == index_digest(index)
+            and self.max_dist == max_dist and self.cutoff == cutoff
+            and self.rest.median == ('none' if median == 'none' else 'approx'))
+
+    def __len__(self):
+        return len(self.data)
+
+    def group_stats(self):
+        '''
+        Return (stats, medians, approximate): the BucketStats (median
+        'none') over unordered group pairs of all distances, the median of
+        every bucket (None with median='none') and a bool array of the
+        buckets whose median came from the sketch.
+        '''
+        ngroups = len(self.groups)
+        nbuckets = ngroups * ngroups
+        rows = np.repeat(np.arange(len(self.seqids)), np.diff(self.indptr))
+        buckets = pair_buckets(self.codes[rows], self.codes[self.indices], ngroups)
+        stats = BucketStats(nbuckets, median='none')
+        stats.add(buckets, self.data)
+        stats.merge(self.rest)
+        approximate = np.zeros(nbuckets, dtype=bool)
+        if self.rest.median == 'none':
+            return stats, None, approximate
+
+        # the kept distances are all below the pruned ones: a rank below
+        # the number kept is read from them, a higher one from the sketch
+        kept = np.bincount(buckets, minlength=nbuckets)
+        vals = self.data[np.lexsort((self.data, buckets))]
+        starts = np.cumsum(kept) - kept
+        count = stats.count
+
+        def value_at(ranks):
+            out = np.full(nbuckets, np.nan)
+            exact = (count > 0) & (ranks < kept)
+            out[exact] = vals[(starts + ranks)[exact]]
+            pruned = (count > 0) & ~exact
+            out[pruned] = self.rest.sketch.values_at(self.rest.count, np.where(pruned, ranks - kept, -1))[pruned]
+            return out, pruned
+
+        lower, lower_pruned = value_at((count - 1) // 2)
+        upper, upper_pruned = value_at(count // 2)
+        return stats, (lower + upper) / 2, lower_pruned | upper_pruned
+
+    def write_groups(self, b_handle=None, i_handle=None, pairs=None, b_table=None, i_table=None):
+        '''
+        Write the between- and within-group output (as -engine stream);
+        return the number of its rows with an approximate median.
+        '''
+        stats, medians, approximate = self.group_stats()
+        print_bucket_results(stats, self.groups, b_handle, i_handle, pairs, b_table, i_table, medians)
+        ngroups = len(self.groups)
+        written = [code * (ngroups + 1) for code in range(ngroups)]
+        written += [code1 * ngroups + code2 for code1, code2 in (all_pairs(ngroups) if pairs is None else pairs)]
+        return int(np.count_nonzero(approximate[written]))
+
+    def save(self, f=None):
+        tmp = '{0}.{1}.tmp'.format(f, os.getpid())
+        with open(tmp, 'wb') as fhout:
+            pickle.dump(self, fhout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, f)
+
+
+def load_sparse(f=None):
+    '''
+    SparseStore stored in `f`, or None if it is of another version.
+    '''
+    with open(f, 'rb') as fh:
+        store = pickle.load(fh)
+    if getattr(store, 'version', None) != SPARSE_VERSION:
+        return None
+    return store
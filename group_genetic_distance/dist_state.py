@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+Per-gene partial statistics kept between runs, so that a change of the
+group definition only recomputes the group pairs it touches.
+
+The state of a gene holds, over ordered (row group, column group) pairs of
+the upper triangle (see dist_engine.pair_buckets):
+
+- kept: BucketStats of the finite values not above max_dist (count, exact
+  sums, min/max and the values or sketch of the median mode)
+- excluded: BucketStats of the finite values above max_dist
+- seen: the pairs with any non-NaN value
+- upper: the rows with a value right of the diagonal
+
+together with the seqids, the groups of every grouped seqid and the
+settings and content digest of the matrix source. The per-gene output
+(as `-engine stream` writes it) is kept folded to unordered pairs, the
+all-genes partials of multi_gene.py are kept + excluded.
+
+When the group definition changes, a group is changed for a gene if its
+members among the gene's seqids are not the same. The buckets of two
+unchanged groups are carried over, only the rows of the changed groups
+are read from the matrix (dist_engine.accumulate_rows), and a gene with no
+changed group is not read at all.
+
+A seqid listed under several groups counts in all of them, as in the
+single-pass engine, except in the all-genes between partial: there it
+counts in the group of its last line, as in multi_gene.py. For such a
+gene the state also keeps these last-line buckets (primary), and a
+change of the group definition computes it again from the whole matrix.
+'''
+import os
+import pickle
+import numpy as np
+
+from dist_stats import BucketStats
+from dist_engine import accumulate_triu, accumulate_rows, rows_with_upper_values, print_bucket_results
+
+# bump when the stored state would change for the same inputs
+STATE_VERSION = '2'
+
+STATE_SUFFIX = '.state'
+
+
+def state_file(state_dir=None, gene=None):
+    return os.path.join(state_dir, gene + STATE_SUFFIX)
+
+
+class GeneState(object):
+
+    def __init__(self, source=None, max_dist=10, median='exact'):
+        self.version = STATE_VERSION
+        self.source = source
+        self.max_dist = max_dist
+        self.median = median
+        self.seqids = []
+        self.groups = []
+        self.seqid_group = {}
+        self.seqid_groups = {}
+        self.upper = None
+        self.seen = None
+        self.kept = None
+        self.excluded = None
+        self.primary = None
+
+    def matches(self, source=None, max_dist=10, median='exact'):
+        '''
+        True if the state was computed from the same matrix and settings.
+        '''
+        return (self.version == STATE_VERSION and self.source == source
+            and self.max_dist == max_dist and self.median == median)
+
+    def _set_groups(self, index=None):
+        self.groups = list(index.groups)
+        self.seqid_group = {seqid: index.seqid_group[seqid]
+            for seqid in self.seqids if seqid in index.seqid_group}
+        self.seqid_groups = {seqid: sorted(index.seqid_groups[seqid])
+            for seqid in self.seqids if seqid in index.seqid_groups}
+
+    def compute(self, seqids=None, matrix=None, index=None):
+        '''
+        Fill the state from a whole gene matrix.
+        '''
+        self.seqids = list(seqids)
+        self._set_groups(index)
+        ngroups, codes = len(index), index.codes(seqids)
+        multi = index.multi_codes(seqids)
+        self.upper = rows_with_upper_values(matrix)
+        self.seen = np.zeros(ngroups * ngroups, dtype=bool)
+        self.excluded = BucketStats(ngroups * ngroups, median=self.median)
+        self.kept = accumulate_triu(matrix, codes, ngroups,
+            ordered=True, max_dist=self.max_dist, verbose_exclude=True, median=self.median,
+            seen=self.seen, excluded=self.excluded, multi=multi)
+        self.primary = None
+        if multi is not None:
+            seen = np.zeros(ngroups * ngroups, dtype=bool)
+            excluded = BucketStats(ngroups * ngroups, median=self.median)
+            kept = accumulate_triu(matrix, codes, ngroups, ordered=True,
+                max_dist=self.max_dist, median=self.median, seen=seen, excluded=excluded)
+            self.primary = (seen, kept, excluded)
+        return self
+
+    def changed_groups(self, index=None):
+        '''
+        Groups of the old or the new definition whose members among the
+        gene's seqids differ, counting those of their last line apart.
+        '''
+        old, new = {}, {}
+        for seqid in self.seqids:
+            for group in self.seqid_groups.get(seqid, ()):
+                old.setdefault(group, set()).add(seqid)
+            for group in index.seqid_groups.get(seqid, ()):
+                new.setdefault(group, set()).add(seqid)
+            if seqid in self.seqid_group:
+                old.setdefault(self.seqid_group[seqid], set()).add((seqid, 'last'))
+            if seqid in index.seqid_group:
+                new.setdefault(index.seqid_group[seqid], set()).add((seqid, 'last'))
+        groups = set(self.groups) | set(index.groups)
+        return {group for group in groups if old.get(group) != new.get(group)}
+
+    def update(self, index=None, read_matrix=None):
+        '''
+        Move the state to the group definition `index`. read_matrix() is
+        called, only if a group changed, for the (seqids, matrix) of the gene.
+        Return the changed groups.
+        '''
+        changed = self.changed_groups(index)
+        if changed and (self.primary is not None or index.multi_grouped(self.seqids)):
+            seqids, matrix = read_matrix()
+            if list(seqids) != self.seqids:
+                raise ValueError('the seqids of the matrix are not those of the state')
+            self.compute(seqids, matrix, index)
+            return changed
+        ngroups, old_ngroups = len(index), len(self.groups)
+
+        new_code = np.full(old_ngroups, -1, dtype=np.int64)
+        for code, group in enumerate(self.groups):
+            if group not in changed and group in index.group_code:
+                new_code[code] = index.group_code[group]
+        code1 = new_code[np.arange(old_ngroups * old_ngroups) // max(old_ngroups, 1)]
+        code2 = new_code[np.arange(old_ngroups * old_ngroups) % max(old_ngroups, 1)]
+        mapping = np.where((code1 >= 0) & (code2 >= 0), code1 * ngroups + code2, -1)
+
+        seen = np.zeros(ngroups * ngroups, dtype=bool)
+        seen[mapping[self.seen & (mapping >= 0)]] = True
+        kept = self.kept.remap(mapping, ngroups * ngroups)
+        excluded = self.excluded.remap(mapping, ngroups * ngroups)
+        if self.primary is not None:
+            primary_seen = np.zeros(ngroups * ngroups, dtype=bool)
+            primary_seen[mapping[self.primary[0] & (mapping >= 0)]] = True
+            self.primary = (primary_seen, self.primary[1].remap(mapping, ngroups * ngroups),
+                self.primary[2].remap(mapping, ngroups * ngroups))
+
+        if changed:
+            seqids, matrix = read_matrix()
+            if list(seqids) != self.seqids:
+                raise ValueError('the seqids of the matrix are not those of the state')
+            codes = index.codes(seqids)
+            changed_codes = [index.group_code[group] for group in changed if group in index.group_code]
+            rows = np.nonzero(np.isin(codes, changed_codes))[0]
+            accumulate_rows(matrix, rows, codes, ngroups, kept, ordered=True,
+                max_dist=self.max_dist, seen=seen, excluded=excluded)
+
+        self._set_groups(index)
+        self.seen, self.kept, self.excluded = seen, kept, excluded
+        return changed
+
+    def write_gene(self, index=None, b_handle=None, i_handle=None, pairs=None,
+        congeneric_only=False, match=None):
+        '''
+        Per-gene between- and within-group output, see group_dist.dist_groups.
+        '''
+        restricted = index.restrict(set(self.seqids))
+        ngroups, nrestricted = len(index), len(restricted)
+        # (a, b) and (b, a) of the full definition go to the unordered
+        # bucket of the groups with a member in the gene
+        code = np.array([restricted.group_code.get(group, -1) for group in index.groups], dtype=np.int64)
+        code1 = code[np.arange(ngroups * ngroups) // max(ngroups, 1)]
+        code2 = code[np.arange(ngroups * ngroups) % max(ngroups, 1)]
+        low, high = np.minimum(code1, code2), np.maximum(code1, code2)
+        mapping = np.where(low >= 0, low * nrestricted + high, -1)
+        stats = self.kept.remap(mapping, nrestricted * nrestricted)
+        selected = restricted.select_pairs(pairs=pairs, congeneric_only=congeneric_only, match=match)
+        print_bucket_results(stats, restricted.groups, b_handle, i_handle, selected)
+
+    def within_partial(self, index=None):
+        '''
+        (present, stats) as multi_gene.within_matrix_partial() gives them.
+        '''
+        ngroups = len(index)
+        present = index.present([seqid for seqid, upper in zip(self.seqids, self.upper) if upper])
+        mapping = np.full(ngroups * ngroups, -1, dtype=np.int64)
+        mapping[np.arange(ngroups) * (ngroups + 1)] = np.arange(ngroups)
+        stats = self.kept.remap(mapping, ngroups).merge(self.excluded.remap(mapping, ngroups))
+        return present, stats
+
+    def between_partial(self):
+        '''
+        (seen, stats) as multi_gene.between_matrix_partial() gives them.
+        '''
+        seen, kept, excluded = self.primary or (self.seen, self.kept, self.excluded)
+        nbuckets = len(seen)
+        identity = np.arange(nbuckets)
+        stats = kept.remap(identity, nbuckets).merge(excluded.remap(identity, nbuckets))
+        return seen.copy(), stats
+
+    def save(self, f=None):
+        tmp = '{0}.{1}.tmp'.format(f, os.getpid())
+        with open(tmp, 'wb') as fhout:
+            pickle.dump(self, fhout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, f)
+
+
+def load_state(f=None):
+    '''
+    GeneState stored in `f`, or None if there is none or it is of another
+    version.
+    '''
+    if not os.path.exists(f):
+        return None
+    with open(f, 'rb') as fh:
+        state = pickle.load(fh)
+    if getattr(state, 'version', None) != STATE_VERSION:
+        return None
+    return state
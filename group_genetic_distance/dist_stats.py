@@ -0,0 +1,748 @@
+#!/usr/bin/env python3
+'''
+Exact summary statistics of distance values held in NumPy arrays.
+
+The text output of the scripts was produced with the `statistics` module,
+which computes mean and sample standard deviation from the exact rational
+sums of the data. The functions here get the same exact sums from float64
+arrays without building Python float lists: every value is split into
+32-bit digits of a fixed-point integer (scaled by 2**_BIAS) and the digits
+are summed with `np.bincount`. The results are therefore identical, bit for
+bit, to `statistics.mean()` and `statistics.stdev()`.
+
+Medians are exact (all values are kept), approximate (a mergeable
+log-binned quantile sketch with bounded relative error) or not computed
+('NA.'), see MEDIAN_MODES.
+
+WeightedStats merges the statistics of several genes with a weight per gene
+(-weighting of between-group_dist_of_multi-genes.py).
+'''
+import math
+import numpy as np
+
+
+# x * 2**_BIAS is an integer for every float64 (including subnormals, whose
+# frexp() exponent goes down to -1073 - 52). Multiple of 32.
+_BIAS = 1152
+_DIGIT = 32
+_DIGIT_MASK = (1 << _DIGIT) - 1
+# float64 sums of 32-bit digits are exact for this many terms per bin
+_CHUNK = 1 << 20
+_SQRT_BIT_WIDTH = 109
+
+MEDIAN_MODES = ('exact', 'approx', 'none')
+
+
+def _mantissa_exponent(vals):
+    '''
+    Return (m, p) with vals == m * 2**p exactly, m an int64 array.
+    '''
+    frac, exp = np.frexp(vals)
+    m = (frac * (1 << 53)).astype(np.int64)
+    p = exp.astype(np.int64) - 53
+    return m, p
+
+
+def _split_digits(m, q):
+    '''
+    Split m * 2**q (q >= 0, |m| < 2**54) into three 32-bit digits.
+
+    Return (k, d0, d1, d2): digit d0 sits at position k, d1 at k+1 and
+    d2 at k+2, all as float64 arrays carrying the sign of m.
+    '''
+    sign = np.where(m < 0, -1.0, 1.0)
+    a = np.abs(m).astype(np.uint64)
+    k = q >> 5
+    r = (q & 31).astype(np.uint64)
+    d0 = (a << r) & np.uint64(_DIGIT_MASK)
+    rest = a >> (np.uint64(_DIGIT) - r)
+    d1 = rest & np.uint64(_DIGIT_MASK)
+    d2 = rest >> np.uint64(_DIGIT)
+    return k, d0 * sign, d1 * sign, d2 * sign
+
+
+def _square_terms(m, p):
+    '''
+    Split m**2 * 2**(2p) into three terms (m_i, p_i) with |m_i| < 2**54.
+    '''
+    m = np.abs(m)
+    h = m >> 27
+    l = m & ((1 << 27) - 1)
+    return [(h * h, 2 * p + 54), (2 * h * l, 2 * p + 27), (l * l, 2 * p)]
+
+
+def digit_sums(keys=None, vals=None, nkeys=1):
+    '''
+    Exact per-key sums of vals and vals**2 as 32-bit digit arrays.
+
+    Return (k0, sx, sxx) where sx and sxx are int64 arrays of shape
+    (nkeys, ndigits) and digit j of a row has weight 2**(32 * (k0 + j)).
+    sx is scaled by 2**_BIAS and sxx by 2**(2 * _BIAS).
+    '''
+    if keys is None:
+        keys = np.zeros(len(vals), dtype=np.int64)
+    m, p = _mantissa_exponent(vals)
+    terms = [(m, p + _BIAS)]
+    sq_terms = [(mi, pi + 2 * _BIAS) for mi, pi in _square_terms(m, p)]
+
+    split = [_split_digits(mi, qi) for mi, qi in terms]
+    sq_split = [_split_digits(mi, qi) for mi, qi in sq_terms]
+
+    k_all = [s[0] for s in split + sq_split if len(s[0])]
+    if not k_all:
+        empty = np.zeros((nkeys, 1), dtype=np.int64)
+        return 0, empty, empty.copy()
+    k0 = min(int(k.min()) for k in k_all)
+    ndigits = max(int(k.max()) for k in k_all) - k0 + 3
+
+    def accumulate(parts):
+        acc = np.zeros(nkeys * ndigits, dtype=np.int64)
+        for k, d0, d1, d2 in parts:
+            base = keys * ndigits + (k - k0)
+            for shift, d in enumerate((d0, d1, d2)):
+                for i in range(0, len(d), _CHUNK):
+                    acc += np.bincount(
+                        base[i:i + _CHUNK] + shift,
+                        weights=d[i:i + _CHUNK],
+                        minlength=nkeys * ndigits).astype(np.int64)
+        return acc.reshape(nkeys, ndigits)
+
+    return k0, accumulate(split), accumulate(sq_split)
+
+
+def digits_to_int(k0=0, digits=None):
+    '''
+    Combine one row of 32-bit digits into a Python int.
+    '''
+    total = 0
+    for j, d in enumerate(digits.tolist()):
+        if d:
+            total += d << (_DIGIT * (k0 + j))
+    return total
+
+
+def exact_sums(vals=None):
+    '''
+    Return (n, S, SS): S == sum(vals) * 2**_BIAS and
+    SS == sum(vals**2) * 2**(2 * _BIAS), both exact Python ints.
+    '''
+    vals = np.asarray(vals, dtype=np.float64)
+    k0, sx, sxx = digit_sums(vals=vals)
+    return len(vals), digits_to_int(k0, sx[0]), digits_to_int(k0, sxx[0])
+
+
+def _integer_sqrt_of_frac_rto(n, m):
+    a = math.isqrt(n // m)
+    return a | (a * a * m != n)
+
+
+def _float_sqrt_of_frac(n, m):
+    '''
+    Correctly rounded square root of n/m, as `statistics.stdev()` does it.
+    '''
+    q = (n.bit_length() - m.bit_length() - _SQRT_BIT_WIDTH) // 2
+    if q >= 0:
+        numerator = _integer_sqrt_of_frac_rto(n, m << 2 * q) << q
+        denominator = 1
+    else:
+        numerator = _integer_sqrt_of_frac_rto(n << -2 * q, m)
+        denominator = 1 << -q
+    return numerator / denominator
+
+
+def mean_from_sums(n=0, S=0):
+    return S / (n << _BIAS)
+
+
+def stdev_from_sums(n=0, S=0, SS=0, weight=1):
+    '''
+    Sample standard deviation of the data, each value counted `weight` times.
+    '''
+    n_w = n * weight
+    if n_w < 2:
+        return 'NA.'
+    num = weight * weight * (n * SS - S * S)
+    den = n_w * (n_w - 1) << (2 * _BIAS)
+    return _float_sqrt_of_frac(num, den)
+
+
+def exact_median(vals=None):
+    '''
+    Same result as `statistics.median()`, via np.partition.
+    '''
+    n = len(vals)
+    if n % 2 == 1:
+        return float(np.partition(vals, n // 2)[n // 2])
+    i = n // 2
+    part = np.partition(vals, [i - 1, i])
+    return (float(part[i - 1]) + float(part[i])) / 2
+
+
+def stat_dist(vals=None, weight=1, median='exact'):
+    '''
+    Minimum, maximum, mean, median and sample std of vals.
+
+    weight: how many times each value is counted. group_dist.py reads every
+    unordered pair twice (key1:key2 and key2:key1), so it passes 2 here to
+    keep Sample_std identical to the dict-based code.
+
+    median: one of MEDIAN_MODES.
+    '''
+    vals = np.asarray(vals, dtype=np.float64)
+    if len(vals) <= 0:
+        return 'NA.', 'NA.', 'NA.', 'NA.', 'NA.'
+    n, S, SS = exact_sums(vals)
+    if median == 'exact':
+        med = exact_median(vals)
+    elif median == 'approx':
+        sketch = QuantileSketch(1)
+        sketch.add(np.zeros(n, dtype=np.int64), vals)
+        med = float(sketch.medians(np.array([n]))[0])
+    else:
+        med = 'NA.'
+    return (float(vals.min()), float(vals.max()), mean_from_sums(n, S),
+        med, stdev_from_sums(n, S, SS, weight=weight))
+
+
+class QuantileSketch(object):
+    '''
+    Log-binned quantile sketch for many buckets (the DDSketch scheme).
+
+    A value x != 0 falls into bin sign(x) * (ceil(log(|x|) / log(gamma)) + _OFFSET),
+    gamma = (1 + accuracy) / (1 - accuracy), and is represented by the bin
+    midpoint, so every quantile has a relative error of at most `accuracy`.
+    Zeros have a bin of their own and are exact. Only (bucket, bin) counts
+    are stored, so memory does not grow with the number of values, and two
+    sketches merge by adding counts.
+    '''
+    _OFFSET = 80000
+    _NBINS = 2 * _OFFSET + 1
+    # compact the stored counts when this many (bucket, bin) keys pile up
+    _COMPACT = 1 << 22
+
+    def __init__(self, nbuckets=1, accuracy=0.01):
+        self.nbuckets = nbuckets
+        self.accuracy = accuracy
+        self.log_gamma = math.log((1 + accuracy) / (1 - accuracy))
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.npending = 0
+
+    def _bins(self, vals=None):
+        bins = np.zeros(len(vals), dtype=np.int64)
+        nonzero = vals != 0
+        x = vals[nonzero]
+        idx = np.ceil(np.log(np.abs(x)) / self.log_gamma).astype(np.int64) + self._OFFSET // 2
+        bins[nonzero] = np.sign(x).astype(np.int64) * np.maximum(idx, 1)
+        return bins + self._OFFSET
+
+    def _value(self, bins=None):
+        signed = bins - self._OFFSET
+        idx = np.abs(signed) - self._OFFSET // 2
+        gamma = math.exp(self.log_gamma)
+        vals = 2 * np.exp(idx * self.log_gamma) / (gamma + 1)
+        return np.where(signed == 0, 0.0, np.sign(signed) * vals)
+
+    def add(self, buckets=None, vals=None):
+        keys, counts = np.unique(buckets * self._NBINS + self._bins(vals), return_counts=True)
+        self.pending.append((keys, counts))
+        self.npending += len(keys)
+        if self.npending > self._COMPACT:
+            self.compact()
+
+    def merge(self, other=None):
+        other.compact()
+        self.pending.append((other.keys, other.counts))
+        self.npending += len(other.keys)
+        if self.npending > self._COMPACT:
+            self.compact()
+        return self
+
+    def compact(self):
+        if not self.pending:
+            return
+        keys = np.concatenate([self.keys] + [k for k, c in self.pending])
+        counts = np.concatenate([self.counts] + [c for k, c in self.pending])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts).astype(np.int64)
+        self.pending = []
+        self.npending = 0
+
+    def remap(self, mapping=None, nbuckets=1):
+        '''
+        New sketch whose bucket mapping[b] holds the counts of bucket b;
+        buckets mapped to -1 are dropped.
+        '''
+        self.compact()
+        other = QuantileSketch(nbuckets, accuracy=self.accuracy)
+        buckets = mapping[self.keys // self._NBINS]
+        keep = buckets >= 0
+        other.pending.append((buckets[keep] * self._NBINS + self.keys[keep] % self._NBINS, self.counts[keep]))
+        other.compact()
+        return other
+
+    def values_at(self, count=None, ranks=None):
+        '''
+        Approximate value of 0-based rank ranks[b] in every bucket b (NaN
+        where the bucket is empty or the rank is negative); count holds the
+        bucket sizes.
+        '''
+        self.compact()
+        vals = np.full(self.nbuckets, np.nan)
+        has = (count > 0) & (ranks >= 0)
+        if not np.any(has):
+            return vals
+        cum = np.cumsum(self.counts)
+        before = (np.cumsum(count) - count)[has]
+        pos = np.searchsorted(cum, before + ranks[has], side='right')
+        vals[has] = self._value((self.keys % self._NBINS)[pos])
+        return vals
+
+    def medians(self, count=None):
+        '''
+        Approximate median of every bucket; count holds the bucket sizes.
+        '''
+        return (self.values_at(count, (count - 1) // 2) + self.values_at(count, count // 2)) / 2
+
+
+def _normalize_digits(acc=None):
+    '''
+    Propagate carries so that every digit but the last is in [0, 2**32).
+    A new top digit is appended while the last one is not small.
+    '''
+    while True:
+        for j in range(acc.shape[1] - 1):
+            carry = acc[:, j] >> _DIGIT
+            acc[:, j] -= carry << _DIGIT
+            acc[:, j + 1] += carry
+        if not np.any(np.abs(acc[:, -1]) >> _DIGIT):
+            return acc
+        acc = np.concatenate((acc, np.zeros((acc.shape[0], 1), dtype=np.int64)), axis=1)
+
+
+def _add_digits(k0_a=None, acc_a=None, k0_b=None, acc_b=None):
+    '''
+    Sum two digit arrays that may start at different digit positions.
+    '''
+    if acc_a is None:
+        return k0_b, acc_b.copy()
+    k0 = min(k0_a, k0_b)
+    end = max(k0_a + acc_a.shape[1], k0_b + acc_b.shape[1])
+    acc = np.zeros((acc_a.shape[0], end - k0), dtype=np.int64)
+    acc[:, k0_a - k0:k0_a - k0 + acc_a.shape[1]] += acc_a
+    acc[:, k0_b - k0:k0_b - k0 + acc_b.shape[1]] += acc_b
+    return k0, _normalize_digits(acc)
+
+
+# double-double arithmetic (Dekker, Knuth) on float64 arrays: a value is
+# hi + lo, for BucketStats.moments()
+
+def _two_sum(a, b):
+    s = a + b
+    v = s - a
+    return s, (a - (s - v)) + (b - v)
+
+
+def _split(a):
+    t = 134217729.0 * a  # 2**27 + 1
+    hi = t - (t - a)
+    return hi, a - hi
+
+
+def _two_prod(a, b):
+    p = a * b
+    a1, a2 = _split(a)
+    b1, b2 = _split(b)
+    return p, ((a1 * b1 - p) + a1 * b2 + a2 * b1) + a2 * b2
+
+
+def _dd_add(ah, al, bh, bl):
+    s, e = _two_sum(ah, bh)
+    t, f = _two_sum(al, bl)
+    s, e = _two_sum(s, e + t)
+    return _two_sum(s, e + f)
+
+
+def _dd_div(ah, al, b):
+    q = ah / b
+    p, e = _two_prod(q, b)
+    return _two_sum(q, (((ah - p) - e) + al) / b)
+
+
+def _dd_from_digits(k0=0, digits=None, scale=0):
+    '''
+    Return (hi, lo, magnitude, exact, ndigits): every row of a digit array
+    times 2**-scale in double-double, the sum of the absolute values of its
+    terms, False for the rows with a digit outside the normal float64
+    range and the number of digits summed.
+    '''
+    nrows = digits.shape[0]
+    used = np.nonzero(np.any(digits != 0, axis=0))[0]
+    if len(used):
+        k0 += int(used[0])
+        # one digit position per row
+        digits = np.ascontiguousarray(_normalize_digits(digits[:, used[0]:used[-1] + 1].copy()).T)
+    else:
+        digits = np.zeros((0, nrows))
+    hi, lo, magnitude = np.zeros(nrows), np.zeros(nrows), np.zeros(nrows)
+    exact = np.ones(nrows, dtype=bool)
+    for j in reversed(range(len(digits))):
+        e = _DIGIT * (k0 + j) - scale
+        if not -1000 < e < 960:
+            exact &= digits[j] == 0
+            continue
+        term = np.ldexp(digits[j].astype(np.float64), e)
+        hi, lo = _dd_add(hi, lo, term, 0.0)
+        magnitude += np.abs(term)
+    return hi, lo, magnitude, exact, len(digits)
+
+
+def _round_dd(hi=None, lo=None, error=None):
+    '''
+    Return (x, residual, decided): x = hi + lo rounded to float64, the
+    rest (hi + lo - x) and whether x is the rounding of every value within
+    `error` of hi + lo (no rounding boundary that close).
+    '''
+    x = hi + lo
+    residual = (hi - x) + lo
+    # the smaller of the two ulps around x
+    half_ulp = np.spacing(np.nextafter(np.abs(x), 0)) / 2
+    return x, residual, np.abs(residual) + error < half_ulp
+
+
+class BucketStats(object):
+    '''
+    Running min/max/mean/median/std for many buckets at once.
+
+    Values are added in batches as (bucket, value) arrays, so a caller can
+    stream a distance matrix once and send every distance to its group pair.
+    Sums are kept exactly (see digit_sums), so partial accumulators can be
+    merged in any order and still give the same result as one pass.
+
+    median: 'exact' keeps every value; 'approx' keeps a QuantileSketch, so
+    memory is bounded by the number of buckets; 'none' keeps nothing.
+    '''
+
+    def __init__(self, nbuckets=1, median='exact', accuracy=0.01):
+        if median not in MEDIAN_MODES:
+            raise ValueError('unknown median mode: {0}'.format(median))
+        self.nbuckets = nbuckets
+        self.median = median
+        self.count = np.zeros(nbuckets, dtype=np.int64)
+        self.minimum = np.full(nbuckets, np.inf)
+        self.maximum = np.full(nbuckets, -np.inf)
+        self.k0 = 0
+        self.sx = None
+        self.sxx = None
+        self.values = []
+        self.sketch = None
+        if median == 'approx':
+            self.sketch = QuantileSketch(nbuckets, accuracy=accuracy)
+
+    def add(self, buckets=None, vals=None):
+        buckets = np.asarray(buckets, dtype=np.int64)
+        vals = np.asarray(vals, dtype=np.float64)
+        if len(vals) == 0:
+            return
+        self.count += np.bincount(buckets, minlength=self.nbuckets)
+        np.minimum.at(self.minimum, buckets, vals)
+        np.maximum.at(self.maximum, buckets, vals)
+        k0, sx, sxx = digit_sums(keys=buckets, vals=vals, nkeys=self.nbuckets)
+        self._add_sums(k0, sx, sxx)
+        if self.median == 'exact':
+            self.values.append((buckets, vals))
+        elif self.median == 'approx':
+            self.sketch.add(buckets, vals)
+
+    def _add_sums(self, k0=0, sx=None, sxx=None):
+        # sx and sxx always start at the same digit position
+        self.sxx = _add_digits(self.k0, self.sxx, k0, sxx)[1]
+        self.k0, self.sx = _add_digits(self.k0, self.sx, k0, sx)
+
+    def merge(self, other=None):
+        '''
+        Add the contents of another BucketStats with the same buckets.
+        '''
+        self.count += other.count
+        np.minimum(self.minimum, other.minimum, out=self.minimum)
+        np.maximum(self.maximum, other.maximum, out=self.maximum)
+        if other.sx is not None:
+            self._add_sums(other.k0, other.sx, other.sxx)
+        if self.median == 'exact':
+            self.values.extend(other.values)
+        elif self.median == 'approx':
+            self.sketch.merge(other.sketch)
+        return self
+
+    def remap(self, mapping=None, nbuckets=1):
+        '''
+        New BucketStats of `nbuckets` buckets: bucket mapping[b] (an int
+        array, one entry per bucket) gets the contents of bucket b, merged
+        when several buckets map to it; buckets mapped to -1 are dropped.
+        '''
+        mapping = np.asarray(mapping, dtype=np.int64)
+        keep = mapping >= 0
+        target = mapping[keep]
+        other = BucketStats(nbuckets, median=self.median)
+        other.count = np.bincount(target, weights=self.count[keep], minlength=nbuckets).astype(np.int64)
+        np.minimum.at(other.minimum, target, self.minimum[keep])
+        np.maximum.at(other.maximum, target, self.maximum[keep])
+        if self.sx is not None:
+            other.k0 = self.k0
+            for name in ('sx', 'sxx'):
+                digits = getattr(self, name)
+                acc = np.zeros((nbuckets, digits.shape[1]), dtype=np.int64)
+                np.add.at(acc, target, digits[keep])
+                setattr(other, name, _normalize_digits(acc))
+        if self.median == 'exact':
+            for buckets, vals in self.values:
+                buckets = mapping[buckets]
+                kept = buckets >= 0
+                other.values.append((buckets[kept], vals[kept]))
+        elif self.median == 'approx':
+            other.sketch = self.sketch.remap(mapping, nbuckets)
+        return other
+
+    def moments(self):
+        '''
+        (mean, rest, m2) of every bucket as float64 arrays (0 for empty
+        buckets): the mean and the sum of squared deviations from it, each
+        rounded once from the exact sums, and mean + rest, the mean to about
+        twice the precision.
+
+        The sums are taken in double-double arithmetic, vectorized over the
+        buckets, with a bound on their error; only the buckets where the
+        bound does not decide the rounding (a value close to a rounding
+        boundary, or almost equal values) are computed from the exact sums
+        as Python ints.
+        '''
+        mean = np.zeros(self.nbuckets)
+        rest = np.zeros(self.nbuckets)
+        m2 = np.zeros(self.nbuckets)
+        has = self.count > 0
+        if not np.any(has):
+            return mean, rest, m2
+        n = self.count[has].astype(np.float64)
+        # overflows and NaN only occur in buckets left undecided
+        with np.errstate(over='ignore', invalid='ignore'):
+            s_hi, s_lo, s_mag, s_exact, s_digits = _dd_from_digits(self.k0, self.sx[has], _BIAS)
+            ss_hi, ss_lo, ss_mag, ss_exact, ss_digits = _dd_from_digits(self.k0, self.sxx[has], 2 * _BIAS)
+            # relative error of a double-double operation: below 2**-104
+            eps = 2.0 ** -100
+            s_err = s_mag * eps * max(s_digits, 1)
+            ss_err = ss_mag * eps * max(ss_digits, 1)
+
+            q_hi, q_lo = _dd_div(s_hi, s_lo, n)
+            q_err = s_err / n + np.abs(q_hi) * eps
+            mean_has, rest_has, mean_ok = _round_dd(q_hi, q_lo, q_err)
+
+            # m2 = SS - S**2 / n
+            p_hi, p_lo = _two_prod(s_hi, s_hi)
+            p_hi, p_lo = _two_sum(p_hi, p_lo + 2 * s_hi * s_lo)
+            t_hi, t_lo = _dd_div(p_hi, p_lo, n)
+            t_err = (2 * np.abs(s_hi) * s_err + s_err * s_err) / n + 2 * np.abs(t_hi) * eps
+            d_hi, d_lo = _dd_add(ss_hi, ss_lo, -t_hi, -t_lo)
+            m2_err = ss_err + t_err + (np.abs(ss_hi) + np.abs(t_hi)) * eps
+            m2_has, _, m2_ok = _round_dd(d_hi, d_lo, m2_err)
+
+        # a bucket of zeros: all sums are 0
+        zero = (s_mag == 0) & (ss_mag == 0) & s_exact & ss_exact
+        decided = zero | (mean_ok & m2_ok & (m2_has > 0) & s_exact & ss_exact)
+        mean[has] = np.where(decided, mean_has, 0.0)
+        rest[has] = np.where(decided, rest_has, 0.0)
+        m2[has] = np.where(decided, m2_has, 0.0)
+
+        for b in np.nonzero(has)[0][~decided].tolist():
+            n = int(self.count[b])
+            S = digits_to_int(self.k0, self.sx[b])
+            SS = digits_to_int(self.k0, self.sxx[b])
+            mean[b] = mean_from_sums(n, S)
+            # mean * 2**_BIAS is an integer, see _BIAS
+            num, den = float(mean[b]).as_integer_ratio()
+            rest[b] = mean_from_sums(n, S - n * (num << _BIAS) // den)
+            m2[b] = (n * SS - S * S) / (n << (2 * _BIAS))
+        return mean, rest, m2
+
+    def medians(self):
+        '''
+        Median of every bucket (NaN for empty buckets or median='none').
+        '''
+        if self.median == 'approx':
+            return self.sketch.medians(self.count)
+        medians = np.full(self.nbuckets, np.nan)
+        if not self.values:
+            return medians
+        buckets = np.concatenate([b for b, v in self.values])
+        vals = np.concatenate([v for b, v in self.values])
+        order = np.lexsort((vals, buckets))
+        vals = vals[order]
+        starts = np.concatenate(([0], np.cumsum(self.count)[:-1]))
+        has = self.count > 0
+        lower = vals[(starts + (self.count - 1) // 2)[has]]
+        upper = vals[(starts + self.count // 2)[has]]
+        medians[has] = (lower + upper) / 2
+        return medians
+
+    def results(self, weight=1, medians=None):
+        '''
+        Return {bucket: (min, max, mean, median, std)} for non-empty buckets.
+
+        weight: as in stat_dist(). medians: medians of the buckets computed
+        elsewhere, instead of those of the median mode.
+        '''
+        if medians is None:
+            medians = self.medians()
+        results = {}
+        for b in np.nonzero(self.count)[0].tolist():
+            n = int(self.count[b])
+            S = digits_to_int(self.k0, self.sx[b])
+            SS = digits_to_int(self.k0, self.sxx[b])
+            med = 'NA.' if np.isnan(medians[b]) else float(medians[b])
+            results[b] = (float(self.minimum[b]), float(self.maximum[b]),
+                mean_from_sums(n, S), med,
+                stdev_from_sums(n, S, SS, weight=weight))
+        return results
+
+
+def weighted_medians(buckets=None, vals=None, weights=None, nbuckets=1):
+    '''
+    Weighted median of every bucket (NaN for empty buckets): the mean of the
+    smallest value whose cumulative weight reaches half of the bucket weight
+    and of the smallest one whose cumulative weight exceeds it. With equal
+    weights, the same as `statistics.median()`.
+    '''
+    medians = np.full(nbuckets, np.nan)
+    if len(vals) == 0:
+        return medians
+    order = np.lexsort((vals, buckets))
+    buckets, vals = buckets[order], vals[order]
+    total = np.bincount(buckets, weights=weights[order], minlength=nbuckets)
+    # every bucket weighs 1, so rounding does not grow with the others
+    cum = np.cumsum(weights[order] / total[buckets])
+    count = np.bincount(buckets, minlength=nbuckets)
+    has = count > 0
+    starts = (np.cumsum(count) - count)[has]
+    ends = starts + count[has] - 1
+    half = np.where(starts > 0, cum[np.maximum(starts - 1, 0)], 0.0) + 0.5
+    lower = np.clip(np.searchsorted(cum, half - 1e-9, side='left'), starts, ends)
+    upper = np.clip(np.searchsorted(cum, half + 1e-9, side='right'), starts, ends)
+    medians[has] = (vals[lower] + vals[upper]) / 2
+    return medians
+
+
+class WeightedStats(object):
+    '''
+    Per-bucket statistics of several BucketStats (one per gene) merged with
+    a weight per gene: within a bucket, a gene of weight w and n values
+    gives every value the weight w / n.
+
+    Count, minimum and maximum are those of all values. The mean is the
+    weighted mean of the gene means, the median the weighted median of the
+    values (of the sketch bins for median='approx') and the standard
+    deviation sqrt(weighted variance * N / (N - 1)), N the count; with
+    weights proportional to the gene counts, all are those of the pooled
+    values. The mean (to about twice the float64 precision) and sum of
+    squared deviations of every gene are rounded from its exact sums
+    (BucketStats.moments), the mean taken relative to the first gene mean
+    of the bucket, then merged gene by gene in float64 (Chan et al.), so
+    tight groups lose no precision, but the result is not exact to the
+    last bit as that of BucketStats is.
+
+    Memory: O(buckets) for median 'none', sketch bins of all buckets for
+    'approx', all values for 'exact'.
+    '''
+
+    def __init__(self, nbuckets=1, median='exact', accuracy=0.01):
+        if median not in MEDIAN_MODES:
+            raise ValueError('unknown median mode: {0}'.format(median))
+        self.nbuckets = nbuckets
+        self.median = median
+        self.count = np.zeros(nbuckets, dtype=np.int64)
+        self.minimum = np.full(nbuckets, np.inf)
+        self.maximum = np.full(nbuckets, -np.inf)
+        self.weight = np.zeros(nbuckets)
+        # mean - shift; shift: the mean of the first gene of the bucket
+        self.shift = np.zeros(nbuckets)
+        self.mean = np.zeros(nbuckets)
+        self.m2 = np.zeros(nbuckets)
+        # (buckets, values, weights), or (sketch keys, weights) for 'approx'
+        self.values = []
+        self.npending = 0
+        self.sketch = None
+        if median == 'approx':
+            self.sketch = QuantileSketch(nbuckets, accuracy=accuracy)
+
+    def add(self, stats=None, weight=1.0, moments=None):
+        '''
+        Add the BucketStats of one gene with its weight; moments: its
+        stats.moments(), if already computed (in a worker process).
+        '''
+        has = stats.count > 0
+        if not np.any(has):
+            return
+        if moments is None:
+            moments = stats.moments()
+        mean, rest, m2 = moments
+        n = np.where(has, stats.count, 1)
+        first = has & (self.weight == 0)
+        self.shift[first] = mean[first]
+        # mean - shift is exact for a mean within a factor 2 of the shift
+        mean = (mean - self.shift) + rest
+        w = np.where(has, float(weight), 0.0)
+        total = self.weight + w
+        frac = w / np.where(total > 0, total, 1.0)
+        delta = mean - self.mean
+        self.m2 += w * m2 / n + delta * delta * self.weight * frac
+        self.mean += delta * frac
+        self.weight = total
+        self.count += stats.count
+        np.minimum(self.minimum, stats.minimum, out=self.minimum)
+        np.maximum(self.maximum, stats.maximum, out=self.maximum)
+
+        value_weight = w / n
+        if self.median == 'exact':
+            for buckets, vals in stats.values:
+                self.values.append((buckets, vals, value_weight[buckets]))
+        elif self.median == 'approx':
+            sketch = stats.sketch
+            sketch.compact()
+            self.values.append((sketch.keys, sketch.counts * value_weight[sketch.keys // sketch._NBINS]))
+            self.npending += len(sketch.keys)
+            if self.npending > QuantileSketch._COMPACT:
+                self._compact()
+
+    def _compact(self):
+        keys = np.concatenate([k for k, w in self.values])
+        weights = np.concatenate([w for k, w in self.values])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        self.values = [(keys, np.bincount(inverse, weights=weights))]
+        self.npending = len(keys)
+
+    def medians(self):
+        if self.median == 'none' or not self.values:
+            return np.full(self.nbuckets, np.nan)
+        if self.median == 'approx':
+            self._compact()
+            keys, weights = self.values[0]
+            nbins = self.sketch._NBINS
+            return weighted_medians(keys // nbins, self.sketch._value(keys % nbins), weights, self.nbuckets)
+        return weighted_medians(
+            np.concatenate([b for b, v, w in self.values]),
+            np.concatenate([v for b, v, w in self.values]),
+            np.concatenate([w for b, v, w in self.values]),
+            self.nbuckets)
+
+    def results(self):
+        '''
+        Return {bucket: (min, max, mean, median, std)} for non-empty buckets.
+        '''
+        medians = self.medians()
+        results = {}
+        for b in np.nonzero(self.count)[0].tolist():
+            n = int(self.count[b])
+            med = 'NA.' if np.isnan(medians[b]) else float(medians[b])
+            std = math.sqrt(self.m2[b] / self.weight[b] * n / (n - 1)) if n >= 2 else 'NA.'
+            results[b] = (float(self.minimum[b]), float(self.maximum[b]),
+                float(self.shift[b] + self.mean[b]), med, std)
+        return results
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+'''
+In-process pairwise DNA distances, following ape's `dist.dna()`.
+
+Sequences are encoded as uint8 arrays of 4-bit IUPAC masks (A=1, C=2,
+G=4, T=8, ambiguity codes are the OR of their bases, gaps and unknown
+characters are 0). A site is a known base when exactly one bit is set,
+which is what ape's `KnownBase()` tests.
+
+Supported models: see NATIVE_MODELS. Without `pairwise_deletion`, the
+sites with a gap or an ambiguous base in any sequence are removed first
+(ape's global deletion); with it, each pair only uses the sites where both
+sequences have a known base. Base frequencies (F81, T92, TN93) are taken
+from the whole alignment before any deletion, as `base.freq()` does.
+'''
+import re
+import numpy as np
+
+
+NATIVE_MODELS = ("raw", "N", "TS", "TV", "JC69", "K80", "F81", "T92", "TN93")
+
+IUPAC = {
+    'A': 1, 'C': 2, 'G': 4, 'T': 8, 'U': 8,
+    'R': 5, 'Y': 10, 'S': 6, 'W': 9, 'K': 12, 'M': 3,
+    'B': 14, 'D': 13, 'H': 11, 'V': 7, 'N': 15,
+}
+
+_CODE = np.zeros(256, dtype=np.uint8)
+for _base, _mask in IUPAC.items():
+    _CODE[ord(_base)] = _mask
+    _CODE[ord(_base.lower())] = _mask
+
+# number of bases in each 4-bit mask
+_NBASES = np.array([bin(i).count('1') for i in range(16)], dtype=np.uint8)
+
+PURINES = 5       # A|G
+PYRIMIDINES = 10  # C|T
+
+
+def encode_seq(seq=''):
+    return _CODE[np.frombuffer(seq.encode('ascii', 'replace'), dtype=np.uint8)]
+
+
+def _read_fasta(fh):
+    seqids = []
+    seqs = []
+    for line in fh:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('>'):
+            seqids.append(line[1:].strip())
+            seqs.append([])
+        else:
+            seqs[-1].append(line)
+    return seqids, [''.join(s) for s in seqs]
+
+
+def _read_phylip(fh, interleaved=False):
+    lines = [line.strip() for line in fh]
+    lines = [line for line in lines if line]
+    n, s = [int(x) for x in lines[0].split()[:2]]
+    seqids = []
+    seqs = []
+    i = 1
+    if interleaved:
+        for line in lines[1:n + 1]:
+            seqid, seq = (line.split(None, 1) + [''])[:2]
+            seqids.append(seqid)
+            seqs.append([re.sub(r'\s+', '', seq)])
+        for k, line in enumerate(lines[n + 1:]):
+            seqs[k % n].append(re.sub(r'\s+', '', line))
+    else:
+        for k in range(n):
+            seqid, seq = (lines[i].split(None, 1) + [''])[:2]
+            seq = re.sub(r'\s+', '', seq)
+            i += 1
+            while len(seq) < s:
+                seq += re.sub(r'\s+', '', lines[i])
+                i += 1
+            seqids.append(seqid)
+            seqs.append([seq])
+    return seqids, [''.join(s) for s in seqs]
+
+
+def _read_clustal(fh):
+    seqids = []
+    seqs = {}
+    for line in fh:
+        if line.startswith('CLUSTAL') or not line.strip() or line[0].isspace():
+            continue
+        fields = line.split()
+        seqid = fields[0]
+        if seqid not in seqs:
+            seqids.append(seqid)
+            seqs[seqid] = []
+        seqs[seqid].append(fields[1])
+    return seqids, [''.join(seqs[seqid]) for seqid in seqids]
+
+
+def read_msa(msa_file=None, msa_format='fasta'):
+    '''
+    Read an alignment in one of the `-msa_format` formats.
+
+    Return (seqids, seqs) where seqs is an (n, s) uint8 array of IUPAC masks.
+    '''
+    with open(msa_file, 'r') as fh:
+        if msa_format == 'fasta':
+            seqids, seqs = _read_fasta(fh)
+        elif msa_format == 'sequential':
+            seqids, seqs = _read_phylip(fh, interleaved=False)
+        elif msa_format == 'interleaved':
+            seqids, seqs = _read_phylip(fh, interleaved=True)
+        elif msa_format == 'clustal':
+            seqids, seqs = _read_clustal(fh)
+        else:
+            raise ValueError('unknown MSA format: {0}'.format(msa_format))
+
+    lengths = set(len(seq) for seq in seqs)
+    if len(lengths) > 1:
+        raise ValueError('{0}: sequences are not aligned'.format(msa_file))
+    return seqids, np.array([encode_seq(seq) for seq in seqs], dtype=np.uint8).reshape(len(seqs), -1)
+
+
+def base_freq(seqs=None):
+    '''
+    Frequencies of A, C, G and T over the whole alignment.
+    '''
+    counts = np.array([np.count_nonzero(seqs == mask) for mask in (1, 2, 4, 8)], dtype=np.float64)
+    return counts / counts.sum()
+
+
+def pair_counts(seqs=None, pairwise_deletion=False):
+    '''
+    Site counts of every pair of sequences, each an (n, n) int64 array:
+
+    L: sites compared, Nd: differences, Ns1: A<->G transitions,
+    Ns2: C<->T transitions.
+    '''
+    known = _NBASES[seqs] == 1
+    if not pairwise_deletion:
+        keep = np.all(known, axis=0)
+        seqs = seqs[:, keep]
+        known = known[:, keep]
+
+    n = seqs.shape[0]
+    counts = {name: np.zeros((n, n), dtype=np.int64) for name in ('L', 'Nd', 'Ns1', 'Ns2')}
+    for i in range(n - 1):
+        other = seqs[i + 1:]
+        both = known[i + 1:] & known[i]
+        diff = both & (other != seqs[i])
+        union = other | seqs[i]
+        row = {
+            'L': both.sum(axis=1),
+            'Nd': diff.sum(axis=1),
+            'Ns1': (diff & (union == PURINES)).sum(axis=1),
+            'Ns2': (diff & (union == PYRIMIDINES)).sum(axis=1),
+        }
+        for name, vals in row.items():
+            counts[name][i, i + 1:] = vals
+            counts[name][i + 1:, i] = vals
+    return counts
+
+
+def model_distance(counts=None, model='K80', bf=None):
+    '''
+    Apply an evolutionary model to the site counts of pair_counts().
+    '''
+    # identical sequences give -c * log(1) == -0.0 with the log-corrected
+    # models; ape writes 0
+    return _model_distance(counts, model, bf) + 0.0
+
+
+def _model_distance(counts=None, model='K80', bf=None):
+    L = counts['L'].astype(np.float64)
+    Nd = counts['Nd'].astype(np.float64)
+    Ns = (counts['Ns1'] + counts['Ns2']).astype(np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if model == 'N':
+            return Nd
+        if model == 'TS':
+            return Ns
+        if model == 'TV':
+            return Nd - Ns
+
+        p = Nd / L
+        if model == 'raw':
+            return p
+        if model == 'JC69':
+            return -0.75 * np.log(1 - 4 * p / 3)
+
+        P = Ns / L
+        Q = (Nd - Ns) / L
+        if model == 'K80':
+            a1 = 1 - 2 * P - Q
+            a2 = 1 - 2 * Q
+            return -0.5 * np.log(a1 * np.sqrt(a2))
+        if model == 'F81':
+            E = 1 - np.sum(bf * bf)
+            return -E * np.log(1 - p / E)
+        if model == 'T92':
+            wg = 2 * (bf[1] + bf[2]) * (1 - (bf[1] + bf[2]))
+            a1 = 1 - P / wg - Q
+            a2 = 1 - 2 * Q
+            return -wg * np.log(a1) - 0.5 * (1 - wg) * np.log(a2)
+        if model == 'TN93':
+            gR = bf[0] + bf[2]
+            gY = bf[1] + bf[3]
+            k1 = 2 * bf[0] * bf[2] / gR
+            k2 = 2 * bf[1] * bf[3] / gY
+            k3 = 2 * (gR * gY - bf[0] * bf[2] * gY / gR - bf[1] * bf[3] * gR / gY)
+            P1 = counts['Ns1'] / L
+            P2 = counts['Ns2'] / L
+            w1 = 1 - P1 / k1 - Q / (2 * gR)
+            w2 = 1 - P2 / k2 - Q / (2 * gY)
+            w3 = 1 - Q / (2 * gR * gY)
+            return -k1 * np.log(w1) - k2 * np.log(w2) - k3 * np.log(w3)
+
+    raise ValueError('model {0} is not available in-process, use Rscript'.format(model))
+
+
+def dist_dna(seqs=None, model='K80', pairwise_deletion=False):
+    '''
+    Pairwise distance matrix of an encoded alignment (zero diagonal).
+    '''
+    if model not in NATIVE_MODELS:
+        raise ValueError('model {0} is not available in-process, use Rscript'.format(model))
+    bf = base_freq(seqs)
+    matrix = model_distance(pair_counts(seqs, pairwise_deletion), model=model, bf=bf)
+    np.fill_diagonal(matrix, 0)
+    return matrix
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import sys
+import timings
 
 
 
@@ -16,14 +17,16 @@ The genus and species must be seperated by '_'.
 lines start with '#' will also be output.
 
 
-python3 {0} <between-group.dist>
+python3 {0} <between-group.dist> [-timings <file>] [-profile <prefix>]
 '''.format(sys.argv[0])
 
-    if len(sys.argv) != 2:
+    argv, timings_f, profile = timings.pop_arguments(sys.argv)
+
+    if len(argv) != 2:
         sys.exit(usage)
 
-    d_f = sys.argv[1]
-    with open(d_f, 'r') as fh:
+    d_f = argv[1]
+    with timings.profiled(profile), timings.stage('filter'), open(d_f, 'r') as fh:
         for i in fh:
             i = i.strip()
             if i.startswith('#'):
@@ -36,6 +39,9 @@ python3 {0} <between-group.dist>
             if g_1 == g_2 and col_1 != col_2 :
                 print(i)
 
+    if timings_f:
+        timings.write(timings_f)
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
-import re
-from mglcmdtools import csv2dict
 import statistics
 import argparse
 import sys
 import subprocess
 import os
 import math
+import hashlib
+import dist_engine
+import dist_matrix
+import dist_cache
+import dist_csv
+import dna_dist
+import dist_output
+import group_matrix
+import dist_resample
+import barcode_gap
+import dist_sparse
+import supermatrix
+import timings
+from alignment import PackedAlignment
+from group_index import GroupIndex, read_pairs
+from dist_stats import MEDIAN_MODES
 
 def get_para():
     description = '''
@@ -27,7 +41,7 @@ Copyright Guanliang Meng (linzhi2012'@'gmail'.'com)
         help='MSA format [%(default)s]')
 
     parser.add_argument('-pairwise_dist', metavar='<file>', required=False,
-        help='file of pairwise genetic distance matrix')
+        help='file of pairwise genetic distance matrix, csv or binary .npy (see convert_dist_matrix.py)')
 
     parser.add_argument('-group_definition', metavar='<file>', required=True,
         help='File format: seqid groupName')
@@ -49,20 +63,159 @@ Copyright Guanliang Meng (linzhi2012'@'gmail'.'com)
 "BH87", "T92", "TN93", "GG95", "logdet", "paralin", "indel", "indelblock"],
         help='Evolutionary model [%(default)s]')
 
+    parser.add_argument('-dist_engine', default="R", choices=["R", "native"],
+        help='''how to compute distances from `-msa_file`. R: Rscript with ape
+dist.dna(), written to <msa_file>.csv; native: in-process NumPy implementation,
+no csv file, models: {0}. [%(default)s]'''.format(', '.join(dna_dist.NATIVE_MODELS)))
+
+    parser.add_argument('-max_memory', metavar='<MB>', type=float, required=False,
+        help='''chunked mode for matrices larger than memory: the matrix is read
+(or computed with -dist_engine native) row block by row block, each block
+taking about this much memory, and the statistics are updated per block as
+with -engine stream. -median exact still keeps every distance (16 bytes
+each); use -median approx or none to bound memory. A matrix computed
+here is not added to -cache_dir.''')
+
+    parser.add_argument('-cache_dir', metavar='<dir>', required=False,
+        help='''cache of distance matrices computed from `-msa_file`, keyed by
+the content of the alignment, -msa_format, -model, -pairwise_deletion and
+-dist_engine. A run with the same inputs loads the matrix instead of
+computing it (no csv file is written then).''')
+
+    parser.add_argument('-engine', default="numpy", choices=["numpy", "stream", "dict"],
+        help='''numpy: dense matrix and integer group codes; stream: one pass over
+the upper triangle with per-group-pair running statistics, cost independent of
+the number of groups ("excluding" messages are printed once per pair); dict: the
+original nested-dictionary scan. All print the same statistics; a seqid listed
+under several groups counts in each of them. [%(default)s]''')
+
+    parser.add_argument('-median', default="exact", choices=MEDIAN_MODES,
+        help='''exact: keep all values; approx: quantile sketch with 1%% relative
+error and bounded memory; none: do not compute medians (printed as NA.).
+The dict engine is always exact. [%(default)s]''')
+
+    parser.add_argument('-out_format', default="text", choices=dist_output.OUT_FORMATS,
+        help='''text: tab-separated lines; npz, parquet (needs pyarrow) or hdf5 (needs
+h5py): typed columns (group codes, counts, float64 statistics) and, for the
+between-groups output, the group x group mean distance matrix, written to the
+`-b_o` and `-i_o` files, see dist_output.py [%(default)s]''')
+
+    group_matrix.add_arguments(parser)
+
+    parser.add_argument('-pairs', metavar='<file>', required=False,
+        help='only compute these group pairs of the between-groups output (two group names per line)')
+
+    parser.add_argument('-congeneric_only', action='store_true',
+        help='''only compute between-groups pairs of the same genus (group names
+as Genus_species, see get_congenic_stat.py) [%(default)s]''')
+
+    parser.add_argument('-match', metavar='<str>', nargs='+', required=False,
+        help='''only compute between-groups pairs whose two group names both contain
+one of these strings (see pick_lines_with_specified_element_only.py)''')
+
+    parser.add_argument('-sparse_store', metavar='<file>', required=False,
+        help='''sparse mode for very large matrices: only the pairs up to
+`-sparse_cutoff` are stored (CSR) in this file, the others are counted per
+group pair; the matrix is read in row blocks (`-max_memory`). Without
+`-msa_file`/`-pairwise_dist`, the statistics are computed from an existing
+store, built with the same `-group_definition`, `-max_dist`, `-sparse_cutoff`
+and `-median`. Medians can become approximate, see dist_sparse.py''')
+
+    parser.add_argument('-sparse_cutoff', metavar='<float>', type=float, required=False,
+        help='largest distance kept by -sparse_store [the -max_dist value]')
+
+    parser.add_argument('-barcode_gap', metavar='<file>', type=argparse.FileType('w'),
+        required=False, help='''write the largest within-group and smallest between-group
+distance (nearest neighbour) of every specimen and group, and their gap, see
+barcode_gap.py''')
+
+    parser.add_argument('-bootstrap', metavar='<int>', type=int, default=0,
+        help='''number of bootstrap replicates (specimens resampled within groups)
+of the mean within- and between-group distances, written to `-r_o`, see
+dist_resample.py [%(default)s]''')
+
+    parser.add_argument('-permutations', metavar='<int>', type=int, default=0,
+        help='''number of permutations of the group labels to test the gap between
+the between-group mean and the within-group means, written to `-r_o` [%(default)s]''')
+
+    parser.add_argument('-confidence', metavar='<float>', type=float, default=0.95,
+        help='level of the bootstrap percentile intervals [%(default)s]')
+
+    parser.add_argument('-seed', metavar='<int>', type=int, required=False,
+        help='random seed of -bootstrap and -permutations')
+
+    parser.add_argument('-processes', metavar='<int>', type=int, default=1,
+        help='number of processes for the -bootstrap and -permutations replicates [%(default)s]')
+
+    parser.add_argument('-r_o', metavar='<file>', type=argparse.FileType('w'),
+        default=sys.stdout, help='output of -bootstrap and -permutations')
+
     parser.add_argument('-pairwise_deletion', action='store_true',
         help='''a logical indicating whether to delete the sites with missing data in a pairwise
 way. The default is to delete the sites with at least one missing data for all
 sequences (ignored if model = "indel" or "indelblock"). [%(default)s]''')
 
+    timings.add_arguments(parser)
+
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit()
 
     args = parser.parse_args()
 
-    if not args.pairwise_dist and not args.msa_file:
+    if not args.pairwise_dist and not args.msa_file and not args.sparse_store:
         sys.exit('You must specify either `-msa_file` or `-pairwise_dist`!')
 
+    if args.sparse_store:
+        if args.engine == 'dict':
+            sys.exit('`-sparse_store` needs `-engine numpy` or `-engine stream`!')
+        if args.barcode_gap or args.bootstrap or args.permutations:
+            sys.exit('`-barcode_gap`, `-bootstrap` and `-permutations` need the whole matrix, not `-sparse_store`!')
+        if not args.pairwise_dist and not args.msa_file and not os.path.exists(args.sparse_store):
+            sys.exit('{0}: no such sparse store!'.format(args.sparse_store))
+
+    if args.msa_file and args.dist_engine == 'native':
+        if args.model not in dna_dist.NATIVE_MODELS:
+            sys.exit('`-dist_engine native` supports the models: ' + ', '.join(dna_dist.NATIVE_MODELS))
+        if args.engine == 'dict':
+            sys.exit('`-engine dict` needs `-dist_engine R`!')
+
+    if args.engine == 'dict' and (args.pairs or args.congeneric_only or args.match):
+        sys.exit('`-pairs`, `-congeneric_only` and `-match` need `-engine numpy` or `-engine stream`!')
+
+    if args.engine == 'dict' and args.max_memory:
+        sys.exit('`-max_memory` needs `-engine numpy` or `-engine stream`!')
+
+    if args.engine == 'dict' and args.cache_dir:
+        sys.exit('`-cache_dir` needs `-engine numpy` or `-engine stream`!')
+
+    if args.engine == 'dict' and args.pairwise_dist and dist_matrix.is_binary_matrix(args.pairwise_dist):
+        sys.exit('`-engine dict` needs a csv `-pairwise_dist`!')
+
+    if args.engine == 'dict' and args.barcode_gap:
+        sys.exit('`-barcode_gap` needs `-engine numpy` or `-engine stream`!')
+
+    if args.engine == 'dict' and args.matrix_prefix:
+        sys.exit('`-matrix_prefix` needs `-engine numpy` or `-engine stream`!')
+
+    if args.bootstrap < 0 or args.permutations < 0:
+        sys.exit('`-bootstrap` and `-permutations` must not be negative!')
+
+    if args.bootstrap or args.permutations:
+        if args.engine == 'dict' or args.max_memory:
+            sys.exit('`-bootstrap` and `-permutations` need `-engine numpy` or `-engine stream` without `-max_memory`!')
+        if not 0 < args.confidence < 1:
+            sys.exit('`-confidence` must be between 0 and 1!')
+
+    if args.out_format != 'text':
+        if args.engine == 'dict':
+            sys.exit('`-out_format {0}` needs `-engine numpy` or `-engine stream`!'.format(args.out_format))
+        if args.b_o is sys.stdout or args.i_o is sys.stdout:
+            sys.exit('`-out_format {0}` needs `-b_o` and `-i_o` files!'.format(args.out_format))
+        message = dist_output.missing_dependency(args.out_format)
+        if message:
+            sys.exit(message)
+
     return args
 
 
@@ -108,11 +261,15 @@ M <- dist.dna(a, model = "{model}", pairwise.deletion = {pairwise_deletion_val},
 write.csv(M, file=myArgs[2])
     '''.format(msa_format=msa_format, model=model, pairwise_deletion_val=pairwise_deletion_val)
 
-    tmp_file = 'tmp_get_dist_pairwise_matrix.R'
+    # one script per setting: a script left by a run with another -model
+    # must not be reused
+    digest = hashlib.sha256(script.encode('utf-8')).hexdigest()[:12]
+    tmp_file = 'tmp_get_dist_pairwise_matrix.{0}.R'.format(digest)
     if not os.path.exists(tmp_file):
-        with open(tmp_file, 'w') as fhout:
+        with open(tmp_file + '.' + str(os.getpid()), 'w') as fhout:
             fhout.write(script)
-    
+        os.replace(tmp_file + '.' + str(os.getpid()), tmp_file)
+
     return tmp_file
 
 
@@ -126,21 +283,6 @@ def get_dist_pairwise_matrix(msa_file=None, R_script=None):
     return matrix_file
 
 
-def get_seqid_group(infile=None, delimiter=r'\s+'):
-    seqid_group = {}
-    group_seqid = {}
-    with open(infile, 'r') as fh:
-        for i in fh:
-            i = i.strip()
-            seqid, group = re.split(delimiter, i, maxsplit=1)
-            seqid_group[seqid] = group
-            if group not in group_seqid:
-                group_seqid.setdefault(group, [])
-            group_seqid[group].append(seqid)
-
-    return seqid_group, group_seqid
-
-
 def get_members_of_specific_group(mdict=None, group_seqid=None, group=None):
     items = []
     for key1 in mdict:
@@ -212,60 +354,478 @@ def dist_between_groups(mdict=None, group_seqid=None, out_handle=None, max_dist=
             print(group1, group2, '\t'.join(line), sep='\t', file=out_handle)
 
 
-def filter_not_existing_groups(triu_dict=None, seqid_group=None, group_seqid=None):
-    # delete some seqids
-    filtered_group_seqid = {}
-    for group in group_seqid:
-        for seqid in group_seqid[group]:
-            if seqid in triu_dict:
-                if group not in filtered_group_seqid:
-                    filtered_group_seqid.setdefault(group, [])
-                filtered_group_seqid[group].append(seqid)
-            else:
-                # discard
-                pass
+def read_matrix(msa_file=None, pairwise_dist=None, msa_format='fasta', model='K80',
+    pairwise_deletion=False, native=False, cache_dir=None, reuse_buffer=False,
+    site_counts=False):
+    '''
+    Return (seqids, matrix) of a gene, from `-msa_file` (Rscript, or the
+    in-process engine if native) or from a `-pairwise_dist` csv file or
+    binary `.npy` matrix (see dist_matrix.py, memory-mapped). Seqids are in
+    file order.
 
-    return filtered_group_seqid
+    reuse_buffer=True parses csv files into the array of the previous call
+    (see dist_csv.py).
 
+    With cache_dir, a matrix computed from `msa_file` is stored there (see
+    dist_cache.py) and later runs on the same alignment and settings load
+    it instead of computing it again.
 
+    site_counts=True (with msa_file): return (seqids, matrix, counts),
+    counts the supermatrix.gene_counts() of the alignment, taken from the
+    distance computation if native, else counted (or read from the cache).
+    '''
+    if msa_file and site_counts and not native:
+        seqids, matrix = read_matrix(msa_file, pairwise_dist, msa_format, model,
+            pairwise_deletion, native, cache_dir, reuse_buffer)
+        return seqids, matrix, supermatrix.read_gene_counts(msa_file, msa_format, pairwise_deletion, cache_dir)
+
+    if msa_file and cache_dir:
+        key = dist_cache.cache_key(
+            msa_file=msa_file,
+            msa_format=msa_format,
+            model=model,
+            pairwise_deletion=pairwise_deletion,
+            dist_engine='native' if native else 'R')
+        with timings.stage('cache'):
+            cached = dist_cache.load(cache_dir, key)
+        if cached is not None:
+            if site_counts:
+                return cached + (supermatrix.read_gene_counts(msa_file, msa_format, pairwise_deletion, cache_dir),)
+            return cached
+        counts_key = dist_cache.counts_key(msa_file, msa_format, pairwise_deletion)
+        counts = dist_cache.load_counts(cache_dir, counts_key) if site_counts else None
+        if counts is not None:
+            # native: the distances of the cached counts
+            with timings.stage('dist'):
+                matrix = supermatrix.counts_dist_dna(counts[1], counts[2], model)
+            with timings.stage('cache', items=len(counts[0])):
+                dist_cache.store(cache_dir, key, counts[0], matrix)
+            return counts[0], matrix, counts
+        result = read_matrix(
+            msa_file=msa_file,
+            msa_format=msa_format,
+            model=model,
+            pairwise_deletion=pairwise_deletion,
+            native=native,
+            reuse_buffer=reuse_buffer,
+            site_counts=site_counts)
+        with timings.stage('cache', items=len(result[0])):
+            dist_cache.store(cache_dir, key, result[0], result[1])
+            if site_counts:
+                dist_cache.store_counts(cache_dir, counts_key, *result[2])
+        return result
+
+    if msa_file and native:
+        with timings.stage('dist'):
+            aln = PackedAlignment.read(msa_file=msa_file, msa_format=msa_format)
+            if site_counts:
+                matrix, counts = aln.dist_and_counts(model=model, pairwise_deletion=pairwise_deletion)
+                return aln.seqids, matrix, (aln.seqids, counts, aln.base_counts())
+            return aln.seqids, aln.dist_dna(model=model, pairwise_deletion=pairwise_deletion)
+
+    if pairwise_dist and dist_matrix.is_binary_matrix(pairwise_dist):
+        with timings.stage('parse'):
+            return dist_matrix.load_matrix(pairwise_dist)
+
+    if msa_file:
+        R_script = write_R_tmp_script(
+            msa_format=msa_format,
+            model=model,
+            pairwise_deletion=pairwise_deletion)
+        with timings.stage('rscript'):
+            pairwise_dist = get_dist_pairwise_matrix(msa_file=msa_file, R_script=R_script)
+
+    with timings.stage('parse'):
+        try:
+            return dist_csv.read_dist_csv(pairwise_dist, reuse_buffer=reuse_buffer)
+        except ValueError as e:
+            sys.exit(str(e))
+
+
+def read_blocks(msa_file=None, pairwise_dist=None, msa_format='fasta', model='K80',
+    pairwise_deletion=False, native=False, cache_dir=None, max_memory=1024):
+    '''
+    Return (seqids, blocks) like read_matrix(), but the distances come as
+    (i0, matrix[i0:i1, i0 + 1:]) row blocks (see dist_engine.accumulate_blocks)
+    sized so that one block takes about max_memory MB. The matrix is never
+    held whole: csv files are parsed block by block, binary and cached
+    matrices are memory-mapped and native distances are computed per block.
+    '''
+    def block_rows(n):
+        return dist_engine.block_rows_for(n, int(max_memory * 2**20) // dist_engine.BLOCK_BYTES_PER_CELL)
+
+    if msa_file and cache_dir:
+        key = dist_cache.cache_key(
+            msa_file=msa_file,
+            msa_format=msa_format,
+            model=model,
+            pairwise_deletion=pairwise_deletion,
+            dist_engine='native' if native else 'R')
+        cached = dist_cache.load(cache_dir, key)
+        if cached is not None:
+            seqids, matrix = cached
+            return seqids, dist_engine.iter_upper_blocks(matrix, block_rows(len(seqids)))
+
+    if msa_file and native:
+        aln = PackedAlignment.read(msa_file=msa_file, msa_format=msa_format)
+        blocks = aln.iter_upper_blocks(model=model, pairwise_deletion=pairwise_deletion,
+            block_rows=block_rows(len(aln.seqids)))
+        return aln.seqids, blocks
+
+    if pairwise_dist and dist_matrix.is_binary_matrix(pairwise_dist):
+        seqids, matrix = dist_matrix.load_matrix(pairwise_dist)
+        return seqids, dist_engine.iter_upper_blocks(matrix, block_rows(len(seqids)))
+
+    if msa_file:
+        R_script = write_R_tmp_script(
+            msa_format=msa_format,
+            model=model,
+            pairwise_deletion=pairwise_deletion)
+        with timings.stage('rscript'):
+            pairwise_dist = get_dist_pairwise_matrix(msa_file=msa_file, R_script=R_script)
+
+    try:
+        seqids, blocks = dist_csv.read_blocks(pairwise_dist, block_rows=block_rows)
+    except ValueError as e:
+        sys.exit(str(e))
+    return seqids, csv_blocks(blocks)
+
+
+def csv_blocks(blocks=None):
+    '''
+    The blocks of dist_csv.read_blocks(); a malformed row found while they
+    are parsed exits with its message.
+    '''
+    try:
+        for block in blocks:
+            yield block
+    except ValueError as e:
+        sys.exit(str(e))
 
-def main():
-    args = get_para()
 
-    f_dir = os.getcwd()
-    R_script = write_R_tmp_script(
-        msa_format=args.msa_format,
-        model = args.model,
-        pairwise_deletion=args.pairwise_deletion)
+def check_one_group(index=None, seqids=None, options=None):
+    '''
+    Exit if a seqid of the matrix is listed under several groups, which
+    `options` do not support.
+    '''
+    several = index.multi_grouped(seqids)
+    if several:
+        sys.exit('{0}: every seqid must be in one group, but {1} is listed under {2}!'.format(
+            options, several[0], ', '.join(sorted(index.seqid_groups[several[0]]))))
 
 
-    if args.msa_file:
-        args.pairwise_dist = get_dist_pairwise_matrix(
-            msa_file=args.msa_file,
-            R_script=R_script)
+def dist_groups(seqids=None, matrix=None, index=None,
+    b_handle=None, i_handle=None, engine='numpy', max_dist=10, median='exact',
+    pairs=None, congeneric_only=False, match=None, blocks=None, tables=False,
+    gap_handle=None):
+    '''
+    Write the between- and within-group statistics of one gene matrix;
+    index is the GroupIndex of the group definition. pairs, congeneric_only
+    and match select the between-group pairs (see GroupIndex.select_pairs).
+    With the row blocks of read_blocks() instead of a matrix, the stream
+    engine is used.
 
-    triu_dict, tril_dict = csv2dict(args.pairwise_dist, header=0, all_key_to_all=True)
+    tables=True also returns the rows as the dist_output.GroupTable pair
+    (between, within); a handle of None is not written.
 
-    seqid_group, group_seqid = get_seqid_group(infile=args.group_definition, delimiter=args.delimiter)
+    gap_handle: also write the barcode gap report (barcode_gap.py), taken
+    from the same pass over the matrix with the stream engine.
+    '''
+    with timings.stage('filter', items=len(seqids)):
+        # only the groups with a member in the matrix
+        index = index.restrict(set(seqids))
+        selected = index.select_pairs(pairs=pairs, congeneric_only=congeneric_only, match=match)
+    ngroups = len(index)
+    npairs = ngroups * (ngroups - 1) // 2 if selected is None else len(selected)
+    b_table = i_table = None
+    if tables:
+        b_table = dist_output.GroupTable(index.groups, pairs=True)
+        i_table = dist_output.GroupTable(index.groups)
+
+    gap = None
+    if gap_handle is not None:
+        gap = barcode_gap.BarcodeGap(index.codes(seqids), ngroups, max_dist)
+
+    if engine == 'stream' or blocks is not None:
+        if blocks is None:
+            blocks = dist_engine.iter_upper_blocks(matrix)
+        if gap is not None:
+            blocks = gap.tap(blocks)
+        with timings.stage('single_pass', items=len(seqids) * (len(seqids) - 1) // 2):
+            dist_engine.dist_groups_single_pass(
+                matrix=matrix,
+                codes=index.codes(seqids),
+                multi=index.multi_codes(seqids),
+                groups=index.groups,
+                b_handle=b_handle,
+                i_handle=i_handle,
+                max_dist=max_dist,
+                median=median,
+                pairs=selected,
+                blocks=blocks,
+                b_table=b_table,
+                i_table=i_table)
+        if gap is not None:
+            with timings.stage('output', items=len(seqids)):
+                barcode_gap.print_barcode_gap(gap, seqids, index.groups, gap_handle)
+        return b_table, i_table
+
+    with timings.stage('filter', items=len(seqids)):
+        members = index.members(seqids)
+
+    with timings.stage('between', items=npairs):
+        dist_engine.dist_between_groups(
+            matrix=matrix,
+            members=members,
+            groups=index.groups,
+            out_handle=b_handle,
+            max_dist=max_dist,
+            median=median,
+            pairs=selected,
+            table=b_table)
+
+    with timings.stage('within', items=ngroups):
+        dist_engine.dist_within_group(
+            matrix=matrix,
+            members=members,
+            groups=index.groups,
+            out_handle=i_handle,
+            max_dist=max_dist,
+            median=median,
+            table=i_table)
+
+    if gap is not None:
+        with timings.stage('barcode_gap', items=len(seqids) * (len(seqids) - 1) // 2):
+            for i0, block in dist_engine.iter_upper_blocks(matrix):
+                gap.add(i0, block)
+            barcode_gap.print_barcode_gap(gap, seqids, index.groups, gap_handle)
+    return b_table, i_table
+
+
+def sparse_groups(store_file=None, index=None, b_handle=None, i_handle=None,
+    msa_file=None, pairwise_dist=None, msa_format='fasta', model='K80',
+    pairwise_deletion=False, native=False, cache_dir=None, max_memory=None,
+    cutoff=None, max_dist=10, median='exact', pairs=None, congeneric_only=False,
+    match=None, tables=False):
+    '''
+    dist_groups() from a sparse pairwise store (dist_sparse.py), built from
+    the row blocks of the input and saved to store_file or, without an
+    input, read from store_file. cutoff: the largest distance kept
+    (max_dist if None).
+    '''
+    if cutoff is None:
+        cutoff = max_dist
+    if msa_file or pairwise_dist:
+        # blocks of 256 MB unless -max_memory says otherwise
+        seqids, blocks = read_blocks(
+            msa_file=msa_file,
+            pairwise_dist=pairwise_dist,
+            msa_format=msa_format,
+            model=model,
+            pairwise_deletion=pairwise_deletion,
+            native=native,
+            cache_dir=cache_dir,
+            max_memory=max_memory or 256)
+        check_one_group(index, seqids, '`-sparse_store`')
+        with timings.stage('sparse', items=len(seqids) * (len(seqids) - 1) // 2):
+            store = dist_sparse.SparseStore(seqids, index, cutoff=cutoff,
+                max_dist=max_dist, median=median).build(blocks)
+            store.save(store_file)
+    else:
+        with timings.stage('parse'):
+            store = dist_sparse.load_sparse(store_file)
+        if store is None or not store.matches(index, max_dist, cutoff, median):
+            sys.exit('{0}: the sparse store was built by another version or with another group definition, -max_dist, -sparse_cutoff or -median!'.format(store_file))
+
+    with timings.stage('filter', items=len(store.seqids)):
+        restricted = index.restrict(set(store.seqids))
+        selected = restricted.select_pairs(pairs=pairs, congeneric_only=congeneric_only, match=match)
+    b_table = i_table = None
+    if tables:
+        b_table = dist_output.GroupTable(restricted.groups, pairs=True)
+        i_table = dist_output.GroupTable(restricted.groups)
+
+    with timings.stage('sparse_groups', items=len(store)):
+        approximate = store.write_groups(b_handle, i_handle, selected, b_table, i_table)
+    if approximate:
+        print('{0} output rows have an approximate median (distances above -sparse_cutoff)'.format(approximate),
+            file=sys.stderr)
+    return b_table, i_table
+
+
+def resample_groups(seqids=None, matrix=None, index=None, out_handle=None,
+    max_dist=10, pairs=None, congeneric_only=False, match=None,
+    bootstrap=0, permutations=0, seed=None, processes=1, confidence=0.95,
+    b_table=None, i_table=None):
+    '''
+    Bootstrap intervals and permutation tests of the mean distances, see
+    dist_resample.py; the group pairs are selected as in dist_groups(),
+    whose tables (b_table, i_table) give the observed means.
+    '''
+    with timings.stage('filter', items=len(seqids)):
+        index = index.restrict(set(seqids))
+        selected = index.select_pairs(pairs=pairs, congeneric_only=congeneric_only, match=match)
+        if selected is None:
+            selected = list(dist_engine.all_pairs(len(index)))
+        coded = dist_resample.CodedMatrix(matrix, index.codes(seqids), len(index), max_dist)
+        means = group_matrix.summary_matrices(b_table, i_table, ('mean',))['mean']
 
+    if bootstrap:
+        with timings.stage('bootstrap', items=bootstrap):
+            result = dist_resample.bootstrap(coded, bootstrap, seed, processes, confidence, selected, means)
+            dist_resample.print_bootstrap(index.groups, result, out_handle, selected, bootstrap, confidence)
 
-    filtered_group_seqid = filter_not_existing_groups(triu_dict=triu_dict, seqid_group=seqid_group, group_seqid=group_seqid)
+    if permutations:
+        with timings.stage('permutations', items=permutations):
+            result = dist_resample.permutation_test(coded, permutations, seed, processes)
+            dist_resample.print_permutations(index.groups, result, means, out_handle, selected, permutations)
 
-    dist_between_groups(
-        mdict=triu_dict,
-        group_seqid=filtered_group_seqid,
-        out_handle=args.b_o,
-        max_dist=args.max_dist)
 
-    dist_within_group(
-        mdict=triu_dict,
-        group_seqid=filtered_group_seqid,
-        out_handle=args.i_o,
-        max_dist=args.max_dist)
+def main():
+    args = get_para()
 
+    with timings.profiled(args.profile):
+        run(args)
 
-if __name__ == '__main__':
-    main()
+    if args.timings:
+        timings.write(args.timings)
 
 
+def run(args=None):
+    f_dir = os.getcwd()
 
+    with timings.stage('groups'):
+        index = GroupIndex.read(infile=args.group_definition, delimiter=args.delimiter)
+
+    if args.engine == 'dict':
+        from mglcmdtools import csv2dict
+
+        R_script = write_R_tmp_script(
+            msa_format=args.msa_format,
+            model = args.model,
+            pairwise_deletion=args.pairwise_deletion)
+
+        if args.msa_file:
+            with timings.stage('rscript'):
+                args.pairwise_dist = get_dist_pairwise_matrix(
+                    msa_file=args.msa_file,
+                    R_script=R_script)
+
+        with timings.stage('parse'):
+            triu_dict, tril_dict = csv2dict(args.pairwise_dist, header=0, all_key_to_all=True)
+
+        with timings.stage('filter', items=len(triu_dict)):
+            # group -> set of the members in the matrix
+            filtered_group_seqid = index.restrict(triu_dict).group_sets
+
+        ngroups = len(filtered_group_seqid)
+        with timings.stage('between', items=ngroups * (ngroups - 1) // 2):
+            dist_between_groups(
+                mdict=triu_dict,
+                group_seqid=filtered_group_seqid,
+                out_handle=args.b_o,
+                max_dist=args.max_dist)
+
+        with timings.stage('within', items=ngroups):
+            dist_within_group(
+                mdict=triu_dict,
+                group_seqid=filtered_group_seqid,
+                out_handle=args.i_o,
+                max_dist=args.max_dist)
+        return
+
+    text = args.out_format == 'text'
+    if args.sparse_store:
+        b_table, i_table = sparse_groups(
+            store_file=args.sparse_store,
+            index=index,
+            b_handle=args.b_o if text else None,
+            i_handle=args.i_o if text else None,
+            msa_file=args.msa_file,
+            pairwise_dist=args.pairwise_dist,
+            msa_format=args.msa_format,
+            model=args.model,
+            pairwise_deletion=args.pairwise_deletion,
+            native=args.dist_engine == 'native',
+            cache_dir=args.cache_dir,
+            max_memory=args.max_memory,
+            cutoff=args.sparse_cutoff,
+            max_dist=args.max_dist,
+            median=args.median,
+            pairs=read_pairs(args.pairs) if args.pairs else None,
+            congeneric_only=args.congeneric_only,
+            match=args.match,
+            tables=not text or bool(args.matrix_prefix))
+    else:
+        matrix = blocks = None
+        if args.max_memory:
+            seqids, blocks = read_blocks(
+                msa_file=args.msa_file,
+                pairwise_dist=args.pairwise_dist,
+                msa_format=args.msa_format,
+                model=args.model,
+                pairwise_deletion=args.pairwise_deletion,
+                native=args.dist_engine == 'native',
+                cache_dir=args.cache_dir,
+                max_memory=args.max_memory)
+        else:
+            seqids, matrix = read_matrix(
+                msa_file=args.msa_file,
+                pairwise_dist=args.pairwise_dist,
+                msa_format=args.msa_format,
+                model=args.model,
+                pairwise_deletion=args.pairwise_deletion,
+                native=args.dist_engine == 'native',
+                cache_dir=args.cache_dir)
+
+        if args.barcode_gap or args.bootstrap or args.permutations:
+            check_one_group(index, seqids, '`-barcode_gap`, `-bootstrap` and `-permutations`')
+
+        b_table, i_table = dist_groups(
+            seqids=seqids,
+            matrix=matrix,
+            blocks=blocks,
+            index=index,
+            b_handle=args.b_o if text else None,
+            i_handle=args.i_o if text else None,
+            engine=args.engine,
+            max_dist=args.max_dist,
+            median=args.median,
+            pairs=read_pairs(args.pairs) if args.pairs else None,
+            congeneric_only=args.congeneric_only,
+            match=args.match,
+            tables=not text or bool(args.matrix_prefix or args.bootstrap or args.permutations),
+            gap_handle=args.barcode_gap)
+
+    if not text:
+        with timings.stage('output'):
+            for handle, table in ((args.b_o, b_table), (args.i_o, i_table)):
+                handle.close()
+                dist_output.write_table(handle.name, args.out_format, table)
+
+    if args.bootstrap or args.permutations:
+        resample_groups(
+            seqids=seqids,
+            matrix=matrix,
+            index=index,
+            out_handle=args.r_o,
+            max_dist=args.max_dist,
+            pairs=read_pairs(args.pairs) if args.pairs else None,
+            congeneric_only=args.congeneric_only,
+            match=args.match,
+            bootstrap=args.bootstrap,
+            permutations=args.permutations,
+            seed=args.seed,
+            processes=args.processes,
+            confidence=args.confidence,
+            b_table=b_table,
+            i_table=i_table)
+
+    if args.matrix_prefix:
+        with timings.stage('matrices', items=len(b_table.groups)):
+            group_matrix.write_matrices(args.matrix_prefix, b_table, i_table,
+                stats=args.matrix_stats, order=args.matrix_order)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+'''
+Group definition shared by all scripts.
+
+A GroupIndex is read once from a `-group_definition` file and holds:
+
+- groups: the sorted group names; a group's code is its position here
+- group_seqid: group -> member seqids (file order), seqid_group: seqid ->
+  group, and group_sets: group -> set of members, for O(1) membership
+- seqid_code: seqid -> group code
+- seqid_groups: seqid -> set of all its groups
+
+Against the seqids of one matrix it gives the integer group code of every
+row (codes), the row indices of every group as contiguous sorted arrays
+(members, used for fancy-indexed sub-blocks) and the row membership mask
+of a group (member_mask).
+
+A seqid listed under several groups is a member of all of them, as in the
+original dict scan. Its code is the group of its last line; the
+single-pass accumulators add its other groups from multi_codes() (see
+dist_engine.expand_pairs), the few features that need one group per
+seqid exit on it (multi_grouped).
+
+select_pairs() pushes the group-pair filters of get_congenic_stat.py and
+pick_lines_with_specified_element_only.py (and an explicit pair list)
+down to the engines, so only the selected blocks are computed.
+'''
+import re
+import numpy as np
+
+
+def read_pairs(infile=None):
+    '''
+    Group pairs of a `-pairs` file: two group names per line, separated by
+    white space; empty lines and lines starting with '#' are skipped.
+    '''
+    pairs = []
+    with open(infile, 'r') as fh:
+        for i in fh:
+            i = i.strip()
+            if not i or i.startswith('#'):
+                continue
+            group1, group2 = i.split()[0:2]
+            pairs.append((group1, group2))
+    return pairs
+
+
+def genus(group=None):
+    return group.split('_')[0]
+
+
+def check_match(group=None, elements=None):
+    for e in elements:
+        if e in group:
+            return True
+    return False
+
+
+class GroupIndex(object):
+
+    def __init__(self, group_seqid=None):
+        self.group_seqid = group_seqid
+        self.groups = sorted(group_seqid.keys())
+        self.group_code = {group: i for i, group in enumerate(self.groups)}
+        self.group_sets = {group: set(seqids) for group, seqids in group_seqid.items()}
+        self.seqid_groups = {}
+        for group, seqids in group_seqid.items():
+            for seqid in seqids:
+                self.seqid_groups.setdefault(seqid, set()).add(group)
+        self.seqid_group = {}
+        self.seqid_code = {}
+
+    @classmethod
+    def read(cls, infile=None, delimiter=r'\s+'):
+        group_seqid = {}
+        seqid_group = {}
+        with open(infile, 'r') as fh:
+            for i in fh:
+                i = i.strip()
+                seqid, group = re.split(delimiter, i, maxsplit=1)
+                seqid_group[seqid] = group
+                group_seqid.setdefault(group, []).append(seqid)
+        index = cls(group_seqid)
+        index.seqid_group = seqid_group
+        index.seqid_code = {seqid: index.group_code[group] for seqid, group in seqid_group.items()}
+        return index
+
+    def __len__(self):
+        return len(self.groups)
+
+    def restrict(self, seqids=None):
+        '''
+        GroupIndex of the members found in `seqids` (a set or dict); groups
+        without any are dropped.
+        '''
+        group_seqid = {}
+        for group in self.group_seqid:
+            for seqid in self.group_seqid[group]:
+                if seqid in seqids:
+                    group_seqid.setdefault(group, []).append(seqid)
+        index = GroupIndex(group_seqid)
+        for seqid, group in self.seqid_group.items():
+            if seqid in seqids:
+                index.seqid_group[seqid] = group
+                index.seqid_code[seqid] = index.group_code[group]
+        return index
+
+    def codes(self, seqids=None):
+        '''
+        Group code of every seqid of a matrix (-1 if ungrouped).
+        '''
+        return np.array([self.seqid_code.get(seqid, -1) for seqid in seqids], dtype=np.int64)
+
+    def multi_grouped(self, seqids=None):
+        '''
+        The seqids of `seqids` listed under several groups.
+        '''
+        return [seqid for seqid in seqids if len(self.seqid_groups.get(seqid, ())) > 1]
+
+    def multi_codes(self, seqids=None):
+        '''
+        All group codes of every seqid of a matrix, as (offsets, codes):
+        those of seqid i are codes[offsets[i]:offsets[i + 1]], its code
+        (see codes()) first. None if no seqid is in several groups.
+        '''
+        if not self.multi_grouped(seqids):
+            return None
+        offsets = [0]
+        codes = []
+        for seqid in seqids:
+            if seqid in self.seqid_code:
+                code = self.seqid_code[seqid]
+                codes.append(code)
+                codes.extend(sorted(self.group_code[group] for group in self.seqid_groups[seqid]
+                    if self.group_code[group] != code))
+            offsets.append(len(codes))
+        return np.array(offsets, dtype=np.int64), np.array(codes, dtype=np.int64)
+
+    def present(self, seqids=None):
+        '''
+        Bool array over the groups: the groups with a member in `seqids`.
+        '''
+        present = np.zeros(len(self.groups), dtype=bool)
+        for seqid in seqids:
+            for group in self.seqid_groups.get(seqid, ()):
+                present[self.group_code[group]] = True
+        return present
+
+    def members(self, seqids=None):
+        '''
+        Sorted matrix indices of each group's members, in the order of `groups`.
+        '''
+        position = {seqid: i for i, seqid in enumerate(seqids)}
+        members = []
+        for group in self.groups:
+            idx = [position[seqid] for seqid in self.group_seqid[group] if seqid in position]
+            members.append(np.unique(np.array(idx, dtype=np.int64)))
+        return members
+
+    def member_mask(self, seqids=None, group=None):
+        '''
+        Bool mask of the matrix rows that belong to `group`.
+        '''
+        members = self.group_sets[group]
+        return np.array([seqid in members for seqid in seqids], dtype=bool)
+
+    def select_pairs(self, pairs=None, congeneric_only=False, match=None, include_same=False):
+        '''
+        Sorted (code1, code2) group pairs, code1 < code2, that pass every
+        given filter, or None when no filter is given. include_same also
+        allows code1 == code2 (the multi-gene between-group output has
+        same-group lines), except with congeneric_only.
+
+        pairs: (group1, group2) list, in either order; congeneric_only: the
+        two groups have the same genus (the part of the name before the
+        first '_'); match: both group names contain one of these strings.
+        '''
+        if pairs is None and not congeneric_only and not match:
+            return None
+
+        if pairs is not None:
+            selected = set()
+            for group1, group2 in pairs:
+                if group1 in self.group_code and group2 in self.group_code:
+                    code1, code2 = self.group_code[group1], self.group_code[group2]
+                    selected.add((min(code1, code2), max(code1, code2)))
+            candidates = sorted(selected)
+        else:
+            codes = range(len(self.groups))
+            if match:
+                codes = [code for code in codes if check_match(self.groups[code], match)]
+            by_genus = {}
+            for code in codes:
+                key = genus(self.groups[code]) if congeneric_only else ''
+                by_genus.setdefault(key, []).append(code)
+            candidates = []
+            for codes in by_genus.values():
+                for k, code1 in enumerate(codes):
+                    for code2 in codes[k:]:
+                        candidates.append((code1, code2))
+            candidates.sort()
+
+        selected = []
+        for code1, code2 in candidates:
+            group1, group2 = self.groups[code1], self.groups[code2]
+            if code1 == code2 and (congeneric_only or not include_same):
+                continue
+            if congeneric_only and genus(group1) != genus(group2):
+                continue
+            if match and not (check_match(group1, match) and check_match(group2, match)):
+                continue
+            selected.append((code1, code2))
+        return selected
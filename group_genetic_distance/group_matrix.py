@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+'''
+Square group x group matrices of the between-group statistics
+(`-matrix_prefix`), ready for a heatmap without pivoting the long
+between-group output.
+
+<prefix>.<statistic>.tsv is written for every statistic asked for: a
+header line `group` + the group names, then one line per group with its
+name and its row of the matrix. The matrix is symmetric; cell (a, b) is
+the statistic of the group pair, the diagonal that of the group itself
+when the run computes it (the within-group output of group_dist.py, the
+same-group pairs of between-group_dist_of_multi-genes.py). Pairs with no
+value are written as NA, which pandas reads as NaN:
+
+    pandas.read_table('<prefix>.mean.tsv', index_col=0)
+
+With order='cluster', the rows and columns are ordered as the leaves of a
+UPGMA tree of the mean matrix (missing pairs count as the largest mean
+distance), and the tree is written to <prefix>.upgma.nwk.
+'''
+import numpy as np
+
+from dist_output import STAT_COLUMNS
+
+MATRIX_STATS = ('count',) + STAT_COLUMNS
+
+MATRIX_ORDERS = ('input', 'cluster')
+
+
+def summary_matrices(b_table=None, i_table=None, stats=MATRIX_STATS):
+    '''
+    {statistic: G x G matrix} of the dist_output.GroupTable of the group
+    pairs, the diagonal filled from the within-group table if given.
+    '''
+    matrices = {}
+    for stat in stats:
+        matrix = b_table.matrix(stat)
+        if i_table is not None and i_table.code1:
+            code = np.array(i_table.code1, dtype=np.int64)
+            matrix[code, code] = i_table.values(stat)
+        matrices[stat] = matrix
+    return matrices
+
+
+def upgma(matrix=None, labels=None):
+    '''
+    UPGMA tree of a symmetric distance matrix; return (leaf order, Newick
+    string). NaN and infinite distances are replaced by the largest finite
+    one, the diagonal is ignored.
+    '''
+    n = len(matrix)
+    if n == 0:
+        return [], ';'
+    d = np.array(matrix, dtype=np.float64)
+    finite = np.isfinite(d)
+    d[~finite] = d[finite].max() if finite.any() else 0.0
+    np.fill_diagonal(d, np.inf)
+
+    size = np.ones(n)
+    height = np.zeros(n)
+    order = [[i] for i in range(n)]
+    trees = [str(label) for label in labels]
+    for _ in range(n - 1):
+        i, j = divmod(int(np.argmin(d)), n)
+        if i > j:
+            i, j = j, i
+        h = d[i, j] / 2
+        trees[i] = '({0}:{1},{2}:{3})'.format(trees[i], h - height[i], trees[j], h - height[j])
+        order[i] = order[i] + order[j]
+        # average linkage: distances of the merged cluster, weighted by size
+        merged = (d[i] * size[i] + d[j] * size[j]) / (size[i] + size[j])
+        d[i, :] = merged
+        d[:, i] = merged
+        d[i, i] = np.inf
+        d[j, :] = np.inf
+        d[:, j] = np.inf
+        size[i] += size[j]
+        height[i] = h
+    return order[0], trees[0] + ';'
+
+
+def write_matrix(f=None, groups=None, matrix=None, order=None, integer=False):
+    with open(f, 'w') as fhout:
+        print('group', '\t'.join(groups[i] for i in order), sep='\t', file=fhout)
+        for i in order:
+            row = matrix[i, order]
+            line = ['NA' if np.isnan(x) else str(int(x) if integer else x) for x in row.tolist()]
+            print(groups[i], '\t'.join(line), sep='\t', file=fhout)
+
+
+def write_matrices(prefix=None, b_table=None, i_table=None, stats=MATRIX_STATS, order='input'):
+    '''
+    Write <prefix>.<statistic>.tsv for every statistic of `stats` (and
+    <prefix>.upgma.nwk with order='cluster'). Groups with no row in the
+    tables are left out.
+    '''
+    groups = b_table.groups
+    rows = set(b_table.code1) | set(b_table.code2)
+    if i_table is not None:
+        rows |= set(i_table.code1)
+    leaves = [code for code in range(len(groups)) if code in rows]
+    matrices = summary_matrices(b_table, i_table, stats)
+    if order == 'cluster':
+        mean = b_table.matrix('mean')[np.ix_(leaves, leaves)]
+        order, tree = upgma(mean, [groups[code] for code in leaves])
+        leaves = [leaves[i] for i in order]
+        with open(prefix + '.upgma.nwk', 'w') as fhout:
+            print(tree, file=fhout)
+    for stat in stats:
+        write_matrix('{0}.{1}.tsv'.format(prefix, stat), groups, matrices[stat], leaves,
+            integer=stat == 'count')
+
+
+def add_arguments(parser=None):
+    '''
+    The -matrix_prefix, -matrix_stats and -matrix_order options.
+    '''
+    parser.add_argument('-matrix_prefix', metavar='<prefix>', required=False,
+        help='''also write the between-group statistics as square group x group
+matrices, <prefix>.<statistic>.tsv, see group_matrix.py''')
+
+    parser.add_argument('-matrix_stats', metavar='<str>', nargs='+', default=list(MATRIX_STATS),
+        choices=MATRIX_STATS, help='statistics written by -matrix_prefix [%(default)s]')
+
+    parser.add_argument('-matrix_order', default='input', choices=MATRIX_ORDERS,
+        help='''order of the matrix rows and columns: input: as the group definition;
+cluster: leaves of a UPGMA tree of the mean distances, written to
+<prefix>.upgma.nwk [%(default)s]''')
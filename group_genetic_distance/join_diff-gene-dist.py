@@ -1,128 +1,262 @@
 #!/usr/bin/env python3
+'''
+Join the per-gene within- or between-group files into one table, one
+column block per file (files in sorted order) and one row per group (or
+group pair), rows sorted by group name, 'NA.' where a file lacks a group.
+
+main() joins the files with a streaming k-way merge (join_files): every
+file is read in group order and a row is printed as soon as all files have
+moved past its group, so memory grows with the number of files, not with
+the number of rows. A file whose lines are not in that order is sorted
+into a temporary copy first, and more than FAN_IN files are merged in
+passes through temporary files, so that no more than FAN_IN files are
+open at a time.
+'''
 import sys
-import collections
+import os
+import heapq
+import tempfile
+import timings
+import dist_output
 
+# input files open at the same time in one merge pass
+FAN_IN = 256
 
+# separates the cells of one row in the temporary files of a merge pass
+_CELL_SEP = '\x00'
 
-def read_within_group_dist(f_lst=None):
-    '''
-    The first column will be the key
 
-    per-file-content-format:
-    # group Minimum Maximum Average
+def read_file_list(f_lst=None):
     '''
-
-    group_vals = {}
+    The distinct files of the list, in sorted order.
+    '''
+    files = set()
     with open(f_lst, 'r') as fh:
         for f in fh:
             f = f.strip()
-            group_vals.setdefault(f, {})
-            with open(f, 'r') as fh_dist:
-                for i in fh_dist:
-                    i = i.strip()
-                    if i.startswith('#'):
-                        continue
-                    line = i.split()
-                    group = line[0]
-                    val = '\t'.join(line[1:])
-                    group_vals[f][group] = val
+            if f:
+                files.add(f)
+    return sorted(files)
+
+
+def iter_records(f=None, key_cols=1):
+    '''
+    Yield (group, values) of the lines of a per-gene file, as the read_*
+    functions split them: group is the first `key_cols` columns joined by
+    '---', values the other columns joined by tabs.
+    '''
+    with open(f, 'r') as fh:
+        for i in fh:
+            i = i.strip()
+            if not i or i.startswith('#'):
+                continue
+            line = i.split()
+            yield '---'.join(line[0:key_cols]), '\t'.join(line[key_cols:])
+
+
+def is_sorted(f=None, key_cols=1):
+    prev = None
+    for group, vals in iter_records(f, key_cols):
+        if prev is not None and group < prev:
+            return False
+        prev = group
+    return True
 
-    return group_vals
+
+def dedup(records=None):
+    '''
+    Keep the last of consecutive records of the same group, as the dict of
+    the in-memory join does.
+    '''
+    prev = None
+    for record in records:
+        if prev is not None and record[0] != prev[0]:
+            yield prev
+        prev = record
+    if prev is not None:
+        yield prev
 
 
-def read_between_groups_dist(f_lst=None):
+def file_source(f=None, key_cols=1, tmpdir=None):
     '''
-    The first and two columns will be the key
+    Iterator of the (group, [values]) records of a file in group order. A
+    file that is not in order is sorted (stably, one file in memory) into
+    a copy in tmpdir.
+    '''
+    if not is_sorted(f, key_cols):
+        records = sorted(iter_records(f, key_cols), key=lambda record: record[0])
+        fd, sorted_f = tempfile.mkstemp(dir=tmpdir)
+        with os.fdopen(fd, 'w') as fhout:
+            for group, vals in dedup(records):
+                print(group, vals, sep='\t', file=fhout)
+        f, key_cols = sorted_f, 1
+    for group, vals in dedup(iter_records(f, key_cols)):
+        yield group, [vals]
+
 
-    per-file-content-format:
-    # group1 group2 Minimum Maximum Average
+def merged_source(f=None):
     '''
+    Iterator of the (group, cells) rows of a merge pass file.
+    '''
+    with open(f, 'r') as fh:
+        for line in fh:
+            group, cells = line.rstrip('\n').split('\t', 1)
+            yield group, cells.split(_CELL_SEP)
 
-    group_vals = {}
-    with open(f_lst, 'r') as fh:
-        for f in fh:
-            f = f.strip()
-            group_vals.setdefault(f, {})
-            with open(f, 'r') as fh_dist:
-                for i in fh_dist:
-                    i = i.strip()
-                    if i.startswith('#'):
-                        continue
-                    line = i.split()
-                    group = '---'.join(line[0:2])
-                    val = '\t'.join(line[2:])
-                    group_vals[f][group] = val
-
-    return group_vals
-
-
-def join_dist(group_vals=None, val_width=3):
-    # first, get a combined group names
-    all_groups = set()
-    for f in group_vals:
-        for group in group_vals[f]:
-            all_groups.add(group)
-
-    all_groups = sorted(all_groups)
-
-    # second, create the joined groups
-    joined_group_vals = collections.OrderedDict()
-    for group in all_groups:
-        joined_group_vals.setdefault(group, [])
-
-    f_order = sorted(group_vals.keys())
-    for f in f_order:
-        for group in all_groups:
-            vals = ['NA.'] * val_width
-            vals = '\t'.join(vals)
-            if group in group_vals[f]:
-                vals = group_vals[f][group]
-            joined_group_vals[group].append(vals)
-
-
-    tmp_g = list(all_groups)[0]
-    if '---' in tmp_g:
-        title = ['#group1', 'group2']
-    else:
-        title = ['#group']
-
-    for f in f_order:
-        title.append(f)
-        vals = [''] * (val_width-1)
-        title.append('\t'.join(vals))
-    title = '\t'.join(title)
-    print(title)
-    for group in joined_group_vals:
-        line = '\t'.join(joined_group_vals[group])
-        if '---' in group:
-            g1, g2 = group.split('---')
-            print(g1, g2, line, sep='\t')
-        else:
-            print(group, line, sep='\t')
+
+def _tagged(i=0, source=None):
+    for group, cells in source:
+        yield group, i, cells
+
+
+def merge_sources(sources=None, widths=None, na='NA.'):
+    '''
+    k-way merge of group-ordered sources; yield (group, cells) with the
+    cells of every source in order, `na` for the widths[i] cells of a
+    source without the group. One record per source is held.
+    '''
+    merged = heapq.merge(*[_tagged(i, source) for i, source in enumerate(sources)])
+    group = None
+    row = None
+    for next_group, i, cells in merged:
+        if next_group != group:
+            if row is not None:
+                yield group, [cell for cells_i in row for cell in cells_i]
+            group = next_group
+            row = [[na] * width for width in widths]
+        row[i] = cells
+    if row is not None:
+        yield group, [cell for cells_i in row for cell in cells_i]
+
+
+def value_names(files=None, val_width=3):
+    return ['{0}:{1}'.format(f, j + 1) for f in files for j in range(val_width)]
+
+
+def join_files(files=None, key_cols=1, val_width=3, out_handle=None, fan_in=FAN_IN, writer=None):
+    '''
+    Streaming join of the per-gene files, see the module docstring. With a
+    dist_output.RowWriter (value columns: value_names()), the rows go
+    there instead of out_handle, val_width values per file.
+    '''
+    na = '\t'.join(['NA.'] * val_width)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sources = [file_source(f, key_cols, tmpdir) for f in files]
+        widths = [1] * len(files)
+        # merge passes through temporary files while too many are open
+        while len(sources) > fan_in:
+            next_sources, next_widths = [], []
+            for k in range(0, len(sources), fan_in):
+                fd, part = tempfile.mkstemp(dir=tmpdir)
+                with os.fdopen(fd, 'w') as fhout:
+                    for group, cells in merge_sources(sources[k:k + fan_in], widths[k:k + fan_in], na):
+                        print(group, _CELL_SEP.join(cells), sep='\t', file=fhout)
+                next_sources.append(merged_source(part))
+                next_widths.append(sum(widths[k:k + fan_in]))
+            sources, widths = next_sources, next_widths
+
+        rows = 0
+        for group, cells in merge_sources(sources, widths, na):
+            if writer is not None:
+                values = []
+                for cell in cells:
+                    vals = cell.split('\t')[:val_width]
+                    values.extend(vals + ['NA.'] * (val_width - len(vals)))
+                writer.add(group.split('---'), values)
+                rows += 1
+                continue
+            if rows == 0:
+                if '---' in group:
+                    title = ['#group1', 'group2']
+                else:
+                    title = ['#group']
+                for f in files:
+                    title.append(f)
+                    title.append('\t'.join([''] * (val_width - 1)))
+                print('\t'.join(title), file=out_handle)
+            line = '\t'.join(cells)
+            if '---' in group:
+                g1, g2 = group.split('---')
+                print(g1, g2, line, sep='\t', file=out_handle)
+            else:
+                print(group, line, sep='\t', file=out_handle)
+            rows += 1
+    return rows
+
+
+def pop_option(argv=None, option=None, default=None):
+    '''
+    Remove `option <value>` from argv; return (argv, value).
+    '''
+    argv = list(argv)
+    if option not in argv:
+        return argv, default
+    i = argv.index(option)
+    if i + 1 >= len(argv):
+        sys.exit('{0} needs a value'.format(option))
+    value = argv[i + 1]
+    del argv[i:i + 2]
+    return argv, value
 
 
 def main():
     usage = '''
-python3 {0} <b|w> <f_lst> <val_width>
+python3 {0} <b|w> <f_lst> <val_width> [-out_format <fmt> -o <file>] [-timings <file>] [-profile <prefix>]
 
 b: input is between groups data
 w: input is within group data
 
+-out_format: text (the default, printed), npz, parquet (needs pyarrow) or
+hdf5 (needs h5py): group name columns and one float64 column per file and
+value, written to the `-o` file, see dist_output.py
+
+-timings: write per-stage timings as JSON to this file ('-' for stderr)
+-profile: run under cProfile and tracemalloc, write <prefix>.prof and
+<prefix>.tracemalloc
+
     '''.format(sys.argv[0])
 
-    if len(sys.argv) != 4:
+    argv, timings_f, profile = timings.pop_arguments(sys.argv)
+    argv, out_format = pop_option(argv, '-out_format', 'text')
+    argv, out_f = pop_option(argv, '-o', None)
+
+    if len(argv) != 4:
         sys.exit(usage)
 
-    d_type, f_lst, val_width = sys.argv[1:4]
+    if out_format not in dist_output.OUT_FORMATS:
+        sys.exit('`-out_format` must be one of: ' + ', '.join(dist_output.OUT_FORMATS))
+    if out_format != 'text':
+        if not out_f:
+            sys.exit('`-out_format {0}` needs an `-o` file!'.format(out_format))
+        message = dist_output.missing_dependency(out_format)
+        if message:
+            sys.exit(message)
+
+    d_type, f_lst, val_width = argv[1:4]
 
     val_width = int(val_width)
 
-    if d_type == 'b':
-        group_vals = read_between_groups_dist(f_lst=f_lst)
-    else:
-        group_vals = read_within_group_dist(f_lst=f_lst)
+    with timings.profiled(profile):
+        files = read_file_list(f_lst)
+        key_cols = 2 if d_type == 'b' else 1
+        writer = None
+        if out_format != 'text':
+            key_names = ['group1', 'group2'] if key_cols == 2 else ['group']
+            writer = dist_output.RowWriter(out_f, out_format, key_names, value_names(files, val_width))
+        with timings.stage('join', items=len(files)):
+            rows = join_files(
+                files=files,
+                key_cols=key_cols,
+                val_width=val_width,
+                out_handle=sys.stdout,
+                writer=writer)
+            if writer is not None:
+                writer.close()
+    if rows == 0:
+        sys.exit('No distance lines in the files of {0}!'.format(f_lst))
 
-    join_dist(group_vals=group_vals, val_width=val_width)
+    if timings_f:
+        timings.write(timings_f)
 
 
 if __name__ == '__main__':
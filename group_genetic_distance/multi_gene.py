@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+'''
+Per-gene reductions shared by the multi-gene scripts.
+
+Each gene's distance matrix is reduced into a partial result: the group
+(pair) accumulators plus the groups (pairs) the gene has seen. Partials
+can be computed in worker processes and are merged in the order of the
+gene list. The sums are exact, so the merged output is the same as the
+serial run.
+
+Merging the partials pools the values of all genes, so a gene weighs as
+much as it has values of a group pair. weigh_partials() merges them with
+a weight per gene instead (see WEIGHTINGS and dist_stats.WeightedStats);
+only one partial, O(G x G) without exact medians, is held at a time.
+'''
+import functools
+import multiprocessing
+import sys
+import numpy as np
+
+from dist_stats import BucketStats, WeightedStats
+from dist_engine import accumulate_triu, rows_with_upper_values, sub_matrix
+import dist_matrix
+import dist_csv
+import timings
+
+
+def read_file_list(pairwise_dist_list=None):
+    files = []
+    with open(pairwise_dist_list, 'r') as fh:
+        for f in fh:
+            f = f.strip()
+            if f:
+                files.append(f)
+    return files
+
+
+# pooled: all values of all genes; gene: every gene weighs the same;
+# length: every gene weighs its alignment length
+WEIGHTINGS = ('pooled', 'gene', 'length')
+
+
+def read_gene_lengths(f=None):
+    '''
+    {matrix file: alignment length} of lines `file length`; ValueError
+    naming the line if one is not of this form or the length is not a
+    positive number.
+    '''
+    lengths = {}
+    with open(f, 'r') as fh:
+        for i, line in enumerate(fh, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            fields = line.rsplit(None, 1)
+            try:
+                length = float(fields[1]) if len(fields) == 2 else 0.0
+            except ValueError:
+                length = 0.0
+            if not length > 0 or np.isinf(length):
+                raise ValueError('{0}, line {1}: expected `matrix_file length` with a positive length, got: {2}'.format(f, i, line))
+            lengths[fields[0]] = length
+    return lengths
+
+
+def gene_weights(files=None, weighting='gene', lengths=None):
+    '''
+    The weight of every file; lengths: see read_gene_lengths(). ValueError
+    if a file has no length.
+    '''
+    if weighting != 'length':
+        return [1.0] * len(files)
+    for i, f in enumerate(files, start=1):
+        if f not in lengths:
+            raise ValueError('no alignment length of {0}, line {1}'.format(f, i))
+    return [lengths[f] for f in files]
+
+
+def _call(func=None, f=None):
+    '''
+    func(f) in a worker process. A sys.exit() there would leave the pool
+    waiting for the result, so it is handed to the parent instead.
+    '''
+    try:
+        return func(f)
+    except SystemExit as e:
+        return e
+
+
+def map_genes(func=None, files=None, processes=1):
+    '''
+    Yield func(f) for every file, in the order of `files`.
+    '''
+    if processes <= 1 or len(files) <= 1:
+        for f in files:
+            yield func(f)
+        return
+    pool = multiprocessing.Pool(processes=min(processes, len(files)))
+    try:
+        for result in pool.imap(functools.partial(_call, func), files):
+            if isinstance(result, SystemExit):
+                raise result
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def within_matrix_partial(seqids=None, matrix=None, index=None, median='exact'):
+    '''
+    Return (present, stats) of one gene matrix: present[code] is True when
+    the group has a member in the matrix (as the original dict-based script
+    decided it: the member's row has a value right of the diagonal), stats
+    holds its same-group pairs. index: GroupIndex.
+    '''
+    groups, codes = index.groups, index.codes(seqids)
+    upper = rows_with_upper_values(matrix)
+    present = index.present([seqid for seqid, up in zip(seqids, upper) if up])
+    stats = BucketStats(len(groups), median=median)
+    accumulate_triu(matrix, codes, len(groups), stats=stats, within_only=True,
+        multi=index.multi_codes(seqids))
+    return present, stats
+
+
+def between_matrix_partial(seqids=None, matrix=None, index=None, median='exact', pairs=None):
+    '''
+    Return (seen, stats) of one gene matrix over ordered group pairs
+    (group of row seqid, group of column seqid) of the upper triangle.
+
+    With pairs (GroupIndex.select_pairs), only the rows of the groups in
+    them are read; other buckets of these groups may be filled too. A
+    seqid listed under several groups counts in the group of its last
+    line, as in the original between-group script.
+    '''
+    groups, codes = index.groups, index.codes(seqids)
+    ngroups = len(groups)
+    if pairs is not None:
+        idx = np.nonzero(np.isin(codes, np.array(pairs, dtype=np.int64).ravel()))[0]
+        matrix = sub_matrix(matrix, idx, idx)
+        codes = codes[idx]
+    stats = BucketStats(ngroups * ngroups, median=median)
+    seen = np.zeros(ngroups * ngroups, dtype=bool)
+    accumulate_triu(matrix, codes, ngroups, stats=stats, ordered=True, seen=seen)
+    return seen, stats
+
+
+def read_gene_matrix(f=None):
+    '''
+    (seqids, matrix) of a csv or binary .npy matrix file; exits with a
+    message if a csv file is malformed.
+    '''
+    with timings.stage('parse'):
+        if dist_matrix.is_binary_matrix(f):
+            return dist_matrix.load_matrix(f)
+        try:
+            return dist_csv.read_dist_csv(f, reuse_buffer=True)
+        except ValueError as e:
+            sys.exit(str(e))
+
+
+def within_gene_partial(f=None, index=None, median='exact'):
+    seqids, matrix = read_gene_matrix(f)
+    with timings.stage('within', items=len(seqids)):
+        return within_matrix_partial(seqids, matrix, index, median)
+
+
+def between_gene_partial(f=None, index=None, median='exact', pairs=None):
+    seqids, matrix = read_gene_matrix(f)
+    for seqid in seqids:
+        if seqid not in index.seqid_code:
+            raise KeyError(seqid)
+    with timings.stage('between', items=len(seqids)):
+        return between_matrix_partial(seqids, matrix, index, median, pairs)
+
+
+def merge_partials(partials=None):
+    '''
+    Merge (flags, stats) partials in order; flags are OR-ed.
+    '''
+    flags = None
+    stats = None
+    for part_flags, part_stats in partials:
+        if stats is None:
+            flags, stats = part_flags, part_stats
+            continue
+        flags |= part_flags
+        stats.merge(part_stats)
+    return flags, stats
+
+
+def fold_pairs(seen=None, stats=None, ngroups=0):
+    '''
+    (seen, stats) of ordered group pairs folded into unordered ones: (a, b)
+    and (b, a) both go to the bucket of (min, max).
+    '''
+    buckets = np.arange(ngroups * ngroups)
+    code1, code2 = buckets // max(ngroups, 1), buckets % max(ngroups, 1)
+    mapping = np.minimum(code1, code2) * ngroups + np.maximum(code1, code2)
+    folded = np.zeros(ngroups * ngroups, dtype=bool)
+    folded[mapping[seen]] = True
+    return folded, stats.remap(mapping, ngroups * ngroups)
+
+
+def weighed_partial(partial=None, fold_groups=0):
+    '''
+    (flags, stats, moments, folded) of a (flags, stats) partial of ordered
+    group pairs, as weigh_partials() takes it: moments is
+    stats.moments(), the costly part of weighing a gene, so that it can be
+    computed in a worker process. With fold_groups (the number of groups),
+    folded is the same of the partial folded to unordered pairs
+    (fold_pairs); else None.
+    '''
+    flags, stats = partial
+    folded = None
+    if fold_groups:
+        fold_flags, fold_stats = fold_pairs(flags, stats, fold_groups)
+        folded = (fold_flags, fold_stats, fold_stats.moments())
+    return flags, stats, stats.moments(), folded
+
+
+def weigh_partials(partials=None, weights=None, nbuckets=1, median='exact', fold_groups=0):
+    '''
+    Merge the weighed_partial() of every gene into (flags, WeightedStats),
+    gene i with weights[i]. With fold_groups (the number of groups, as
+    given to weighed_partial()), also return the (flags, WeightedStats) of
+    the unordered pairs, every gene folded before it is weighed; else None.
+    '''
+    flags = np.zeros(nbuckets, dtype=bool)
+    stats = WeightedStats(nbuckets, median=median)
+    fold_flags = np.zeros(nbuckets, dtype=bool)
+    fold_stats = WeightedStats(nbuckets, median=median)
+    for (part_flags, part_stats, moments, folded), weight in zip(partials, weights):
+        flags |= part_flags
+        stats.add(part_stats, weight, moments)
+        if fold_groups:
+            part_flags, part_stats, moments = folded
+            fold_flags |= part_flags
+            fold_stats.add(part_stats, weight, moments)
+    return flags, stats, (fold_flags, fold_stats) if fold_groups else None
+
+
+def within_all_genes(files=None, index=None, median='exact', processes=1):
+    func = functools.partial(within_gene_partial, index=index, median=median)
+    with timings.stage('genes', items=len(files)):
+        present, stats = merge_partials(map_genes(func, files, processes))
+    if stats is None:
+        ngroups = len(index)
+        present, stats = np.zeros(ngroups, dtype=bool), BucketStats(ngroups, median=median)
+    return present, stats
+
+
+def between_all_genes(files=None, index=None, median='exact', processes=1, pairs=None):
+    func = functools.partial(between_gene_partial, index=index, median=median, pairs=pairs)
+    with timings.stage('genes', items=len(files)):
+        seen, stats = merge_partials(map_genes(func, files, processes))
+    if stats is None:
+        nbuckets = len(index) ** 2
+        seen, stats = np.zeros(nbuckets, dtype=bool), BucketStats(nbuckets, median=median)
+    return seen, stats
+
+
+def between_gene_weighed(f=None, index=None, median='exact', pairs=None, fold_groups=0):
+    return weighed_partial(between_gene_partial(f, index, median, pairs), fold_groups)
+
+
+def between_all_genes_weighted(files=None, weights=None, index=None, median='exact', processes=1, pairs=None, fold=False):
+    '''
+    weigh_partials() of the genes of `files`, reduced in parallel.
+    '''
+    fold_groups = len(index) if fold else 0
+    func = functools.partial(between_gene_weighed, index=index, median=median, pairs=pairs,
+        fold_groups=fold_groups)
+    with timings.stage('genes', items=len(files)):
+        return weigh_partials(map_genes(func, files, processes), weights,
+            len(index) ** 2, median, fold_groups)
+
+
+def print_within(groups=None, present=None, stats=None, out_handle=None, table=None):
+    '''
+    The rows are printed to out_handle, if given, and added to the
+    dist_output.GroupTable `table`, if given.
+    '''
+    if out_handle is not None:
+        print('# within-group distances:', file=out_handle)
+        print('# group\tMinimum\tMaximum\tAverage\tMedian\tSample_std', file=out_handle)
+
+    results = stats.results()
+    na = ('NA.', 'NA.', 'NA.', 'NA.', 'NA.')
+    for code in np.nonzero(present)[0].tolist():
+        group = groups[code]
+        if table is not None:
+            table.add(code, int(stats.count[code]), results[code] if stats.count[code] >= 2 else na)
+        if out_handle is None:
+            continue
+        if stats.count[code] < 2:
+            print(group, 'NA.', sep='\t', file=out_handle)
+            continue
+        line = [str(i) for i in results[code]]
+        print(group, '\t'.join(line), sep='\t', file=out_handle)
+
+
+def print_between(groups=None, seen=None, stats=None, out_handle=None, pairs=None, table=None):
+    ngroups = len(groups)
+    results = stats.results()
+    if pairs is not None:
+        selected = np.zeros(ngroups * ngroups, dtype=bool)
+        for code1, code2 in pairs:
+            selected[code1 * ngroups + code2] = True
+            selected[code2 * ngroups + code1] = True
+        seen = seen & selected
+    for b in np.nonzero(seen)[0].tolist():
+        if table is not None:
+            table.add(b // ngroups, int(stats.count[b]), results.get(b, ('NA.',) * 5), b % ngroups)
+        if out_handle is None:
+            continue
+        g1, g2 = groups[b // ngroups], groups[b % ngroups]
+        if b in results:
+            stat = (int(stats.count[b]),) + results[b]
+        else:
+            stat = ('NA.', 'NA.', 'NA.', 'NA.', 'NA.', 'NA.')
+        line = [str(i) for i in stat]
+        print(g1, g2, '\t'.join(line), sep='\t', file=out_handle)
@@ -2,6 +2,7 @@
 import sys
 import os
 import re
+import timings
 
 
 def check_match(c, elements=None):
@@ -14,7 +15,7 @@ def check_match(c, elements=None):
 
 def main():
     usage = '''
-python3 {} <infile> <e1> <e2> [e3] [...]
+python3 {} <infile> <e1> <e2> [e3] [...] [-timings <file>] [-profile <prefix>]
 
 To output the lines whose first two columns consist of any combinations of user specified elements.
 
@@ -22,14 +23,16 @@ NB: The match is checked within the 'in' function!
 
 '''.format(sys.argv[0])
 
-    if len(sys.argv) < 3:
+    argv, timings_f, profile = timings.pop_arguments(sys.argv)
+
+    if len(argv) < 3:
         sys.exit(usage)
 
-    in_f = sys.argv[1]
-    elements = sys.argv[2:]
+    in_f = argv[1]
+    elements = argv[2:]
 
 
-    with open(in_f, 'r') as fh:
+    with timings.profiled(profile), timings.stage('filter'), open(in_f, 'r') as fh:
         for i in fh:
             i = i.strip()
             if not i:
@@ -39,5 +42,8 @@ NB: The match is checked within the 'in' function!
             if check_match(c1, elements) and check_match(c2, elements):
                 print(i)
 
+    if timings_f:
+        timings.write(timings_f)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
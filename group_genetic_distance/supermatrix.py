@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+'''
+Distances over the concatenated alignment of all genes (`-supermatrix` of
+batch_group_dist.py), without building the concatenation.
+
+The site counts of every pair of sequences (L: sites compared, Nd:
+differences, Ns1, Ns2: transitions, see dna_dist.pair_counts) and the base
+counts add up over the genes of a concatenation, so the genes are counted
+one by one (alignment.PackedAlignment) and their counts summed into
+SiteCounts; the model correction is applied once to the sums. Memory is
+four n x n count arrays for the n sequences of all genes, whatever the
+number of genes and sites.
+
+A sequence missing from a gene is a gap over that gene: it adds no site to
+its pairs. With pairwise deletion, the distances are those of
+`dist.dna(supermatrix, pairwise.deletion = TRUE)`. Without it, the sites
+with a gap or an ambiguous base are deleted gene by gene, among the
+sequences of the gene; a global deletion over the concatenation would
+delete every gene where a sequence is missing. Base frequencies (F81, T92,
+TN93) are those of all genes together. A pair with no site in common gets
+NaN.
+
+The counts of a gene come from the same pass as its distances with
+`-dist_engine native` (PackedAlignment.dist_and_counts); with `-cache_dir`
+they are cached beside the matrices (dist_cache.py), so a later run with
+any model or distance engine does not count the gene again (a native
+matrix of another model is computed from the cached counts).
+'''
+import numpy as np
+
+import dna_dist
+import dist_cache
+import timings
+from alignment import PackedAlignment
+
+COUNT_NAMES = ('L', 'Nd', 'Ns1', 'Ns2')
+
+
+def counts_dist_dna(counts=None, bases=None, model='K80'):
+    '''
+    Pairwise distance matrix (zero diagonal) of pair counts and base counts.
+    '''
+    if model not in dna_dist.NATIVE_MODELS:
+        raise ValueError('model {0} is not available in-process, use Rscript'.format(model))
+    matrix = dna_dist.model_distance(counts, model=model, bf=bases / max(bases.sum(), 1))
+    np.fill_diagonal(matrix, 0)
+    return matrix
+
+
+def gene_counts(msa_file=None, msa_format='fasta', pairwise_deletion=False):
+    '''
+    (seqids, pair counts, base counts) of one gene alignment.
+    '''
+    aln = PackedAlignment.read(msa_file=msa_file, msa_format=msa_format)
+    return aln.seqids, aln.pair_counts(pairwise_deletion=pairwise_deletion), aln.base_counts()
+
+
+def read_gene_counts(msa_file=None, msa_format='fasta', pairwise_deletion=False, cache_dir=None):
+    '''
+    gene_counts(), from the cache of cache_dir if it holds them (they are
+    stored there otherwise).
+    '''
+    key = None
+    if cache_dir:
+        key = dist_cache.counts_key(msa_file, msa_format, pairwise_deletion)
+        with timings.stage('cache'):
+            cached = dist_cache.load_counts(cache_dir, key)
+        if cached is not None:
+            return cached
+    with timings.stage('supermatrix_counts'):
+        counts = gene_counts(msa_file, msa_format, pairwise_deletion)
+    if key is not None:
+        with timings.stage('cache', items=len(counts[0])):
+            dist_cache.store_counts(cache_dir, key, *counts)
+    return counts
+
+
+class SiteCounts(object):
+    '''
+    Pair and base counts summed over genes; seqids in the order they are
+    first met.
+    '''
+
+    def __init__(self):
+        self.seqids = []
+        self.seqid_index = {}
+        self.counts = {name: np.zeros((0, 0), dtype=np.int64) for name in COUNT_NAMES}
+        self.bases = np.zeros(4, dtype=np.int64)
+        self.ngenes = 0
+
+    def _grow(self, seqids=None):
+        for seqid in seqids:
+            if seqid not in self.seqid_index:
+                self.seqid_index[seqid] = len(self.seqids)
+                self.seqids.append(seqid)
+        n = len(self.seqids)
+        for name, counts in self.counts.items():
+            if counts.shape[0] < n:
+                grown = np.zeros((n, n), dtype=np.int64)
+                grown[:counts.shape[0], :counts.shape[1]] = counts
+                self.counts[name] = grown
+
+    def add(self, seqids=None, counts=None, bases=None):
+        '''
+        Add the counts of one gene (as returned by gene_counts()).
+        '''
+        if len(set(seqids)) != len(seqids):
+            raise ValueError('duplicated seqids in a gene alignment')
+        self._grow(seqids)
+        idx = np.array([self.seqid_index[seqid] for seqid in seqids], dtype=np.int64)
+        block = np.ix_(idx, idx)
+        for name in COUNT_NAMES:
+            self.counts[name][block] += counts[name]
+        self.bases += bases
+        self.ngenes += 1
+
+    def dist_dna(self, model='K80'):
+        '''
+        Pairwise distance matrix of the summed counts (zero diagonal).
+        '''
+        return counts_dist_dna(self.counts, self.bases, model)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+'''
+Per-stage timings of a run (`-timings`) and profiler dumps (`-profile`).
+
+The library marks its stages with `with timings.stage(name, items):`
+(Rscript, csv parsing, group filtering, within, between, ...). Every
+stage records its calls, wall and CPU seconds and the items it processed;
+a stage entered several times adds up, and nested stages are each counted
+in full. process_peak_rss_kb is the peak RSS of the whole process so far
+when the stage last ended (getrusage ru_maxrss, kilobytes on Linux): it
+never decreases from one stage to the next, and a stage that raised it is
+one whose value is above that of the stage before. Stages run in worker
+processes (-processes) are not seen by the main process, which times the
+whole pool instead.
+
+write() dumps the report as JSON to a file, or to stderr for '-'.
+profiled() runs a block under cProfile and tracemalloc and writes
+<prefix>.prof (read it with `python -m pstats`) and <prefix>.tracemalloc
+(the lines that allocated the most memory).
+'''
+import sys
+import os
+import json
+import time
+import resource
+import contextlib
+import collections
+
+
+def peak_rss_kb():
+    '''
+    High-water mark of the RSS of this process since it started.
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Timings(object):
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.extra = {}
+
+    @contextlib.contextmanager
+    def stage(self, name=None, items=0):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(name, {'name': name, 'calls': 0,
+                'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0})
+            record['calls'] += 1
+            record['wall_seconds'] += time.perf_counter() - wall
+            record['cpu_seconds'] += time.process_time() - cpu
+            record['items'] += items
+            record['process_peak_rss_kb'] = peak_rss_kb()
+
+    def report(self):
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        report = {
+            'script': os.path.basename(sys.argv[0]),
+            'argv': sys.argv[1:],
+            'wall_seconds': time.perf_counter() - self.wall,
+            'cpu_seconds': time.process_time() - self.cpu,
+            'children_cpu_seconds': children.ru_utime + children.ru_stime,
+            'peak_rss_kb': peak_rss_kb(),
+            'stages': list(self.stages.values()),
+        }
+        report.update(self.extra)
+        return report
+
+    def write(self, dest='-'):
+        if dest == '-':
+            json.dump(self.report(), sys.stderr, indent=2)
+            print(file=sys.stderr)
+            return
+        with open(dest, 'w') as fhout:
+            json.dump(self.report(), fhout, indent=2)
+            print(file=fhout)
+
+
+# the timings of this process
+TIMINGS = Timings()
+
+
+def stage(name=None, items=0):
+    return TIMINGS.stage(name, items)
+
+
+def write(dest='-'):
+    TIMINGS.write(dest)
+
+
+@contextlib.contextmanager
+def profiled(prefix=None, top=30):
+    '''
+    Run the block under cProfile and tracemalloc if prefix is given.
+    '''
+    if not prefix:
+        yield
+        return
+    import cProfile
+    import tracemalloc
+
+    profile = cProfile.Profile()
+    tracemalloc.start()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profile.dump_stats(prefix + '.prof')
+        with open(prefix + '.tracemalloc', 'w') as fhout:
+            print('# peak traced memory: {0} bytes'.format(peak), file=fhout)
+            for stat in snapshot.statistics('lineno')[:top]:
+                print(stat, file=fhout)
+        TIMINGS.extra['profile'] = prefix + '.prof'
+        TIMINGS.extra['tracemalloc'] = prefix + '.tracemalloc'
+        TIMINGS.extra['tracemalloc_peak_bytes'] = peak
+
+
+def add_arguments(parser=None):
+    '''
+    The -timings and -profile options of every script.
+    '''
+    parser.add_argument('-timings', metavar='<file>', required=False,
+        help="write per-stage wall/CPU seconds, items and the process peak RSS as JSON to this file ('-' for stderr)")
+
+    parser.add_argument('-profile', metavar='<prefix>', required=False,
+        help='run under cProfile and tracemalloc, write <prefix>.prof and <prefix>.tracemalloc')
+
+
+def pop_arguments(argv=None):
+    '''
+    Remove `-timings <file>` and `-profile <prefix>` from the argument list
+    of a script without argparse; return (argv, timings, profile).
+    '''
+    argv = list(argv)
+    found = {'-timings': None, '-profile': None}
+    for option in found:
+        if option in argv:
+            i = argv.index(option)
+            if i + 1 >= len(argv):
+                sys.exit('{0} needs a value'.format(option))
+            found[option] = argv[i + 1]
+            del argv[i:i + 2]
+    return argv, found['-timings'], found['-profile']
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
-import re
-from mglcmdtools import csv2dict
-import statistics
 import argparse
 import sys
 import subprocess
 import os
+import functools
+from dist_stats import MEDIAN_MODES
+import multi_gene
+import dist_output
+import timings
+from aggregate_store import AggregateStore
+from group_index import GroupIndex
 
 
 def get_para():
@@ -18,7 +22,7 @@ can be generated with R ape package `dist.dna(a, as.matrix = TRUE)`
     parser = argparse.ArgumentParser(description=description)
 
     parser.add_argument('-pairwise_dist_list', metavar='<file>', required=True,
-        help='list of files of pairwise genetic distance matrix')
+        help='list of files of pairwise genetic distance matrix, csv or binary .npy')
 
     parser.add_argument('-group_definition', metavar='<file>', required=True,
         help='File format: seqid groupName')
@@ -29,108 +33,105 @@ can be generated with R ape package `dist.dna(a, as.matrix = TRUE)`
     parser.add_argument('-i_o', metavar='<file>', type=argparse.FileType('w'),
         default=sys.stdout, help='within-group distance output')
 
-    if len(sys.argv) == 1:
-        parser.print_help()
-        sys.exit()
+    parser.add_argument('-median', default="exact", choices=MEDIAN_MODES,
+        help='''exact: keep all values; approx: quantile sketch with 1%% relative
+error, memory bounded by the number of groups; none: do not compute medians
+(printed as NA.). [%(default)s]''')
 
-    args = parser.parse_args()
-
-    return args
+    parser.add_argument('-store', metavar='<dir>', required=False,
+        help='''keep the per-gene partials and the all-genes aggregate here; a later
+run only reads the genes added to (or changed in) the list, genes removed from
+the list are dropped from the aggregate''')
 
+    parser.add_argument('-processes', metavar='<int>', type=int, default=1,
+        help='number of processes to parse and reduce genes in parallel [%(default)s]')
 
-def get_seqid_group(infile=None, delimiter=r'\s+'):
-    seqid_group = {}
-    group_seqid = {}
-    with open(infile, 'r') as fh:
-        for i in fh:
-            i = i.strip()
-            seqid, group = re.split(delimiter, i, maxsplit=1)
-            seqid_group[seqid] = group
-            if group not in group_seqid:
-                group_seqid.setdefault(group, [])
-            group_seqid[group].append(seqid)
+    parser.add_argument('-out_format', default="text", choices=dist_output.OUT_FORMATS,
+        help='''text: tab-separated lines; npz, parquet (needs pyarrow) or hdf5 (needs
+h5py): typed columns written to the `-i_o` file, see dist_output.py [%(default)s]''')
 
-    return seqid_group, group_seqid
+    timings.add_arguments(parser)
 
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit()
 
-def get_members_of_specific_group(mdict=None, group_seqid=None, group=None):
-    items = []
-    for key1 in mdict:
-        for key2, val in mdict[key1].items():
-            if key1 in group_seqid[group] and key2 in group_seqid[group]:
-                items.append((key1, key2, val))
-    return items
-
-
-def stat_dist(items=None):
-    vals = []
-    for key1, key2, val in items:
-        vals.append(val)
-
-    # one val corresponds to two members.
-    if len(vals) <= 0:
-        return 'NA.', 'NA.', 'NA.', 'NA.', 'NA.'
-    return min(vals), max(vals), statistics.mean(vals), statistics.median(vals), statistics.stdev(vals)
-
+    args = parser.parse_args()
 
-def filter_not_existing_groups(triu_dict=None, seqid_group=None, group_seqid=None):
-    # delete some seqids
-    filtered_group_seqid = {}
-    for group in group_seqid:
-        for seqid in group_seqid[group]:
-            if seqid in triu_dict:
-                if group not in filtered_group_seqid:
-                    filtered_group_seqid.setdefault(group, [])
-                filtered_group_seqid[group].append(seqid)
-            else:
-                # discard
-                pass
+    if args.out_format != 'text':
+        if args.i_o is sys.stdout:
+            sys.exit('`-out_format {0}` needs an `-i_o` file!'.format(args.out_format))
+        message = dist_output.missing_dependency(args.out_format)
+        if message:
+            sys.exit(message)
 
-    return filtered_group_seqid
+    return args
 
 
-def distStat_of_all_genes_of_same_group(pairwise_dist_list=None, group_seqid=None, out_handle=None):
-    group_seq1Seq2Dist = {}
-    with open(pairwise_dist_list, 'r') as fh:
-        for f in fh:
-            f = f.strip()
-            triu_dict, tril_dict = csv2dict(f, header=0, all_key_to_all=False)
-            filtered_group_seqid = filter_not_existing_groups(triu_dict=triu_dict, group_seqid=group_seqid)
+def distStat_of_all_genes_of_same_group(pairwise_dist_list=None, index=None, out_handle=None, median='exact', processes=1, store=None, out_format='text'):
+    '''
+    Per-group running statistics over all genes: only the accumulators are
+    kept between genes, not the distance values (unless median='exact').
+    Infinite distances are skipped.
 
-            for group in sorted(filtered_group_seqid.keys()):
-                if group not in group_seq1Seq2Dist:
-                    group_seq1Seq2Dist.setdefault(group, [])
-                items = get_members_of_specific_group(mdict=triu_dict, group_seqid=group_seqid, group=group)
-                group_seq1Seq2Dist[group].extend(items)
+    store: directory of an AggregateStore, see aggregate_store.py.
+    out_format: see dist_output.py; the typed output is written to the
+    file of out_handle.
+    '''
+    files = multi_gene.read_file_list(pairwise_dist_list)
+    if store:
+        func = functools.partial(multi_gene.within_gene_partial, index=index, median=median)
+        present, stats = AggregateStore(store, 'within', index, median).update(files, func, processes)
+        if stats is None:
+            present, stats = multi_gene.within_all_genes([], index, median)
+    else:
+        present, stats = multi_gene.within_all_genes(
+            files=files,
+            index=index,
+            median=median,
+            processes=processes)
+
+    with timings.stage('output', items=len(index)):
+        if out_format != 'text':
+            table = dist_output.GroupTable(index.groups)
+            multi_gene.print_within(groups=index.groups, present=present, stats=stats, table=table)
+            out_handle.close()
+            dist_output.write_table(out_handle.name, out_format, table)
+            return
+        multi_gene.print_within(
+            groups=index.groups,
+            present=present,
+            stats=stats,
+            out_handle=out_handle)
 
-    print('# within-group distances:', file=out_handle)
-    print('# group\tMinimum\tMaximum\tAverage\tMedian\tSample_std', file=out_handle)
 
-    for group in sorted(group_seq1Seq2Dist.keys()):
-        items = group_seq1Seq2Dist[group]
-        if len(items) < 2:
-            print(group, 'NA.', sep='\t', file=out_handle)
-            continue
-        line = [str(i) for i in stat_dist(items)]
-        print(group, '\t'.join(line), sep='\t', file=out_handle)
+def main():
+    args = get_para()
 
+    with timings.profiled(args.profile):
+        run(args)
 
+    if args.timings:
+        timings.write(args.timings)
 
 
-def main():
+def run(args=None):
 
     f_dir = os.getcwd()
 
-    args = get_para()
-
-    seqid_group, group_seqid = get_seqid_group(
-        infile=args.group_definition,
-        delimiter=args.delimiter)
+    with timings.stage('groups'):
+        index = GroupIndex.read(
+            infile=args.group_definition,
+            delimiter=args.delimiter)
 
     distStat_of_all_genes_of_same_group(
         pairwise_dist_list=args.pairwise_dist_list,
-        group_seqid=group_seqid,
-        out_handle=args.i_o)
+        index=index,
+        out_handle=args.i_o,
+        median=args.median,
+        processes=args.processes,
+        store=args.store,
+        out_format=args.out_format)
 
 
 
@@ -15,7 +15,7 @@ setuptools.setup(
     url='https://github.com/linzhi2013/group_genetic_distance',
     packages=setuptools.find_packages(),
     include_package_data=True,
-    install_requires=['mglcmdtools', 'statistics'],
+    install_requires=['mglcmdtools', 'statistics', 'numpy'],
 
     classifiers=(
         "Development Status :: 3 - Alpha",